@@ -0,0 +1,409 @@
+"""Headless HTTP API for resolving formats and downloading videos.
+
+    python api_server.py --port 8503 --download-dir youtube_downloads
+
+    GET    /api/formats?url=<youtube url>      formats by category
+    POST   /api/jobs                           {"url": ..., "itag": 137} or {"url": ..., "rule": "best audio"}
+                                               or {"url": ..., "merge": true, "ae_compatible": false}
+    GET    /api/jobs                           all jobs
+    GET    /api/jobs/<id>                      status and progress
+    DELETE /api/jobs/<id>                      cancel
+    GET    /api/jobs/<id>/file                 the finished file (Range requests supported)
+    GET    /api/bandwidth                      global cap; PUT {"rate": "20M"} changes it
+    GET    /metrics                            Prometheus metrics
+
+Jobs may also set "priority" ("interactive", the default, or "batch") and
+a per-download "rate_limit" (bytes/sec or e.g. "2M"); PATCH /api/jobs/<id>
+changes either while the job runs.
+
+Files are sent from disk with sendfile(), so memory per connection stays
+the same whatever the size of the video. Each connection does hold a
+thread, though: at most YTDL_MAX_CONNECTIONS (default 256) are served at
+once, further clients get a 503, and idle keep-alive connections are
+closed after 30 seconds.
+"""
+import argparse
+import json
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+from bandwidth import INTERACTIVE, PRIORITIES, bandwidth, parse_rate
+from commons import download_selected_stream, get_available_streams, parse_format_rule, select_stream
+from file_server import IDLE_TIMEOUT, FileHTTPServer, send_file
+from metrics import metrics, send_metrics
+from mux import download_best_quality, pick_best_pair
+from prefetch import prefetcher
+from retention import start_retention
+from segmented import DownloadCancelled, DownloadControl
+from store import get_store
+
+# The API has no authentication; listen beyond loopback only when asked to
+API_HOST = os.environ.get("YTDL_API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("YTDL_API_PORT", "8503"))
+API_WORKERS = 4
+# Finished jobs are forgotten this long after they were last looked at
+JOB_TTL = 60 * 60
+MAX_BODY_SIZE = 64 * 1024
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ApiJob:
+    def __init__(self, url, itag=None, rule=None, merge=False, ae_compatible=False,
+                 priority=INTERACTIVE, rate_limit=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.url = url
+        self.itag = itag
+        self.rule = rule
+        self.merge = merge
+        self.ae_compatible = ae_compatible
+        self.control = DownloadControl(priority, rate_limit)
+        self.status = 'queued'
+        self.title = None
+        self.total = 0
+        self.bytes_done = 0
+        self.file_path = None
+        self.file_name = None
+        self.error = None
+        self.created = time.time()
+        self.last_access = self.created
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def on_progress(self, stream, chunk, bytes_remaining):
+        self.bytes_done = self.total - bytes_remaining if self.total else self.bytes_done + len(chunk)
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'url': self.url,
+            'status': self.status,
+            'title': self.title,
+            'bytes_done': self.bytes_done,
+            'total_bytes': self.total,
+            'error': self.error,
+            'priority': self.control.priority,
+            'rate_limit': self.control.rate_limit,
+        }
+        if self.status == 'done':
+            data['file_name'] = self.file_name
+            data['file_url'] = f"/api/jobs/{self.id}/file"
+        return data
+
+
+class JobManager:
+    """Runs ApiJobs on a bounded pool of download threads"""
+
+    def __init__(self, download_dir, workers=API_WORKERS, job_ttl=JOB_TTL):
+        self.download_dir = download_dir
+        self.job_ttl = job_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api-download')
+
+    def submit(self, job):
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.last_access = time.time()
+            return job
+
+    def jobs(self):
+        with self._lock:
+            self._expire()
+            return list(self._jobs.values())
+
+    def cancel(self, job):
+        job.control.cancel()
+        if job.status == 'queued':
+            job.status = 'cancelled'
+
+    def is_serving(self, path):
+        """True while an unexpired job still offers path for download"""
+        path = os.path.abspath(path)
+        with self._lock:
+            return any(j.file_path and os.path.abspath(j.file_path) == path for j in self._jobs.values())
+
+    def _queued(self):
+        """URLs of jobs still waiting for a download thread, oldest first"""
+        with self._lock:
+            return [j.url for j in self._jobs.values() if j.status == 'queued']
+
+    def _expire(self):
+        cutoff = time.time() - self.job_ttl
+        for job_id in [i for i, j in self._jobs.items() if j.finished and j.last_access < cutoff]:
+            del self._jobs[job_id]
+
+    def _run(self, job):
+        if job.control.cancelled.is_set():
+            job.status = 'cancelled'
+            return
+        try:
+            job.status = 'resolving'
+            # Look up the formats of the jobs queued behind this one meanwhile
+            prefetcher.ahead(self._queued())
+            streams, job.title = get_available_streams(job.url)
+            if job.merge:
+                video, audio = pick_best_pair(streams, job.ae_compatible)
+                if job.itag is not None:
+                    video = _find(streams, job.itag)
+                if video is None or audio is None:
+                    raise Exception("No video-only and audio-only streams to merge")
+                job.total = (video.filesize or 0) + (audio.filesize or 0)
+                job.status = 'downloading'
+                job.file_path, job.file_name = download_best_quality(
+                    video, audio, job.title, self.download_dir, ae_compatible=job.ae_compatible,
+                    on_progress=job.on_progress, control=job.control)
+            else:
+                stream = _find(streams, job.itag) if job.itag is not None else select_stream(streams, job.rule)
+                if stream is None:
+                    raise Exception(f"No stream matching {job.itag or job.rule!r}")
+                job.total = stream.filesize or 0
+                job.status = 'downloading'
+                job.file_path, job.file_name = download_selected_stream(
+                    stream, job.title, self.download_dir, on_progress=job.on_progress, control=job.control)
+            job.bytes_done = job.total or os.path.getsize(job.file_path)
+            job.status = 'done'
+        except DownloadCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.status, job.error = 'failed', str(e)
+
+
+def _find(streams, itag):
+    return next((s for s in streams.all_streams() if s.itag == itag), None)
+
+
+def _itag(value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, "itag must be an integer")
+
+
+def _priority(value):
+    if value not in PRIORITIES:
+        raise ApiError(400, f"priority must be one of {', '.join(PRIORITIES)}")
+    return value
+
+
+def _rate(value):
+    try:
+        return parse_rate(value)
+    except (TypeError, ValueError) as e:
+        raise ApiError(400, str(e))
+
+
+def formats_to_dict(streams, title):
+    return {
+        'title': title,
+        'formats': {category: [{
+            'itag': s.itag,
+            'label': s.label,
+            'mime_type': s.mime_type,
+            'codecs': s.codecs,
+            'codec_family': s.codec_family,
+            'resolution': s.resolution,
+            'abr': s.abr,
+            'fps': s.fps,
+            'filesize': s.filesize,
+        } for s in stream_list] for category, stream_list in streams.items()},
+    }
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    timeout = IDLE_TIMEOUT
+    manager = None  # set by make_server
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def send_response(self, code, message=None):
+        self.response_started = True
+        super().send_response(code, message)
+
+    def _dispatch(self, method):
+        self.response_started = False
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip('/').split('/')[1:]
+        try:
+            if method == 'GET' and path == ['metrics']:
+                send_metrics(self)
+            elif method == 'GET' and path == ['healthz']:
+                self._json(200, {'ok': True})
+            elif method == 'GET' and path == ['api', 'formats']:
+                self._formats(parse_qs(parts.query))
+            elif path == ['api', 'jobs'] and method == 'POST':
+                self._submit()
+            elif path == ['api', 'jobs'] and method == 'GET':
+                self._json(200, {'jobs': [j.to_dict() for j in self.manager.jobs()]})
+            elif path == ['api', 'bandwidth'] and method in ('GET', 'PUT'):
+                if method == 'PUT':
+                    bandwidth.set_rate(_rate(self._body().get('rate')))
+                self._json(200, {'rate': bandwidth.rate})
+            elif len(path) == 3 and path[:2] == ['api', 'jobs'] and method in ('GET', 'PATCH', 'DELETE'):
+                job = self._job(path[2])
+                if method == 'DELETE':
+                    self.manager.cancel(job)
+                elif method == 'PATCH':
+                    self._update(job, self._body())
+                self._json(200, job.to_dict())
+            elif len(path) == 4 and path[:2] == ['api', 'jobs'] and path[3] == 'file' and method in ('GET', 'HEAD'):
+                self._file(self._job(path[2]), send_body=method == 'GET')
+            else:
+                raise ApiError(404, "Not found")
+        except ApiError as e:
+            self._json(e.status, {'error': str(e)})
+        except Exception as e:
+            metrics.event('api_error', method=method, path=parts.path, error=f"{type(e).__name__}: {e}")
+            self.close_connection = True
+            if not self.response_started:
+                self._json(500, {'error': "Internal server error"})
+
+    def _formats(self, query):
+        url = query.get('url', [None])[0]
+        if not url:
+            raise ApiError(400, "Missing url parameter")
+        try:
+            streams, title = get_available_streams(url)
+        except Exception as e:
+            raise ApiError(502, f"Could not resolve formats: {e}")
+        self._json(200, formats_to_dict(streams, title))
+
+    def _body(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Nothing tells where this body ends and the next request starts
+            self.close_connection = True
+            raise ApiError(400, "Invalid Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise ApiError(413, "Request body too large")
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            raise ApiError(400, "Body must be JSON")
+        if not isinstance(body, dict):
+            raise ApiError(400, "Body must be a JSON object")
+        return body
+
+    def _submit(self):
+        body = self._body()
+        if not body.get('url'):
+            raise ApiError(400, "Missing url")
+        rule = body.get('rule')
+        if rule is not None:
+            try:
+                parse_format_rule(rule)
+            except ValueError as e:
+                raise ApiError(400, str(e))
+        job = ApiJob(body['url'], itag=_itag(body.get('itag')), rule=rule or "best progressive",
+                     merge=bool(body.get('merge')), ae_compatible=bool(body.get('ae_compatible')),
+                     priority=_priority(body.get('priority', INTERACTIVE)), rate_limit=_rate(body.get('rate_limit')))
+        self.manager.submit(job)
+        self._json(202, job.to_dict(), location=f"/api/jobs/{job.id}")
+
+    def _update(self, job, body):
+        if 'priority' in body:
+            job.control.priority = _priority(body['priority'])
+        if 'rate_limit' in body:
+            job.control.rate_limit = _rate(body['rate_limit'])
+
+    def _job(self, job_id):
+        job = self.manager.get(job_id)
+        if job is None:
+            raise ApiError(404, "No such job")
+        return job
+
+    def _file(self, job, send_body):
+        if job.status != 'done' or not job.file_path or not os.path.isfile(job.file_path):
+            raise ApiError(409 if not job.finished else 410, f"File not available (job is {job.status})")
+        # Keeps retention from expiring a file that is still being fetched
+        get_store(self.manager.download_dir).touch(job.file_path)
+        mime_type = mimetypes.guess_type(job.file_name)[0] or 'application/octet-stream'
+        send_file(self, job.file_path, job.file_name, mime_type, send_body)
+
+    def _json(self, status, data, location=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if location:
+            self.send_header('Location', location)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(download_dir, host=API_HOST, port=API_PORT, workers=API_WORKERS):
+    """An API server (not yet serving) and its JobManager"""
+    os.makedirs(download_dir, exist_ok=True)
+    manager = JobManager(download_dir, workers)
+    handler = type('Handler', (ApiRequestHandler,), {'manager': manager})
+    return FileHTTPServer((host, port), handler), manager
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the downloader over HTTP.")
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('-o', '--download-dir', default="youtube_downloads")
+    parser.add_argument('-w', '--workers', type=int, default=API_WORKERS, help="Parallel downloads")
+    args = parser.parse_args(argv)
+
+    server, manager = make_server(args.download_dir, args.host, args.port, args.workers)
+    start_retention(args.download_dir, in_use=manager.is_serving)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,15 +5,24 @@ from tkinter import filedialog # <-- Import filedialog
 import os
 import threading
 import json # <-- Import json for saving/loading config
+import multiprocessing
 import subprocess # <-- Import for opening folders
-from commons import (
-    get_available_streams,
-    download_selected_stream,
-)
+import time
+# The download backend (commons, mux, pytubefix, asyncio) is imported where
+# it is first used, so the window opens before any of it loads; warm_up()
+# then loads it in the background while the user types a URL
 
 # --- Configuration Handling ---
 CONFIG_FILE = "config.json"
 DEFAULT_DOWNLOAD_FOLDER = "youtube_downloads"
+DEFAULT_MAX_PARALLEL_DOWNLOADS = 2
+# Progress callbacks arrive per chunk; the job list is redrawn at most this often
+PROGRESS_REFRESH_MS = 250
+# 'inline' downloads in this process; 'queue' hands jobs to `jobqueue.py worker`
+# processes (on any machine) that share the download folder
+DOWNLOAD_MODE = os.environ.get("YTDL_DOWNLOAD_MODE", "inline")
+# Label shown in the UI -> transcode profile (see transcode.py)
+TRANSCODE_OPTIONS = {"Keep original format": None, "H.264/AAC (MP4)": 'h264', "ProRes/WAV (MOV)": 'prores'}
 
 def load_config():
     """Loads configuration from file."""
@@ -34,11 +43,313 @@ def save_config(config_data):
 # --- Existing Functions (Ensure they use the dynamic download path) ---
 
 
+# --- Download Manager ---
+class DownloadJob:
+    """One queued/running download and its live progress numbers
+
+    Download threads and the Tk thread both touch the mutable fields, so
+    they are only read or written while holding `lock` (the manager's).
+    """
+
+    def __init__(self, job_id, stream, title, download_folder, audio_stream=None, ae_compatible=False,
+                 transcode=None, lock=None):
+        self.job_id = job_id
+        self.stream = stream
+        self.title = title
+        self.download_folder = download_folder
+        # Set for "best quality" jobs that merge video-only + audio-only streams
+        self.audio_stream = audio_stream
+        self.ae_compatible = ae_compatible
+        # Transcode profile for single-stream jobs, encoded while downloading
+        self.transcode = transcode
+        self.encoded = None # fraction of the source encoded so far
+        from segmented import DownloadControl
+        self.control = DownloadControl()
+        self.status = "Queued"
+        self.total = (stream.filesize or 0) + (audio_stream.filesize or 0 if audio_stream else 0)
+        self.bytes_done = 0
+        self.speed = 0.0 # bytes/sec, smoothed
+        self.file_name = None
+        self.error = None
+        self._last_bytes = 0
+        self._last_time = None
+        self._lock = lock or threading.Lock()
+
+    @property
+    def label(self):
+        if self.audio_stream:
+            return f"{self.title} - {self.stream.resolution} + {self.audio_stream.abr} (merged mp4)"
+        if self.transcode:
+            return f"{self.title} - {self.stream.resolution or self.stream.abr} ({self.stream.subtype} -> {self.transcode})"
+        return f"{self.title} - {self.stream.resolution or self.stream.abr} ({self.stream.subtype})"
+
+    @property
+    def finished(self):
+        return self.status in ("Done", "Failed", "Cancelled")
+
+    def on_progress(self, stream, chunk, bytes_remaining):
+        # Called from the download thread for every chunk; only update numbers here
+        with self._lock:
+            self.bytes_done = self.total - bytes_remaining if self.total else self.bytes_done + len(chunk)
+
+    def on_encode(self, transcode_job):
+        with self._lock:
+            self.encoded = transcode_job.progress
+
+    def sample_speed(self, now):
+        """Update the smoothed bytes/sec from progress since the last sample"""
+        if self._last_time is not None and now > self._last_time:
+            instant = (self.bytes_done - self._last_bytes) / (now - self._last_time)
+            self.speed = instant if not self.speed else 0.7 * self.speed + 0.3 * instant
+        self._last_bytes, self._last_time = self.bytes_done, now
+
+    @property
+    def eta(self):
+        if not self.speed or not self.total:
+            return None
+        return max(self.total - self.bytes_done, 0) / self.speed
+
+
+class DownloadManager:
+    """Runs queued DownloadJobs on at most `max_parallel` worker threads.
+
+    Progress callbacks only mark the manager dirty; a single pending
+    root.after() call redraws all rows, so a fast download cannot flood
+    the Tk event queue.
+    """
+
+    def __init__(self, root, on_update, max_parallel=DEFAULT_MAX_PARALLEL_DOWNLOADS, on_finished=None):
+        self.root = root
+        self.on_update = on_update # called on the Tk thread with the job list, holding the lock
+        self.on_finished = on_finished # called on the Tk thread with each job that ends
+        self.max_parallel = max(1, max_parallel)
+        self.jobs = []
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._refresh_pending = False
+
+    def submit(self, stream, title, download_folder, audio_stream=None, ae_compatible=False, transcode=None):
+        with self._lock:
+            job = DownloadJob(self._next_id, stream, title, download_folder, audio_stream, ae_compatible, transcode,
+                              lock=self._lock)
+            self._next_id += 1
+            self.jobs.append(job)
+        self._start_queued()
+        self.request_refresh()
+        return job
+
+    def set_max_parallel(self, value):
+        self.max_parallel = max(1, int(value))
+        self._start_queued()
+
+    def pause(self, job):
+        job.control.pause()
+        with self._lock:
+            if job.status in ("Queued", "Downloading"):
+                job.status = "Paused" if job.status == "Downloading" else "Queued (paused)"
+        self.request_refresh()
+
+    def resume(self, job):
+        job.control.resume()
+        with self._lock:
+            if job.status == "Paused":
+                job.status = "Downloading"
+            elif job.status == "Queued (paused)":
+                job.status = "Queued"
+        self._start_queued()
+        self.request_refresh()
+
+    def cancel(self, job):
+        job.control.cancel()
+        with self._lock:
+            if job.status.startswith("Queued"):
+                job.status = "Cancelled"
+        self.request_refresh()
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.jobs)
+
+    def clear_finished(self):
+        with self._lock:
+            self.jobs = [j for j in self.jobs if not j.finished]
+        self.request_refresh()
+
+    def _start_queued(self):
+        with self._lock:
+            running = sum(1 for j in self.jobs if j.status in ("Downloading", "Paused"))
+            to_start = []
+            for job in self.jobs:
+                if running >= self.max_parallel:
+                    break
+                if job.status == "Queued":
+                    job.status = "Downloading"
+                    to_start.append(job)
+                    running += 1
+        for job in to_start:
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        from commons import download_selected_stream
+        from mux import download_best_quality
+        from retention import start_retention
+        from segmented import DownloadCancelled
+        from transcode import download_and_transcode
+
+        # Downloaded files belong to the user; only the shared store and
+        # abandoned partials in the folder are kept under quota
+        start_retention(job.download_folder, delivered_ttl=None)
+        file_name, error = None, None
+        try:
+            if DOWNLOAD_MODE == 'queue':
+                file_name = self._run_queued(job)
+                file_path = os.path.join(job.download_folder, file_name)
+            elif job.audio_stream:
+                file_path, file_name = download_best_quality(
+                    job.stream, job.audio_stream, job.title, job.download_folder,
+                    ae_compatible=job.ae_compatible, on_progress=job.on_progress, control=job.control)
+            elif job.transcode:
+                file_path, file_name = download_and_transcode(
+                    job.stream, job.title, job.download_folder, job.transcode,
+                    on_progress=job.on_progress, on_encode=job.on_encode, control=job.control)
+            else:
+                file_path, file_name = download_selected_stream(
+                    job.stream, job.title, job.download_folder,
+                    on_progress=job.on_progress, control=job.control)
+            status, bytes_done = "Done", job.total or os.path.getsize(file_path)
+        except DownloadCancelled:
+            status = "Cancelled"
+        except Exception as e:
+            status, error = "Failed", str(e)
+        with self._lock:
+            job.status, job.file_name, job.error = status, file_name, error
+            if status == "Done":
+                job.bytes_done = bytes_done
+        if self.on_finished:
+            self.root.after(0, self.on_finished, job)
+        self._start_queued()
+        self.request_refresh()
+
+    def _run_queued(self, job):
+        """Submit the job to the folder's job queue and mirror its progress until a worker finishes it"""
+        from commons import watch_url
+        from jobqueue import JobQueue, wait_for_job
+        from segmented import DownloadCancelled
+
+        queue = JobQueue(job.download_folder)
+        job_id = queue.submit(watch_url(job.stream.video_id), itag=job.stream.itag, merge=bool(job.audio_stream),
+                              audio_itag=job.audio_stream.itag if job.audio_stream else None,
+                              ae_compatible=job.ae_compatible, transcode=job.transcode)
+
+        def update(remote):
+            with self._lock:
+                job.bytes_done = remote['bytes_done']
+            self.request_refresh()
+
+        remote = wait_for_job(queue, job_id, on_update=update, should_cancel=job.control.cancelled.is_set)
+        if remote['status'] == 'cancelled':
+            raise DownloadCancelled()
+        if remote['status'] == 'failed':
+            raise Exception(remote['error'])
+        return remote['file_name']
+
+    def request_refresh(self):
+        """Coalesce UI updates: at most one refresh is waiting in root.after"""
+        with self._lock:
+            if self._refresh_pending:
+                return
+            self._refresh_pending = True
+        self.root.after(PROGRESS_REFRESH_MS, self._refresh)
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            self._refresh_pending = False
+            jobs = list(self.jobs)
+            for job in jobs:
+                if job.status == "Downloading":
+                    job.sample_speed(now)
+            self.on_update(jobs)
+            moving = any(j.status == "Downloading" for j in jobs)
+        # Keep ticking while anything is moving so speed/ETA stay current
+        if moving:
+            self.request_refresh()
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{int(n)} B"
+        n /= 1024
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return ""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class DownloadManagerPanel(ttk.LabelFrame):
+    """Job list with per-job progress, speed, ETA and pause/resume/cancel"""
+
+    COLUMNS = (("name", "Download", 300), ("status", "Status", 110), ("progress", "Progress", 130),
+               ("speed", "Speed", 90), ("eta", "ETA", 70))
+
+    def __init__(self, parent, manager, on_max_parallel_changed):
+        super().__init__(parent, text="Downloads")
+        self.manager = manager
+
+        self.tree = ttk.Treeview(self, columns=[c[0] for c in self.COLUMNS], show="headings", height=6)
+        for key, heading, width in self.COLUMNS:
+            self.tree.heading(key, text=heading)
+            self.tree.column(key, width=width, anchor=tk.W)
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        controls = ttk.Frame(self)
+        controls.pack(fill=tk.X, padx=5, pady=(0, 5))
+        ttk.Button(controls, text="Pause", command=lambda: self._apply(manager.pause)).pack(side=tk.LEFT)
+        ttk.Button(controls, text="Resume", command=lambda: self._apply(manager.resume)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(controls, text="Cancel", command=lambda: self._apply(manager.cancel)).pack(side=tk.LEFT)
+        ttk.Button(controls, text="Clear Finished", command=manager.clear_finished).pack(side=tk.LEFT, padx=5)
+
+        self.max_parallel_var = tk.IntVar(value=manager.max_parallel)
+        ttk.Spinbox(controls, from_=1, to=10, width=3, textvariable=self.max_parallel_var,
+                    command=lambda: on_max_parallel_changed(self.max_parallel_var.get())).pack(side=tk.RIGHT)
+        ttk.Label(controls, text="Parallel downloads:").pack(side=tk.RIGHT, padx=5)
+
+    def _apply(self, action):
+        by_id = {str(j.job_id): j for j in self.manager.snapshot()}
+        for item in self.tree.selection():
+            if item in by_id:
+                action(by_id[item])
+
+    def update_jobs(self, jobs):
+        existing = set(self.tree.get_children())
+        for job in jobs:
+            progress = f"{format_bytes(job.bytes_done)} / {format_bytes(job.total)}" if job.total else format_bytes(job.bytes_done)
+            if job.encoded is not None:
+                progress += f", encoded {job.encoded:.0%}"
+            downloading = job.status == "Downloading"
+            values = (job.label, job.status if not job.error else f"Failed: {job.error}", progress,
+                      f"{format_bytes(job.speed)}/s" if downloading else "",
+                      format_eta(job.eta) if downloading else "")
+            item = str(job.job_id)
+            if item in existing:
+                self.tree.item(item, values=values)
+                existing.discard(item)
+            else:
+                self.tree.insert("", tk.END, iid=item, values=values)
+        for item in existing:
+            self.tree.delete(item)
+
+
 class DownloaderApp:
     def __init__(self, root):
         self.root = root
         self.root.title("YouTube Video Downloader")
-        self.root.geometry("800x600") # Example size
+        self.root.geometry("800x800") # Room for the download list
 
         self.streams_data = None
         self.video_title = ""
@@ -73,7 +384,11 @@ class DownloaderApp:
         # --- UI Elements ---
         # URL Input
         ttk.Label(root, text="Enter YouTube URL:").pack(pady=5)
-        self.url_entry = ttk.Entry(root, width=60)
+        self.prefetcher = None  # loaded off the Tk thread by on_url_changed
+        self.loading_prefetcher = False
+        self.url_var = tk.StringVar()
+        self.url_var.trace_add('write', self.on_url_changed)
+        self.url_entry = ttk.Entry(root, width=60, textvariable=self.url_var)
         self.url_entry.pack(pady=5)
 
         # Show Formats Button
@@ -100,6 +415,15 @@ class DownloaderApp:
         self.status_label = ttk.Label(root, text="")
         self.status_label.pack(pady=10)
 
+        # --- Download Manager Panel ---
+        self.download_manager = DownloadManager(
+            root, on_update=lambda jobs: self.manager_panel.update_jobs(jobs),
+            max_parallel=self.config.get("max_parallel_downloads", DEFAULT_MAX_PARALLEL_DOWNLOADS),
+            on_finished=self.download_finished)
+        self.manager_panel = DownloadManagerPanel(root, self.download_manager, self.set_max_parallel_downloads)
+        self.manager_panel.pack(side=tk.BOTTOM, fill=tk.BOTH, expand=True, padx=10, pady=10)
+        # --- End Download Manager Panel ---
+
     def select_download_folder(self):
         """Opens a dialog to select the download folder."""
         # Determine a sensible starting directory
@@ -124,9 +448,35 @@ class DownloaderApp:
              self.update_status("Folder selection cancelled.")
 
 
+    def download_finished(self, job):
+        if job.status == "Done":
+            self.update_status(f"Download complete: {job.file_name}")
+        elif job.status == "Failed":
+            self.update_status(f"Download failed: {job.error}", True)
+            messagebox.showerror("Download Error", f"Failed to download '{job.title}': {job.error}")
+
     def update_status(self, text, is_error=False):
         self.status_label.config(text=text, foreground="red" if is_error else "white")
 
+    def on_url_changed(self, *args):
+        """Start looking up formats as soon as the field holds a video URL"""
+        if self.prefetcher is not None:
+            self.prefetcher.hint(self.url_var.get().strip())
+        elif not self.loading_prefetcher:
+            # prefetch pulls in commons, pytubefix and the engine; importing
+            # them here would freeze the window at the first keystroke
+            self.loading_prefetcher = True
+            threading.Thread(target=self.load_prefetcher, daemon=True).start()
+
+    def load_prefetcher(self):
+        from prefetch import prefetcher
+        self.root.after(0, self.prefetcher_loaded, prefetcher)
+
+    def prefetcher_loaded(self, prefetcher):
+        # Hint whatever the field reads by now, not what it read when loading started
+        self.prefetcher = prefetcher
+        self.on_url_changed()
+
     def fetch_formats_thread(self):
         url = self.url_entry.get()
         if not url:
@@ -141,6 +491,8 @@ class DownloaderApp:
         thread.start()
 
     def fetch_formats_task(self, url):
+        from commons import get_available_streams
+
         try:
             streams, title = get_available_streams(url)
             self.streams_data = streams
@@ -167,6 +519,15 @@ class DownloaderApp:
         ttk.Radiobutton(self.format_frame, text="Video Only", variable=self.format_type_var, value='video', command=self.update_quality_options).pack(anchor=tk.W)
         ttk.Radiobutton(self.format_frame, text="Audio Only", variable=self.format_type_var, value='audio', command=self.update_quality_options).pack(anchor=tk.W)
         ttk.Radiobutton(self.format_frame, text="After Effects Compatible", variable=self.format_type_var, value='ae_compatible', command=self.update_quality_options).pack(anchor=tk.W)
+        ttk.Radiobutton(self.format_frame, text="Best Quality (Video+Audio merged, needs ffmpeg)", variable=self.format_type_var, value='best', command=self.update_quality_options).pack(anchor=tk.W)
+        # Only used by Best Quality: re-encode what isn't already H.264/AAC
+        self.ae_output_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.format_frame, text="Merged output for After Effects (H.264/AAC)", variable=self.ae_output_var).pack(anchor=tk.W, padx=20)
+        # Everything else can be transcoded for After Effects after (and while) downloading
+        ttk.Label(self.format_frame, text="Transcode for After Effects:").pack(anchor=tk.W, pady=(10,0))
+        self.transcode_combobox = ttk.Combobox(self.format_frame, width=30, state="readonly", values=list(TRANSCODE_OPTIONS))
+        self.transcode_combobox.current(0)
+        self.transcode_combobox.pack(anchor=tk.W)
 
         # Add a note about After Effects compatibility
         # ae_note = ttk.Label(self.format_frame, text="Note: 'After Effects Compatible' option filters for formats that work with Adobe After Effects", 
@@ -204,34 +565,18 @@ class DownloaderApp:
 
     def update_quality_options(self):
         format_type = self.format_type_var.get()
-        stream_list = self.streams_data.get(format_type, [])
+        # Best Quality lists the video-only streams; audio is paired automatically
+        category = 'video' if format_type == 'best' else format_type
+        # The catalog orders each category and builds its labels once per video
+        self.stream_map = self.streams_data.options(category, detailed=format_type in ('ae_compatible', 'best'))
 
-        if not stream_list:
+        if not self.stream_map:
             self.quality_combobox['values'] = []
             self.quality_combobox.set('')
             self.selected_stream = None
             self.download_button.config(state=tk.DISABLED)
             return
 
-        try:
-             sorted_streams = sorted(stream_list,
-                                   key=lambda s: (
-                                       int(s.resolution[:-1])
-                                       if s.resolution and s.resolution.endswith('p')
-                                       else int(s.abr[:-4]) if s.abr and s.abr.endswith('kbps')
-                                       else 0
-                                   ),
-                                   reverse=True)
-        except Exception as e:
-             print(f"Error sorting streams: {e}") # Handle potential sorting errors
-             sorted_streams = stream_list # Fallback to unsorted
-
-        # For After Effects compatibility, add codec info to the display
-        if format_type == 'ae_compatible':
-            self.stream_map = {f"{s.resolution or s.abr} ({s.mime_type} - {s.codecs[0]})": s for s in sorted_streams}
-        else:
-            self.stream_map = {f"{s.resolution or s.abr} ({s.mime_type})": s for s in sorted_streams}
-            
         options = list(self.stream_map.keys())
 
         self.quality_combobox['values'] = options
@@ -257,6 +602,12 @@ class DownloaderApp:
              self.selected_stream = None
              self.download_button.config(state=tk.DISABLED)
 
+    def set_max_parallel_downloads(self, value):
+        """Applies and saves the parallel download limit."""
+        self.download_manager.set_max_parallel(value)
+        self.config["max_parallel_downloads"] = self.download_manager.max_parallel
+        save_config(self.config)
+
     def download_selected_thread(self):
         if not self.selected_stream:
             messagebox.showwarning("Selection Error", "No stream selected.")
@@ -268,64 +619,45 @@ class DownloaderApp:
              return
         # --- End Check ---
 
-        # --- Disable UI elements ---
-        self.update_status("Downloading... ⏳") # Add an indicator
-        self.download_button.config(state=tk.DISABLED)
-        self.show_formats_button.config(state=tk.DISABLED)
-        self.url_entry.config(state=tk.DISABLED)
-        self.select_folder_button.config(state=tk.DISABLED)
-        self.quality_combobox.config(state=tk.DISABLED)
-        # Disable radio buttons if they exist
-        try:
-            for widget in self.format_frame.winfo_children():
-                if isinstance(widget, ttk.Radiobutton):
-                    widget.config(state=tk.DISABLED)
-        except tk.TclError: # Handle case where format_frame might not exist yet
-            pass
-        # --- End Disable UI elements ---
+        audio_stream = None
+        ae_output = False
+        transcode = TRANSCODE_OPTIONS.get(self.transcode_combobox.get())
+        if self.format_type_var.get() == 'best':
+            transcode = None # the merge encodes H.264/AAC itself when asked to
+            ae_output = self.ae_output_var.get()
+            from mux import pick_best_audio
+            audio_stream = pick_best_audio(self.streams_data, ae_output)
+            if audio_stream is None:
+                messagebox.showwarning("Selection Error", "No audio stream available to merge.")
+                return
 
+        # Queue the download; the manager runs it in the background so the
+        # rest of the UI stays usable for picking the next video
+        job = self.download_manager.submit(self.selected_stream, self.video_title, self.current_download_folder,
+                                           audio_stream=audio_stream, ae_compatible=ae_output, transcode=transcode)
+        self.update_status(f"Queued: {job.label}")
 
-        # Run download in a separate thread, passing the current folder
-        thread = threading.Thread(target=self.download_task, args=(self.selected_stream, self.video_title, self.current_download_folder))
-        thread.start()
 
-    def download_task(self, stream, title, download_folder): # <-- Add download_folder parameter
-        try:
-            # Pass the download_folder to the download function
-            file_path, file_name = download_selected_stream(stream, title, download_folder)
-            # self.download_path = file_path # Store path if needed later (optional)
-            self.root.after(0, lambda: messagebox.showinfo("Success", f"Downloaded '{file_name}' to '{download_folder}'")) # Use the actual folder path
-            self.root.after(0, lambda: self.update_status(f"Download complete: {file_name}"))
-            # You might add a button here to open the download_folder
-            # Example: self.root.after(0, lambda: os.startfile(download_folder)) # Windows only
-            # Example: self.root.after(0, lambda: subprocess.run(['open', download_folder])) # macOS
-            # Example: self.root.after(0, lambda: subprocess.run(['xdg-open', download_folder])) # Linux
-            # (Requires importing subprocess)
+def warm_up():
+    """Load the download backend and pre-warm the metadata client (blocking)"""
+    from commons import prewarm
+    from metrics import start_metrics_server
 
-        except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Download Error", f"Failed to download: {str(e)}"))
-            self.root.after(0, lambda: self.update_status(f"Download failed: {str(e)}", True))
-        finally:
-            # --- Re-enable UI elements on the main thread ---
-            def re_enable_ui():
-                self.download_button.config(state=tk.NORMAL if self.selected_stream else tk.DISABLED) # Re-enable based on selection state
-                self.show_formats_button.config(state=tk.NORMAL)
-                self.url_entry.config(state=tk.NORMAL)
-                self.select_folder_button.config(state=tk.NORMAL)
-                self.quality_combobox.config(state='readonly') # Set back to readonly
-                # Re-enable radio buttons if they exist
-                try:
-                    for widget in self.format_frame.winfo_children():
-                        if isinstance(widget, ttk.Radiobutton):
-                            widget.config(state=tk.NORMAL)
-                except tk.TclError:
-                    pass # Ignore if frame doesn't exist
-            self.root.after(0, re_enable_ui)
-            # --- End Re-enable UI elements ---
+    start_metrics_server() # only if YTDL_METRICS_PORT is set
+    prewarm()
 
 
 # --- Main Execution ---
-if __name__ == "__main__":
+def main():
     root = tk.Tk()
     app = DownloaderApp(root)
-    root.mainloop()
\ No newline at end of file
+    # Runs once the window has been drawn
+    root.after_idle(lambda: threading.Thread(target=warm_up, daemon=True).start())
+    root.mainloop()
+
+
+if __name__ == "__main__":
+    # Transcode workers are spawned processes; in a frozen (PyInstaller)
+    # build they start this executable again and must stop here
+    multiprocessing.freeze_support()
+    main()
\ No newline at end of file
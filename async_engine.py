@@ -0,0 +1,670 @@
+import asyncio
+import json
+import os
+import ssl
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urljoin, urlsplit
+
+from bandwidth import bandwidth
+from metrics import metrics
+from segmented import (
+    CHECKPOINT_INTERVAL,
+    DOWNLOAD_CONNECTIONS,
+    MAX_RETRIES,
+    MAX_THROTTLE_INTERVENTIONS,
+    READ_SIZE,
+    REQUEST_TIMEOUT,
+    THROTTLE_REFRESH_AFTER,
+    ConnectionThrottled,
+    DownloadCancelled,
+    DownloadControl,
+    RangeNotSupported,
+    SegmentScheduler,
+    StaleURL,
+    Throttled,
+    ThroughputWindow,
+)
+
+# Open connections allowed per host; further requests queue for a free one
+MAX_CONNECTIONS_PER_HOST = 32
+MAX_IDLE_PER_HOST = 16
+# Player endpoint used for metadata lookups that don't need pytubefix
+INNERTUBE_URL = os.environ.get("YTDL_INNERTUBE_URL", "https://www.youtube.com/youtubei/v1")
+# Client whose player responses carry plain (unsigned) stream URLs
+INNERTUBE_CLIENT = "ANDROID_VR"
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason, url):
+        super().__init__(f"HTTP {status} {reason} for {url}")
+        self.status = status
+
+
+class AsyncResponse:
+    """Body of one HTTP/1.1 response, read incrementally"""
+
+    def __init__(self, client, key, reader, writer, status, reason, headers, method):
+        self.client = client
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        length = headers.get('content-length')
+        if method == 'HEAD' or status in (204, 304):
+            length = '0'
+        self._remaining = int(length) if length is not None else None
+        self._chunk_left = 0
+        self._eof = self._remaining == 0
+        self._keep_alive = headers.get('connection', '').lower() != 'close' and (
+            self._chunked or self._remaining is not None)
+
+    async def read(self, n=READ_SIZE):
+        """Return up to n bytes of body, b'' at the end"""
+        if self._eof:
+            return b''
+        timeout = self.client.timeout
+        if self._chunked:
+            if self._chunk_left == 0:
+                line = await asyncio.wait_for(self.reader.readline(), timeout)
+                self._chunk_left = int(line.split(b';')[0].strip() or b'0', 16)
+                if self._chunk_left == 0:
+                    # Skip trailers up to the blank line
+                    while (await asyncio.wait_for(self.reader.readline(), timeout)) not in (b'\r\n', b''):
+                        pass
+                    self._eof = True
+                    return b''
+            data = await asyncio.wait_for(self.reader.read(min(n, self._chunk_left)), timeout)
+            if not data:
+                raise ConnectionError("Connection closed mid-chunk")
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await asyncio.wait_for(self.reader.readexactly(2), timeout)
+            return data
+
+        want = n if self._remaining is None else min(n, self._remaining)
+        data = await asyncio.wait_for(self.reader.read(want), timeout)
+        if self._remaining is not None:
+            if not data:
+                raise ConnectionError("Connection closed before end of body")
+            self._remaining -= len(data)
+            self._eof = self._remaining == 0
+        elif not data:
+            self._eof = True
+        return data
+
+    async def read_all(self):
+        parts = []
+        while True:
+            data = await self.read(1024 * 1024)
+            if not data:
+                break
+            parts.append(data)
+        self.release()
+        return b''.join(parts)
+
+    def release(self):
+        """Return the connection to the pool if the body was fully read"""
+        if self.writer is None:
+            return
+        if self._eof and self._keep_alive:
+            self.client._put(self.key, self.reader, self.writer)
+        else:
+            self.client._discard(self.key, self.writer)
+        self.writer = None
+
+
+class AsyncHTTPClient:
+    """Minimal keep-alive HTTP/1.1 client on asyncio streams.
+
+    One instance per event loop is shared by every metadata lookup and
+    download, so connections to YouTube and the media hosts are reused.
+    HTTPS connections verify certificates against certifi's CA bundle,
+    whatever pytubefix does with the process-wide default.
+    """
+
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, max_idle_per_host=MAX_IDLE_PER_HOST,
+                 timeout=REQUEST_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._slots = defaultdict(lambda: asyncio.Semaphore(self.max_per_host))
+        self._ssl_context = None
+
+    async def request(self, method, url, headers=None, body=None, max_redirects=5):
+        for _ in range(max_redirects + 1):
+            resp = await self._send(method, url, headers or {}, body)
+            if resp.status in (301, 302, 303, 307, 308) and 'location' in resp.headers:
+                await resp.read_all()
+                url = urljoin(url, resp.headers['location'])
+                if resp.status == 303:
+                    method, body = 'GET', None
+                continue
+            return resp
+        raise HTTPError(310, "Too many redirects", url)
+
+    async def get_json(self, url, headers=None):
+        resp = await self.request('GET', url, headers)
+        return self._json(resp, await resp.read_all(), url)
+
+    async def post_json(self, url, payload, headers=None):
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        resp = await self.request('POST', url, headers, json.dumps(payload).encode())
+        return self._json(resp, await resp.read_all(), url)
+
+    @staticmethod
+    def _json(resp, data, url):
+        if resp.status >= 400:
+            raise HTTPError(resp.status, resp.reason, url)
+        return json.loads(data)
+
+    async def connect(self, url):
+        """Open a connection to url's host and leave it idle for the next request"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        reader, writer = await self._get(key, reuse=True)
+        self._put(key, reader, writer)
+
+    async def close(self):
+        for conns in self._idle.values():
+            for _, writer in conns:
+                writer.close()
+        self._idle.clear()
+
+    async def _send(self, method, url, headers, body):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {parts.netloc}']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        if body is not None:
+            lines.append(f'Content-Length: {len(body)}')
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+
+        # A reused connection may have been closed by the server; retry once on a fresh one
+        for reuse in (True, False):
+            reader, writer = await self._get(key, reuse)
+            try:
+                writer.write(request)
+                await writer.drain()
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                self._discard(key, writer)
+                if reuse:
+                    continue
+                raise
+            break
+
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        _, status, reason = (status_line.split(' ', 2) + [''])[:3]
+        resp_headers = {}
+        for line in header_lines:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                resp_headers[name.strip().lower()] = value.strip()
+        return AsyncResponse(self, key, reader, writer, int(status), reason, resp_headers, method)
+
+    async def _get(self, key, reuse):
+        await self._slots[key].acquire()
+        idle = self._idle[key]
+        while reuse and idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        scheme, host, port = key
+        try:
+            context = self._tls_context() if scheme == 'https' else None
+            return await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=context, limit=2 ** 20), self.timeout)
+        except BaseException:
+            self._slots[key].release()
+            raise
+
+    def _tls_context(self):
+        if self._ssl_context is None:
+            import certifi
+
+            self._ssl_context = ssl.create_default_context(cafile=certifi.where())
+        return self._ssl_context
+
+    def _put(self, key, reader, writer):
+        self._slots[key].release()
+        if len(self._idle[key]) < self.max_idle_per_host:
+            self._idle[key].append((reader, writer))
+        else:
+            writer.close()
+
+    def _discard(self, key, writer):
+        self._slots[key].release()
+        writer.close()
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    """The shared AsyncHTTPClient for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncHTTPClient()
+    return client
+
+
+class AsyncEngine:
+    """Event loop on a daemon thread that runs coroutines for sync callers"""
+
+    def __init__(self):
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True)
+                self._thread.start()
+        return self
+
+    def run(self, coro):
+        """Run coro on the engine loop and block until it finishes"""
+        self.start()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Blocking call from inside the async engine; await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def submit(self, coro):
+        """Start coro on the engine loop without waiting; cancelling the returned
+        concurrent.futures.Future cancels the coroutine"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+engine = AsyncEngine()
+
+
+def run_sync(coro):
+    return engine.run(coro)
+
+
+def innertube_client(name=INNERTUBE_CLIENT):
+    """pytubefix's request settings for the InnerTube client `name`, or None
+    if the installed pytubefix doesn't have it (its client table is private
+    and changes between releases)"""
+    from pytubefix.innertube import _default_clients
+
+    config = _default_clients.get(name)
+    if config is None:
+        # Signed URLs name the client by clientName, which isn't always the table key
+        config = next((c for c in _default_clients.values()
+                       if c.get('innertube_context', {}).get('context', {}).get('client', {}).get('clientName') == name),
+                      None)
+    try:
+        config['innertube_context']['context']['client']['clientName']
+        config['header']['User-Agent']
+    except (KeyError, TypeError):
+        return None
+    return config
+
+
+# clientName -> headers for its media requests
+_media_headers = {}
+
+
+def media_headers(url):
+    """User-Agent and client headers of the InnerTube client a signed media URL
+    was issued to (its `c` parameter); {} for URLs that don't name one"""
+    name = parse_qs(urlsplit(url).query).get('c', [''])[0]
+    headers = _media_headers.get(name)
+    if headers is None:
+        config = innertube_client(name) if name else None
+        headers = {}
+        if config is not None:
+            headers = dict(config['header'])
+            version = config['innertube_context']['context']['client'].get('clientVersion')
+            if version:
+                headers['X-Youtube-Client-Version'] = version
+        _media_headers[name] = headers
+    return headers
+
+
+async def fetch_player(video_id, client=None):
+    """Raw InnerTube player response for video_id"""
+    config = innertube_client()
+    if config is None:
+        raise LookupError(f"pytubefix has no usable '{INNERTUBE_CLIENT}' client")
+    payload = dict(config['innertube_context'], videoId=video_id, contentCheckOk=True, racyCheckOk=True)
+    url = f"{INNERTUBE_URL}/player?{urlencode({'prettyPrint': 'false'})}"
+    return await (client or get_client()).post_json(url, payload, config['header'])
+
+
+def record_throttle(action, info, **fields):
+    """Count and log one reaction to a throttled download"""
+    metrics.count('throttle_interventions_total', action=action)
+    metrics.event('throttle', action=action, **info, **fields)
+
+
+async def fetch_range(client, stream, start, end, on_stale=None, max_retries=MAX_RETRIES, control=None,
+                      min_rate=None):
+    """Bytes [start, end) of stream.url, retrying with backoff.
+
+    A rejected URL calls `await on_stale(stream)`, which should refresh
+    stream.url, before the next attempt. Reads are paced by the bandwidth
+    scheduler as part of the download `control` belongs to. A connection
+    reading slower than min_rate bytes/sec is dropped and the rest of the
+    range requested again.
+    """
+    total = stream.filesize
+    for attempt in range(max_retries + 1):
+        try:
+            resp = await client.request('GET', stream.url, {**media_headers(stream.url),
+                                                            'Range': f'bytes={start}-{end - 1}',
+                                                            'Accept-Encoding': 'identity'})
+            if resp.status in (403, 404, 410):
+                resp.release()
+                raise StaleURL(f"HTTP {resp.status} {resp.reason}")
+            if resp.status != 206 and not (resp.status == 200 and start == 0 and end == total):
+                resp.release()
+                raise HTTPError(resp.status, resp.reason, stream.url)
+            parts = []
+            window = ThroughputWindow()
+            try:
+                while True:
+                    chunk = await resp.read()
+                    if not chunk:
+                        break
+                    parts.append(chunk)
+                    waited = time.monotonic()
+                    await bandwidth.consume(control, len(chunk))
+                    rate = window.add(len(chunk), time.monotonic() - waited)
+                    if min_rate and rate is not None and rate < min_rate and attempt < max_retries:
+                        raise ConnectionThrottled(rate, min_rate)
+            finally:
+                resp.release()
+            data = b''.join(parts)
+            if len(data) != end - start:
+                raise ConnectionError(f"Expected {end - start} bytes, got {len(data)}")
+            return data
+        except ConnectionThrottled as e:
+            # Keep what arrived and ask for the rest on a new connection
+            record_throttle('reconnect', {'video_id': getattr(stream, 'video_id', None), 'itag': stream.itag},
+                            rate=round(e.rate), threshold=round(e.threshold), pos=start)
+            got = b''.join(parts)
+            rest = await fetch_range(client, stream, start + len(got), end, on_stale, max_retries - attempt - 1,
+                                     control, min_rate)
+            return got + rest
+        except StaleURL:
+            if on_stale is None or attempt == max_retries:
+                raise
+            await on_stale(stream)
+        except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError):
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(min(2 ** attempt * 0.25, 8))
+
+
+async def ordered_chunks(stream, chunk_size=4 * 1024 * 1024, lookahead=3, on_stale=None, client=None,
+                         control=None, min_rate=None, start=0):
+    """Yield stream's bytes from `start` in order while fetching up to
+    `lookahead` chunks ahead over separate connections. Memory stays
+    bounded by lookahead * chunk_size, which suits consumers that need a
+    sequential feed, like an ffmpeg pipe."""
+    client = client or get_client()
+    pending = deque()
+    offset = start
+    try:
+        while offset < stream.filesize or pending:
+            while offset < stream.filesize and len(pending) < lookahead:
+                end = min(offset + chunk_size, stream.filesize)
+                pending.append(asyncio.ensure_future(fetch_range(client, stream, offset, end, on_stale,
+                                                                  control=control, min_rate=min_rate)))
+                offset = end
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class _PendingWrite:
+    def __init__(self, future, data):
+        self.future = future
+        self.data = data
+        self.n = len(data)
+
+
+class AsyncSegmentedDownloader:
+    """Download `url` into `path` over concurrent ranged requests.
+
+    The output file is preallocated and each worker task writes its ranges
+    at their own offsets. Ranges come from a SegmentScheduler, so idle
+    tasks steal from slow ones. Writes, `on_write(offset, chunk)` and
+    `on_checkpoint(completed_ranges)` (every CHECKPOINT_INTERVAL seconds and
+    when run() ends) run in order on a writer thread of the download's own,
+    keeping disk I/O and hashing off the event loop that metadata lookups
+    share; `on_progress(chunk, bytes_remaining)` follows each write on the
+    loop. `control` (a
+    DownloadControl) pauses or cancels the download from any thread and
+    sets its priority and rate limit with the bandwidth scheduler.
+
+    With `min_rate` (bytes/sec), a connection that reads slower than that
+    over a THROTTLE_WINDOW is dropped and its range handed back, and the
+    largest segment is halved, since long ranges are the ones that get
+    throttled. After THROTTLE_REFRESH_AFTER such connections in a row,
+    run() raises Throttled so the caller can re-resolve the URL. Each of
+    these is recorded as a 'throttle' event with `info` added to it.
+    """
+
+    def __init__(self, url, total_size, path, connections=DOWNLOAD_CONNECTIONS,
+                 on_progress=None, client=None, max_retries=MAX_RETRIES, scheduler=None,
+                 on_checkpoint=None, control=None, min_rate=None, info=None, on_write=None):
+        self.url = url
+        self.total_size = total_size
+        self.path = path
+        self.connections = max(1, connections)
+        self.on_progress = on_progress
+        self.client = client
+        self.max_retries = max_retries
+        self.scheduler = scheduler or SegmentScheduler(total_size, connections=self.connections)
+        self.on_checkpoint = on_checkpoint
+        self.on_write = on_write
+        self.control = control or DownloadControl()
+        # Set when the workers should stop: fatal error or user cancel
+        self._stop = threading.Event()
+        self._bytes_remaining = total_size - self.scheduler.bytes_done
+        self._last_checkpoint = time.monotonic()
+        self._error = None
+        self.min_rate = min_rate
+        self.info = info or {}
+        self.interventions = 0
+        self._throttle_streak = 0
+        self._writer = None  # single-thread executor, for the length of run()
+        self._file = None
+
+    def cancel(self):
+        self.control.cancel()
+
+    def _stopped(self):
+        return self._stop.is_set() or self.control.cancelled.is_set()
+
+    async def run(self):
+        """Fetch all missing ranges. Can be awaited again after a failure."""
+        self.client = self.client or get_client()
+        self._error = None
+        self._stop.clear()
+        self._throttle_streak = 0
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='segment-writer')
+        try:
+            await self._io(self._open)
+            try:
+                await asyncio.gather(*(self._worker() for _ in range(self.connections)))
+            finally:
+                if self.on_checkpoint is not None:
+                    await self._io(self.on_checkpoint, self.scheduler.completed_ranges())
+        finally:
+            if self._file is not None:
+                await self._io(self._file.close)
+                self._file = None
+            self._writer.shutdown(wait=False)
+
+        if self._error is not None:
+            raise self._error
+        if self.control.cancelled.is_set():
+            raise DownloadCancelled()
+        return self.path
+
+    def _io(self, fn, *args):
+        """Run fn on the writer thread, after everything queued before it"""
+        return asyncio.get_running_loop().run_in_executor(self._writer, fn, *args)
+
+    def _open(self):
+        mode = 'r+b' if self.scheduler.done and os.path.exists(self.path) else 'wb'
+        # Unbuffered, so whatever a checkpoint records has reached the OS
+        self._file = open(self.path, mode, buffering=0)
+        self._file.truncate(self.total_size)
+
+    def _write(self, offset, data):
+        self._file.seek(offset)
+        self._file.write(data)
+        if self.on_write is not None:
+            self.on_write(offset, data)
+
+    async def _worker(self):
+        rate = 0.0
+        failures = 0
+        while not self._stopped():
+            if self.control.paused:
+                # Hold no connection while paused
+                while self.control.paused and not self._stopped():
+                    await asyncio.sleep(0.2)
+                continue
+            seg = self.scheduler.claim(rate)
+            if seg is None:
+                return
+            try:
+                rate = await self._fetch(seg) or rate
+                if seg.remaining > 0:
+                    # Paused or stopped mid-segment; hand the rest back
+                    self.scheduler.release(seg)
+                else:
+                    self.scheduler.finish(seg)
+                failures = 0
+            except ConnectionThrottled as e:
+                self.scheduler.release(seg)
+                rate = 0.0
+                self._throttled(e)
+            except Exception as e:
+                self.scheduler.release(seg)
+                failures += 1
+                if isinstance(e, (RangeNotSupported, StaleURL)) or failures > self.max_retries:
+                    self._error = self._error or e
+                    self._stop.set()
+                    return
+                metrics.count('retries_total', kind='segment')
+                await asyncio.sleep(min(2 ** failures * 0.25, 8))
+
+    async def _fetch(self, seg):
+        """Fetch one segment; returns the measured rate in bytes/sec"""
+        # Signed URLs are issued to one client; fetch them as that client
+        headers = {**media_headers(self.url), 'Range': f'bytes={seg.pos}-{seg.end - 1}',
+                   'Accept-Encoding': 'identity'}
+        resp = await self.client.request('GET', self.url, headers)
+        # The previous chunk's write stays in flight while the next one is read
+        pending = None
+        try:
+            if resp.status == 200 and seg.pos == 0 and seg.end == self.total_size:
+                pass  # whole-file answer to a whole-file range is fine
+            elif resp.status == 200:
+                raise RangeNotSupported(f"HTTP {resp.status} for ranged request")
+            elif resp.status in (403, 404, 410):
+                raise StaleURL(f"HTTP {resp.status} {resp.reason}")
+            elif resp.status != 206:
+                raise HTTPError(resp.status, resp.reason, self.url)
+
+            started = time.monotonic()
+            window = ThroughputWindow()
+            ahead = 0  # bytes of the pending write
+            while seg.pos + ahead < seg.end and not self._stopped() and not self.control.paused:
+                chunk = await resp.read(min(READ_SIZE, seg.end - seg.pos - ahead))
+                if not chunk:
+                    raise ConnectionError("Response ended before the segment did")
+                keep = self.scheduler.writable(seg, len(chunk), ahead)
+                previous, pending, ahead = pending, None, 0
+                if previous:
+                    await self._written(seg, previous)
+                if keep:
+                    pending = _PendingWrite(self._io(self._write, seg.pos, chunk[:keep]), chunk[:keep])
+                    ahead = keep
+                waited = time.monotonic()
+                await bandwidth.consume(self.control, len(chunk))
+                self._check_rate(window.add(len(chunk), time.monotonic() - waited))
+                elapsed = time.monotonic() - started
+                if elapsed > 0:
+                    seg.rate = (seg.pos - seg.start) / elapsed
+            return seg.rate
+        finally:
+            if pending:
+                # Bytes handed to the writer count even when the segment fails
+                await self._written(seg, pending)
+            # Drained responses go back to the pool; stolen or cancelled ones are closed
+            resp.release()
+
+    async def _written(self, seg, pending):
+        """Wait for a chunk's write, then count it; advancing only after the write
+        means checkpoints never cover unwritten bytes"""
+        await pending.future
+        self.scheduler.advance(seg, pending.n)
+        self._report(pending.data)
+
+    def _check_rate(self, rate):
+        if rate is None or not self.min_rate:
+            return
+        if rate >= self.min_rate:
+            self._throttle_streak = 0
+        elif self.interventions < MAX_THROTTLE_INTERVENTIONS:
+            raise ConnectionThrottled(rate, self.min_rate)
+
+    def _throttled(self, e):
+        """React to one throttled connection: reconnect, smaller ranges, then a new URL"""
+        if self._stopped():
+            return  # already escalated by another connection
+        self.interventions += 1
+        self._throttle_streak += 1
+        fields = dict(self.info, rate=round(e.rate), threshold=round(e.threshold))
+        if self._throttle_streak >= THROTTLE_REFRESH_AFTER:
+            record_throttle('refresh', fields)
+            self._error = self._error or Throttled(str(e))
+            self._stop.set()
+        else:
+            scheduler = self.scheduler
+            with scheduler.lock:
+                scheduler.max_segment = max(scheduler.min_segment, scheduler.max_segment // 2)
+            record_throttle('reconnect', fields, max_segment=scheduler.max_segment)
+        if self.interventions == MAX_THROTTLE_INTERVENTIONS:
+            # From here on the download takes whatever rate it gets
+            record_throttle('give_up', fields)
+
+    def _report(self, chunk):
+        self._bytes_remaining -= len(chunk)
+        if self.on_progress is not None:
+            self.on_progress(chunk, self._bytes_remaining)
+        self._checkpoint()
+
+    def _checkpoint(self):
+        if self.on_checkpoint is None:
+            return
+        now = time.monotonic()
+        if now - self._last_checkpoint < CHECKPOINT_INTERVAL:
+            return
+        self._last_checkpoint = now
+        # Queued behind the writes it covers; run() waits for the final one
+        self._writer.submit(self.on_checkpoint, self.scheduler.completed_ranges())
@@ -0,0 +1,163 @@
+"""Bandwidth scheduling shared by every download in the process.
+
+    bandwidth.set_rate(parse_rate("20M"))    # global cap in bytes/sec, None to lift it
+    control = DownloadControl(priority=BATCH, rate_limit=2 * 1024 * 1024)
+    ...
+    await bandwidth.consume(control, len(chunk))   # after every read
+
+Each control's rate_limit is its own token bucket. Under a global cap,
+interactive downloads are served first and batch downloads get what is
+left; within a class, downloads (not connections) take turns, so a job
+with eight connections gets the same share as a job with one. The cap,
+a control's rate_limit and its priority can all be changed from any
+thread while downloads run. Without a global cap (YTDL_BANDWIDTH_LIMIT)
+only per-download limits apply; set it a little below the link speed so
+the scheduler, rather than the network, decides who waits.
+"""
+import asyncio
+import os
+import re
+import time
+import weakref
+from collections import deque
+
+from metrics import metrics
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+# Highest priority first
+PRIORITIES = (INTERACTIVE, BATCH)
+# Tokens a bucket may save up while idle, in seconds of its rate. Small,
+# so a batch burst never sits between an interactive download and the link
+BURST_SECONDS = 0.25
+# How often waiting downloads pick up limits changed from other threads
+RECHECK_SECONDS = 0.1
+RATE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*([kmg]?)i?b?(?:/s)?$', re.IGNORECASE)
+RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(value):
+    """Bytes/sec from "20M", "500k" or "1048576"; None (no limit) for empty or 0"""
+    if value is None or isinstance(value, (int, float)):
+        return value if value and value > 0 else None
+    if not isinstance(value, str):
+        raise ValueError(f"Can't parse rate {value!r}")
+    if not value.strip():
+        return None
+    match = RATE_PATTERN.match(value.strip())
+    if not match:
+        raise ValueError(f"Can't parse rate '{value}' (use e.g. 500k, 20M)")
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).lower()]) or None
+
+
+class TokenBucket:
+    """Bytes allowed through at `rate`, with a burst of BURST_SECONDS"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate * BURST_SECONDS
+        self.updated = time.monotonic()
+
+    def refill(self, rate):
+        now = time.monotonic()
+        if rate != self.rate:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * BURST_SECONDS)
+        self.tokens = min(self.tokens + (now - self.updated) * rate, rate * BURST_SECONDS)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until the bucket is out of debt"""
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthScheduler:
+    """Token buckets per download and for the whole process.
+
+    Runs on the event loop the downloads run on (the async engine's);
+    set_rate and the controls' attributes may be changed from any thread.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._global = TokenBucket(rate or 1)
+        self._jobs = weakref.WeakKeyDictionary()  # control -> TokenBucket for its rate_limit
+        self._queues = {priority: {} for priority in PRIORITIES}  # job -> deque of (n, future)
+        self._dispatcher = None
+        self._loop = None
+
+    def set_rate(self, rate):
+        """Change the global cap (bytes/sec, None for none); takes effect within RECHECK_SECONDS"""
+        self.rate = rate or None
+
+    async def consume(self, control, n):
+        """Wait until n more bytes may be read for the download `control` belongs to"""
+        waited = time.monotonic()
+        if control is not None and control.rate_limit:
+            await self._take_job(control, n)
+        if self.rate:
+            await self._take_global(control, n)
+        waited = time.monotonic() - waited
+        if waited > 0.001:
+            metrics.count('bandwidth_wait_seconds_total', round(waited, 3),
+                          priority=getattr(control, 'priority', INTERACTIVE))
+
+    async def _take_job(self, control, n):
+        bucket = self._jobs.get(control)
+        if bucket is None:
+            bucket = self._jobs[control] = TokenBucket(control.rate_limit)
+        bucket.refill(control.rate_limit)
+        # Every connection of the download adds its bytes to the debt and
+        # waits for it to be paid off at whatever the limit is by then
+        bucket.tokens -= n
+        while bucket.tokens < 0 and control.rate_limit and not control.cancelled.is_set():
+            await asyncio.sleep(min(bucket.delay(), RECHECK_SECONDS))
+            bucket.refill(control.rate_limit or bucket.rate)
+
+    async def _take_global(self, control, n):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._queues = {priority: {} for priority in PRIORITIES}
+            self._dispatcher = None
+        future = loop.create_future()
+        priority = getattr(control, 'priority', INTERACTIVE)
+        queue = self._queues[priority if priority in self._queues else INTERACTIVE]
+        # Anonymous reads count as a download of their own
+        queue.setdefault(control if control is not None else future, deque()).append((n, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    def _next(self):
+        """The next request to grant: by priority, then round-robin over downloads"""
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue:
+                job = next(iter(queue))
+                requests = queue.pop(job)
+                n, future = requests.popleft()
+                if requests:
+                    queue[job] = requests  # back of the line
+                if not future.done():
+                    return n, future
+        return 0, None
+
+    async def _dispatch(self):
+        bucket = self._global
+        while any(self._queues.values()):
+            rate = self.rate
+            if rate:
+                bucket.refill(rate)
+                if bucket.tokens < 0:
+                    await asyncio.sleep(min(bucket.delay(), RECHECK_SECONDS))
+                    continue
+            n, future = self._next()
+            if future is not None:
+                future.set_result(None)
+                if rate:
+                    bucket.tokens -= n
+
+
+# Shared by every download in this process
+bandwidth = BandwidthScheduler(parse_rate(os.environ.get("YTDL_BANDWIDTH_LIMIT")))
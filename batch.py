@@ -0,0 +1,279 @@
+"""Headless batch downloader.
+
+Reads URLs (or playlist URLs) from a file, resolves their formats
+concurrently and downloads them through a bounded worker pool.
+
+    python batch.py urls.txt -o youtube_downloads --format "best ae_compatible <=1080p"
+
+Each input line is a URL optionally followed by a per-job format rule:
+
+    https://youtu.be/dQw4w9WgXcQ   best audio
+    https://www.youtube.com/playlist?list=PL...
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+from commons import (
+    get_available_streams,
+    download_selected_stream,
+    select_stream,
+    parse_format_rule,
+)
+from bandwidth import BATCH, bandwidth, parse_rate
+from metrics import METRICS_PORT, start_metrics_server
+from segmented import DownloadControl
+
+DEFAULT_RULE = "best progressive"
+DOWNLOAD_WORKERS = 4
+RESOLVE_WORKERS = 8
+PER_HOST_DOWNLOADS = 2
+# Connections per download; batch jobs already run side by side
+BATCH_CONNECTIONS = 2
+
+
+class BatchJob:
+    def __init__(self, url, rule):
+        self.url = url
+        self.rule = rule
+        self.title = None
+        self.stream = None
+        self.status = 'queued'
+        self.error = None
+        self.file_path = None
+        self.bytes = 0
+        self.resolve_seconds = 0.0
+        self.download_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'rule': self.rule,
+            'title': self.title,
+            'itag': self.stream.itag if self.stream else None,
+            'status': self.status,
+            'error': self.error,
+            'file': self.file_path,
+            'bytes': self.bytes,
+            'resolve_seconds': round(self.resolve_seconds, 3),
+            'download_seconds': round(self.download_seconds, 3),
+        }
+
+
+class HostQueue:
+    """Resolved jobs queued per media host, handed out only while their host
+    is below `per_host` concurrent downloads.
+
+    A worker never waits on a busy host: get() skips to the next host with
+    a free slot, so a run of same-host jobs can't hold up the others.
+    """
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self._queues = OrderedDict()  # host -> deque of jobs
+        self._active = defaultdict(int)
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def host(job):
+        return urlsplit(job.stream.url).hostname or ''
+
+    def put(self, job):
+        with self._cond:
+            self._queues.setdefault(self.host(job), deque()).append(job)
+            self._cond.notify()
+
+    def close(self):
+        """No more jobs; get() returns None once the queues are empty"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get(self):
+        """The next job whose host has a free slot (blocks), or None when all are handed out"""
+        with self._cond:
+            while True:
+                for host, jobs in self._queues.items():
+                    if jobs and self._active[host] < self.per_host:
+                        self._active[host] += 1
+                        self._queues.move_to_end(host)  # take turns between hosts
+                        return jobs.popleft()
+                if self._closed and not any(self._queues.values()):
+                    return None
+                self._cond.wait()
+
+    def done(self, job):
+        """Free job's host slot"""
+        with self._cond:
+            self._active[self.host(job)] -= 1
+            self._cond.notify_all()
+
+
+def read_jobs(lines, default_rule=DEFAULT_RULE):
+    """Parse lines of a URL list into (url, rule) pairs"""
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        url, _, rule = line.partition(' ')
+        rule = rule.strip() or default_rule
+        parse_format_rule(rule)  # fail fast on typos
+        jobs.append((url, rule))
+    return jobs
+
+
+def expand_playlists(jobs):
+    """Replace playlist URLs with one job per video"""
+    expanded = []
+    for url, rule in jobs:
+        if 'list=' in url and 'v=' not in url:
+            from pytubefix import Playlist
+            try:
+                expanded.extend((video_url, rule) for video_url in Playlist(url).video_urls)
+            except Exception as e:
+                print(f"Warning: could not expand playlist {url}: {e}", file=sys.stderr)
+                expanded.append((url, rule))
+        else:
+            expanded.append((url, rule))
+    return expanded
+
+
+class BatchRunner:
+    """Resolves jobs on one pool and feeds a bounded download pool through per-host queues"""
+
+    def __init__(self, download_dir, workers=DOWNLOAD_WORKERS, resolve_workers=RESOLVE_WORKERS,
+                 per_host=PER_HOST_DOWNLOADS, connections=BATCH_CONNECTIONS, rate_limit=None,
+                 priority=BATCH, log=print):
+        self.download_dir = download_dir
+        self.rate_limit = rate_limit
+        self.priority = priority
+        self.workers = workers
+        self.resolve_workers = resolve_workers
+        self.connections = connections
+        self.per_host = per_host
+        self.log = log
+
+    def run(self, jobs):
+        started = time.time()
+        ready = HostQueue(self.per_host)
+        downloaders = [threading.Thread(target=self._download_worker, args=(ready,), daemon=True)
+                       for _ in range(self.workers)]
+        for t in downloaders:
+            t.start()
+
+        # Hand each job to the downloaders as soon as its formats are known
+        with ThreadPoolExecutor(max_workers=self.resolve_workers) as pool:
+            for future in as_completed([pool.submit(self._resolve, job) for job in jobs]):
+                job = future.result()
+                if job.status == 'resolved':
+                    ready.put(job)
+
+        ready.close()
+        for t in downloaders:
+            t.join()
+        return self.summary(jobs, time.time() - started)
+
+    def _resolve(self, job):
+        start = time.time()
+        try:
+            streams, job.title = get_available_streams(job.url)
+            job.stream = select_stream(streams, job.rule)
+            if job.stream is None:
+                raise Exception(f"No stream matching '{job.rule}'")
+            job.status = 'resolved'
+        except Exception as e:
+            job.status, job.error = 'failed', f"resolve: {e}"
+            self.log(f"FAILED {job.url}: {job.error}")
+        job.resolve_seconds = time.time() - start
+        return job
+
+    def _download_worker(self, ready):
+        while True:
+            job = ready.get()
+            if job is None:
+                return
+            start = time.time()
+            try:
+                job.status = 'downloading'
+                try:
+                    job.file_path, _ = download_selected_stream(
+                        job.stream, job.title, self.download_dir, connections=self.connections,
+                        control=DownloadControl(self.priority, self.rate_limit))
+                finally:
+                    ready.done(job)
+                job.bytes = os.path.getsize(job.file_path)
+                job.status = 'done'
+                self.log(f"OK     {job.title} ({job.bytes} bytes)")
+            except Exception as e:
+                job.status, job.error = 'failed', f"download: {e}"
+                self.log(f"FAILED {job.url}: {job.error}")
+            job.download_seconds = time.time() - start
+
+    @staticmethod
+    def summary(jobs, elapsed):
+        done = [j for j in jobs if j.status == 'done']
+        total_bytes = sum(j.bytes for j in done)
+        return {
+            'jobs': len(jobs),
+            'succeeded': len(done),
+            'failed': len(jobs) - len(done),
+            'bytes': total_bytes,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_bytes_per_second': round(total_bytes / elapsed, 1) if elapsed else 0.0,
+            'failures': [{'url': j.url, 'error': j.error} for j in jobs if j.status != 'done'],
+            'results': [j.to_dict() for j in jobs],
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download many YouTube videos without the GUI.")
+    parser.add_argument('input', help="File with one URL (and optional format rule) per line, or '-' for stdin")
+    parser.add_argument('-o', '--output', default="youtube_downloads", help="Download folder")
+    parser.add_argument('-f', '--format', default=DEFAULT_RULE,
+                        help='Default format rule, e.g. "best ae_compatible <=1080p"')
+    parser.add_argument('-w', '--workers', type=int, default=DOWNLOAD_WORKERS, help="Parallel downloads")
+    parser.add_argument('--resolve-workers', type=int, default=RESOLVE_WORKERS, help="Parallel format lookups")
+    parser.add_argument('--per-host', type=int, default=PER_HOST_DOWNLOADS, help="Max parallel downloads per media host")
+    parser.add_argument('--connections', type=int, default=BATCH_CONNECTIONS, help="Connections per download")
+    parser.add_argument('--limit-rate', type=parse_rate, help="Total bandwidth cap for this process, e.g. 20M")
+    parser.add_argument('--job-rate', type=parse_rate, help="Bandwidth cap per download, e.g. 2M")
+    parser.add_argument('--summary', help="Write the JSON summary here (default: stdout)")
+    parser.add_argument('--metrics-port', default=METRICS_PORT, help="Serve Prometheus metrics on this port")
+    args = parser.parse_args(argv)
+
+    parse_format_rule(args.format)
+    start_metrics_server(args.metrics_port)
+    if args.limit_rate:
+        bandwidth.set_rate(args.limit_rate)
+    if args.input == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.input, 'r') as f:
+            lines = f.readlines()
+    jobs = [BatchJob(url, rule) for url, rule in expand_playlists(read_jobs(lines, args.format))]
+    os.makedirs(args.output, exist_ok=True)
+
+    runner = BatchRunner(args.output, workers=args.workers, resolve_workers=args.resolve_workers,
+                         per_host=args.per_host, connections=args.connections, rate_limit=args.job_rate,
+                         log=lambda msg: print(msg, file=sys.stderr))
+    summary = runner.run(jobs)
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""Peak RSS of the Streamlit server process for N concurrent downloads.
+
+Compares the old delivery path (each session keeps the whole file in
+memory, as `st.session_state.file_data` did) with streaming from disk
+through file_server.FileServer. Each mode runs in a fresh child process so
+the peak RSS numbers do not bleed into each other. POSIX only (uses the
+resource module).
+
+    python benchmarks/bench_delivery_memory.py --sessions 8 --size-mb 256
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_inline(path, sessions, result):
+    session_state = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(sessions)
+
+    def session():
+        data = open(path, 'rb').read()
+        with lock:
+            session_state.append(data)
+        # Hold the bytes until every session has loaded its copy
+        barrier.wait()
+
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result.put({'mode': 'inline', 'peak_rss_mb': round(peak_rss_mb(), 1)})
+
+
+def run_stream(path, sessions, result):
+    from file_server import FileServer
+
+    server = FileServer(host='127.0.0.1', port=0).start()
+    tokens = [server.register(path, f'session{i}.mp4') for i in range(sessions)]
+    # Clients run in a separate process so their buffers are not counted
+    client = multiprocessing.Process(target=fetch_all, args=([server.url_for(t) for t in tokens],))
+    client.start()
+    client.join()
+    server.stop()
+    result.put({'mode': 'stream', 'peak_rss_mb': round(peak_rss_mb(), 1)})
+
+
+def fetch_all(urls):
+    def fetch(url):
+        with urllib.request.urlopen(url) as resp:
+            while resp.read(1024 * 1024):
+                pass
+
+    threads = [threading.Thread(target=fetch, args=(u,)) for u in urls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def measure(target, path, sessions):
+    result = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=target, args=(path, sessions, result))
+    proc.start()
+    row = result.get()
+    proc.join()
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--size-mb', type=int, default=128)
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'video.mp4')
+        with open(path, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        rows = []
+        print(f"{'sessions':>8} {'inline MB':>10} {'stream MB':>10}")
+        for n in args.sessions:
+            inline = measure(run_inline, path, n)
+            stream = measure(run_stream, path, n)
+            rows.append({'sessions': n, 'size_mb': args.size_mb,
+                         'inline_peak_rss_mb': inline['peak_rss_mb'],
+                         'stream_peak_rss_mb': stream['peak_rss_mb']})
+            print(f"{n:>8} {inline['peak_rss_mb']:>10} {stream['peak_rss_mb']:>10}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
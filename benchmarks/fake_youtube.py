@@ -0,0 +1,252 @@
+"""Local stand-in for the parts of YouTube the downloader talks to.
+
+Serves InnerTube player responses and Range-capable media, with knobs for
+latency, a global bandwidth cap, per-connection throttling, YouTube-style
+throttling of a random share of media requests and servers that ignore Range:
+
+    backend = FakeYouTube(latency=0.05, per_connection_bps=2_000_000).start()
+    os.environ['YTDL_INNERTUBE_URL'] = backend.innertube_url  # before importing commons
+    streams, title = get_available_streams(backend.watch_url('aaaaaaaaaaa'))
+
+Media bytes are generated from the itag, so any range can be served (and
+checked with media_bytes) without keeping whole files in memory; each file
+starts with just enough MP4/WebM header to pass the downloader's container check.
+"""
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+BLOCK_SIZE = 1024 * 1024
+SEND_SIZE = 64 * 1024
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+URL_LIFETIME = 6 * 3600
+# Playback length the fake formats' bitrates are derived from
+DURATION_SECONDS = 600
+
+# itag -> (mimeType, contentLength as a fraction of the video size, extra fields)
+FORMATS = {
+    18: ('video/mp4; codecs="avc1.42001E, mp4a.40.2"', 0.25, {'qualityLabel': '360p'}),
+    137: ('video/mp4; codecs="avc1.640028"', 1.0, {'fps': 30}),
+    248: ('video/webm; codecs="vp9"', 0.8, {'fps': 30}),
+    136: ('video/mp4; codecs="avc1.4d401f"', 0.5, {'fps': 30}),
+    140: ('audio/mp4; codecs="mp4a.40.2"', 0.06, {}),
+    251: ('audio/webm; codecs="opus"', 0.07, {}),
+}
+PROGRESSIVE_ITAGS = (18,)
+
+
+def _block(itag):
+    return random.Random(itag).randbytes(BLOCK_SIZE)
+
+
+def _header(itag, size):
+    """Container headers that make a file of `size` bytes pass check_container()"""
+    if 'webm' in FORMATS[itag][0]:
+        # EBML header (DocType webm), then a Segment running to the end of the file
+        return (b'\x1a\x45\xdf\xa3\x87\x42\x82\x84webm' + b'\x18\x53\x80\x67'
+                + b'\x01' + (size - 24).to_bytes(7, 'big'))
+    # ftyp, an empty moov, then an mdat (64-bit size) holding the rest
+    return (struct.pack('>I4s4sI4s4s', 24, b'ftyp', b'isom', 0x200, b'isom', b'mp41')
+            + struct.pack('>I4s', 8, b'moov') + struct.pack('>I4sQ', 1, b'mdat', size - 32))
+
+
+def media_bytes(itag, start, end, size, _blocks={}):
+    """Bytes [start, end) of the fake media for itag, a file of `size` bytes"""
+    block = _blocks.get(itag)
+    if block is None:
+        block = _blocks[itag] = _block(itag)
+    out = bytearray()
+    pos = start
+    while pos < end:
+        offset = pos % BLOCK_SIZE
+        take = min(BLOCK_SIZE - offset, end - pos)
+        out += block[offset:offset + take]
+        pos += take
+    header = _header(itag, size)
+    if start < len(header):
+        n = min(len(header), end) - start
+        out[:n] = header[start:start + n]
+    return bytes(out)
+
+
+class TokenBucket:
+    """Blocking rate limiter shared by whoever holds it"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default of 5 drops bursts of concurrent connects
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections is normal here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeYouTube:
+    def __init__(self, video_size=32 * 1024 * 1024, latency=0.0, bandwidth_bps=None,
+                 per_connection_bps=None, throttled_fraction=0.0, throttled_bps=48 * 1024,
+                 ranges=True, host='127.0.0.1', port=0):
+        self.video_size = video_size
+        # Off, media requests ignore Range and always get the whole file
+        self.ranges = ranges
+        self.latency = latency
+        self.per_connection_bps = per_connection_bps
+        self.bandwidth = TokenBucket(bandwidth_bps) if bandwidth_bps else None
+        # This share of media requests is served at throttled_bps
+        self.throttled_fraction = throttled_fraction
+        self.throttled_bps = throttled_bps
+        self._random = random.Random(0)
+        self.requests = {'player': 0, 'media': 0, 'throttled': 0}
+        self._lock = threading.Lock()
+        self._server = QuietServer((host, port), self._handler())
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def innertube_url(self):
+        return f"{self.base_url}/youtubei/v1"
+
+    @staticmethod
+    def watch_url(video_id):
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def filesize(self, itag):
+        return int(self.video_size * FORMATS[itag][1])
+
+    def player(self, video_id):
+        expire = int(time.time()) + URL_LIFETIME
+        formats, adaptive = [], []
+        for itag, (mime, _, extra) in FORMATS.items():
+            fmt = dict(extra, itag=itag, mimeType=mime, contentLength=str(self.filesize(itag)),
+                       averageBitrate=self.filesize(itag) * 8 // DURATION_SECONDS,
+                       url=f"{self.base_url}/media/{video_id}/{itag}?expire={expire}")
+            (formats if itag in PROGRESSIVE_ITAGS else adaptive).append(fmt)
+        return {
+            'playabilityStatus': {'status': 'OK'},
+            'videoDetails': {'videoId': video_id, 'title': f"Fake video {video_id}"},
+            'streamingData': {'formats': formats, 'adaptiveFormats': adaptive},
+        }
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def _connection_rate(self):
+        with self._lock:
+            throttled = self._random.random() < self.throttled_fraction
+            if throttled:
+                self.requests['throttled'] += 1
+        return self.throttled_bps if throttled else self.per_connection_bps
+
+    def _handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if urlsplit(self.path).path.rstrip('/') != '/youtubei/v1/player':
+                    self._reply(404, b'')
+                    return
+                backend._count('player')
+                time.sleep(backend.latency)
+                self._reply(200, json.dumps(backend.player(body.get('videoId', ''))).encode(), 'application/json')
+
+            def do_HEAD(self):
+                self.do_GET(send_body=False)
+
+            def do_GET(self, send_body=True):
+                parts = urlsplit(self.path)
+                match = re.fullmatch(r'/media/([\w-]+)/(\d+)', parts.path)
+                if not match or int(match.group(2)) not in FORMATS:
+                    self._reply(404, b'')
+                    return
+                if int(parse_qs(parts.query).get('expire', ['0'])[0]) < time.time():
+                    self._reply(403, b'')
+                    return
+                backend._count('media')
+                itag = int(match.group(2))
+                size = backend.filesize(itag)
+                start, end, status = 0, size, 200
+                range_match = backend.ranges and RANGE_PATTERN.match(self.headers.get('Range', ''))
+                if range_match:
+                    first, last = range_match.groups()
+                    start = int(first) if first else max(size - int(last), 0)
+                    end = min(int(last) + 1, size) if first and last else size
+                    status = 206
+                time.sleep(backend.latency)
+                self.send_response(status)
+                self.send_header('Content-Type', FORMATS[itag][0].split(';')[0])
+                self.send_header('Content-Length', str(end - start))
+                if backend.ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                if status == 206:
+                    self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+                self.end_headers()
+                if send_body:
+                    self._send_media(itag, start, end, size)
+
+            def _send_media(self, itag, start, end, size):
+                rate = backend._connection_rate()
+                connection = TokenBucket(rate) if rate else None
+                pos = start
+                try:
+                    while pos < end:
+                        n = min(SEND_SIZE, end - pos)
+                        if connection:
+                            connection.take(n)
+                        if backend.bandwidth:
+                            backend.bandwidth.take(n)
+                        self.wfile.write(media_bytes(itag, pos, pos + n, size))
+                        pos += n
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _reply(self, status, body, content_type='text/plain'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,388 @@
+"""Offline benchmark suite against a local fake YouTube backend.
+
+Every scenario runs in a fresh child process (so peak RSS and CPU are its
+own) with YTDL_INNERTUBE_URL pointing at benchmarks/fake_youtube.py, and
+reports metadata latency, download throughput, peak RSS and CPU time.
+POSIX only (uses the resource module).
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --compare bench.json   # diff against an earlier run
+    python benchmarks/run_benchmarks.py --scenarios download_throttled streamlit
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_youtube import FakeYouTube, media_bytes  # noqa: E402
+
+MB = 1024 * 1024
+VIDEO_IDS = [f"bench{i:06d}" for i in range(64)]
+
+# name -> (backend options, scenario options)
+SCENARIOS = {
+    'resolve_cold': ({'latency': 0.05}, {'videos': 32}),
+    'resolve_warm': ({'latency': 0.05}, {'videos': 32, 'warm': True}),
+    'download_fast': ({}, {'itag': 137, 'connections': 4}),
+    'download_single_connection': ({}, {'itag': 137, 'connections': 1}),
+    'download_throttled': ({'per_connection_bps': 4 * MB}, {'itag': 137, 'connections': 4}),
+    'download_bandwidth_capped': ({'bandwidth_bps': 40 * MB}, {'itag': 137, 'connections': 4, 'parallel': 4}),
+    'download_high_latency': ({'latency': 0.2}, {'itag': 137, 'connections': 4}),
+    # A third of media requests crawl at 48 KiB/s, with and without throttle detection
+    'download_flaky_throttle': ({'throttled_fraction': 0.3}, {'itag': 137, 'connections': 4}),
+    'download_flaky_throttle_undetected': ({'throttled_fraction': 0.3},
+                                           {'itag': 137, 'connections': 4, 'throttle_detection': False}),
+    'batch': ({'latency': 0.02}, {'videos': 8, 'rule': 'best ae_compatible <=720p'}),
+    'streamlit': ({'latency': 0.02}, {}),
+    'tk_manager': ({}, {'videos': 4, 'itag': 136}),
+    'priority': ({}, {'cap_mb': 16, 'batch_jobs': 3}),
+    # Local `jobqueue.py worker` processes sharing one queue; one is killed mid-job
+    'workers': ({'per_connection_bps': 8 * MB}, {'workers': 3, 'videos': 12, 'itag': 136, 'kill_after': 1.0}),
+}
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return rss / MB if sys.platform == 'darwin' else rss / 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'p50': round(statistics.median(samples), 4),
+        'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        'max': round(samples[-1], 4),
+    }
+
+
+def verify(path, itag):
+    """Check the start and end of a downloaded file against the fake media"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(MB)
+        f.seek(max(size - MB, 0))
+        tail = f.read()
+    return (head == media_bytes(itag, 0, len(head), size)
+            and tail == media_bytes(itag, size - len(tail), size, size))
+
+
+def find_stream(streams, itag):
+    return next(s for s in streams.all_streams() if s.itag == itag)
+
+
+# --- Scenarios (run in the child process) ---
+
+def scenario_resolve(backend, videos, warm=False):
+    import asyncio
+    from async_engine import run_sync
+    from commons import async_get_available_streams, get_available_streams
+
+    urls = [backend.watch_url(v) for v in VIDEO_IDS[:videos]]
+    if warm:
+        for url in urls:
+            get_available_streams(url)
+    latencies = []
+    for url in urls:
+        started = time.perf_counter()
+        get_available_streams(url)
+        latencies.append(time.perf_counter() - started)
+
+    # As many lookups at once on the shared loop; cold runs use videos not seen yet
+    if not warm:
+        urls = [backend.watch_url(v) for v in VIDEO_IDS[videos:2 * videos]]
+
+    async def all_at_once():
+        started = time.perf_counter()
+        await asyncio.gather(*(async_get_available_streams(u) for u in urls))
+        return time.perf_counter() - started
+
+    return {'metadata_latency_seconds': summarize(latencies),
+            'concurrent_resolve_seconds': round(run_sync(all_at_once()), 4)}
+
+
+def scenario_download(backend, itag, connections, parallel=1, throttle_detection=True):
+    import segmented
+    from commons import download_selected_stream, get_available_streams
+
+    if not throttle_detection:
+        segmented.THROTTLE_RATIO = 0
+
+    # Distinct videos so the content store can't share the transfers
+    jobs = []
+    for i in range(parallel):
+        streams, title = get_available_streams(backend.watch_url(VIDEO_IDS[i]))
+        jobs.append((find_stream(streams, itag), title))
+    results = [None] * parallel
+
+    def run(i):
+        stream, title = jobs[i]
+        results[i] = download_selected_stream(stream, title, 'downloads', connections=connections)[0]
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(parallel)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    total = sum(os.path.getsize(p) for p in results)
+    return {'download_seconds': round(elapsed, 4),
+            'throughput_mb_per_second': round(total / MB / elapsed, 2),
+            'bytes': total,
+            'verified': all(verify(p, itag) for p in results)}
+
+
+def scenario_batch(backend, videos, rule):
+    from batch import BatchJob, BatchRunner
+
+    jobs = [BatchJob(backend.watch_url(v), rule) for v in VIDEO_IDS[:videos]]
+    summary = BatchRunner('downloads', log=lambda msg: None).run(jobs)
+    return {'download_seconds': summary['elapsed_seconds'],
+            'throughput_mb_per_second': round(summary['throughput_bytes_per_second'] / MB, 2),
+            'bytes': summary['bytes'],
+            'failed': summary['failed'],
+            'metadata_latency_seconds': summarize([r['resolve_seconds'] for r in summary['results']])}
+
+
+def scenario_streamlit(backend):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, 'main.py'), default_timeout=120).run()
+    at.text_input[0].input(backend.watch_url(VIDEO_IDS[0])).run()
+    started = time.perf_counter()
+    next(b for b in at.button if b.label == 'Show Available Formats').click().run()
+    resolve = time.perf_counter() - started
+    started = time.perf_counter()
+    next(b for b in at.button if b.label == 'Prepare Selected Format').click().run()
+    prepare = time.perf_counter() - started
+    file_path = at.session_state.file_path if 'file_path' in at.session_state else None
+    return {'metadata_latency_seconds': round(resolve, 4),
+            'download_seconds': round(prepare, 4),
+            'bytes': os.path.getsize(file_path) if file_path else 0,
+            'errors': [e.value for e in at.error]}
+
+
+def scenario_tk_manager(backend, videos, itag):
+    from app import DownloadManager
+    from commons import get_available_streams
+
+    class Root:
+        """Just enough of Tk for DownloadManager: after() on a timer thread"""
+
+        def after(self, ms, callback):
+            threading.Timer(ms / 1000, callback).start()
+
+    done = threading.Event()
+    manager = DownloadManager(Root(), on_update=lambda jobs: all(j.finished for j in jobs) and done.set(),
+                              max_parallel=2)
+    jobs = []
+    for video_id in VIDEO_IDS[:videos]:
+        streams, title = get_available_streams(backend.watch_url(video_id))
+        jobs.append((find_stream(streams, itag), title))
+    started = time.perf_counter()
+    for stream, title in jobs:
+        manager.submit(stream, title, 'downloads')
+    done.wait(600)
+    elapsed = time.perf_counter() - started
+    total = sum(j.bytes_done for j in manager.jobs)
+    return {'download_seconds': round(elapsed, 4),
+            'throughput_mb_per_second': round(total / MB / elapsed, 2),
+            'bytes': total,
+            'failed': sum(1 for j in manager.jobs if j.status != 'Done')}
+
+
+def scenario_priority(backend, cap_mb, batch_jobs):
+    """Audio grabs under a global cap while batch jobs saturate it"""
+    from bandwidth import BATCH, bandwidth
+    from commons import download_selected_stream, get_available_streams
+    from segmented import DownloadControl
+
+    bandwidth.set_rate(cap_mb * MB)
+    batch = []
+    for video_id in VIDEO_IDS[:batch_jobs]:
+        streams, title = get_available_streams(backend.watch_url(video_id))
+        batch.append((find_stream(streams, 137), title))
+    threads = [threading.Thread(target=download_selected_stream, args=(stream, title, 'downloads'),
+                                kwargs={'control': DownloadControl(BATCH)}) for stream, title in batch]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    latencies = []
+    for video_id in VIDEO_IDS[batch_jobs:batch_jobs + 4]:
+        time.sleep(0.25)
+        streams, title = get_available_streams(backend.watch_url(video_id))
+        audio = find_stream(streams, 140)
+        t0 = time.perf_counter()
+        download_selected_stream(audio, title, 'downloads')
+        latencies.append(time.perf_counter() - t0)
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    total = sum(stream.filesize for stream, _ in batch)
+    return {'interactive_download_seconds': summarize(latencies),
+            'interactive_bytes': audio.filesize,
+            'download_seconds': round(elapsed, 4),
+            'throughput_mb_per_second': round(total / MB / elapsed, 2)}
+
+
+def scenario_workers(backend, workers, videos, itag, kill_after):
+    import signal
+    from jobqueue import JobQueue, wait_for_job
+
+    queue = JobQueue('downloads')
+    env = dict(os.environ, YTDL_INNERTUBE_URL=backend.innertube_url, YTDL_JOB_LEASE='2',
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    started = time.perf_counter()
+    job_ids = [queue.submit(backend.watch_url(video_id), itag=itag) for video_id in VIDEO_IDS[:videos]]
+    procs = [subprocess.Popen([sys.executable, os.path.join(ROOT, 'jobqueue.py'), 'worker', '-o', 'downloads',
+                               '--id', f'worker{i}'], env=env, stderr=subprocess.DEVNULL)
+             for i in range(workers)]
+    try:
+        time.sleep(kill_after)
+        procs[0].send_signal(signal.SIGKILL)
+        results = [wait_for_job(queue, job_id, poll=0.1) for job_id in job_ids]
+        elapsed = time.perf_counter() - started
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGINT)
+        for proc in procs:
+            proc.wait(30)
+    done = [r for r in results if r['status'] == 'done']
+    total = sum(r['total_bytes'] for r in done)
+    return {'download_seconds': round(elapsed, 4),
+            'throughput_mb_per_second': round(total / MB / elapsed, 2),
+            'bytes': total,
+            'retried': sum(1 for r in results if r['attempts'] > 1),
+            'failed': len(results) - len(done),
+            'verified': all(verify(os.path.join('downloads', r['file_name']), itag) for r in done)}
+
+
+RUNNERS = {
+    'resolve': scenario_resolve,
+    'download': scenario_download,
+    'batch': scenario_batch,
+    'streamlit': scenario_streamlit,
+    'tk_manager': scenario_tk_manager,
+    'priority': scenario_priority,
+    'workers': scenario_workers,
+}
+
+
+class BackendInfo:
+    """What a child process needs to know about the parent's fake backend"""
+
+    def __init__(self, innertube_url):
+        self.innertube_url = innertube_url
+
+    watch_url = staticmethod(FakeYouTube.watch_url)
+
+
+def child(name, innertube_url, options, result):
+    # Configure before commons (and its async engine) is imported
+    os.environ['YTDL_INNERTUBE_URL'] = innertube_url
+    os.environ['YTDL_FILE_SERVER_PORT'] = '0'
+    os.chdir(tempfile.mkdtemp(prefix=f'ytdl-bench-{name}-'))
+    os.makedirs('downloads', exist_ok=True)
+    kind = name.split('_')[0] if name.split('_')[0] in RUNNERS else name
+    cpu_before, started = cpu_seconds(), time.perf_counter()
+    try:
+        row = RUNNERS[kind](BackendInfo(innertube_url), **options)
+    except Exception as e:
+        row = {'error': f"{type(e).__name__}: {e}"}
+    row.update(wall_seconds=round(time.perf_counter() - started, 4),
+               cpu_seconds=round(cpu_seconds() - cpu_before, 4),
+               peak_rss_mb=round(peak_rss_mb(), 1))
+    result.put(row)
+
+
+def run_scenario(name, video_size):
+    backend_options, options = SCENARIOS[name]
+    backend = FakeYouTube(video_size=video_size, **backend_options).start()
+    try:
+        context = multiprocessing.get_context('spawn')
+        result = context.Queue()
+        proc = context.Process(target=child, args=(name, backend.innertube_url, options, result))
+        proc.start()
+        row = result.get()
+        proc.join()
+    finally:
+        backend.stop()
+    row['backend_requests'] = dict(backend.requests)
+    return row
+
+
+def compare(current, baseline):
+    """Print each numeric metric with its change against baseline"""
+    old = {s['name']: s for s in baseline['scenarios']}
+    for scenario in current['scenarios']:
+        before = old.get(scenario['name'])
+        if not before:
+            continue
+        print(scenario['name'])
+        for key, value in _flatten(scenario).items():
+            prev = _flatten(before).get(key)
+            if isinstance(value, (int, float)) and isinstance(prev, (int, float)) and prev:
+                print(f"  {key:<40} {prev:>12} -> {value:<12} {(value - prev) / prev:+.1%}")
+
+
+def _flatten(row, prefix=''):
+    flat = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--size-mb', type=int, default=32, help='Size of the largest fake format')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Earlier results JSON to diff against')
+    args = parser.parse_args()
+
+    results = {'revision': git_revision(), 'python': platform.python_version(),
+               'platform': platform.platform(), 'size_mb': args.size_mb, 'scenarios': []}
+    for name in args.scenarios:
+        row = dict(name=name, **run_scenario(name, args.size_mb * MB))
+        results['scenarios'].append(row)
+        print(json.dumps(row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
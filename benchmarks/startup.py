@@ -0,0 +1,201 @@
+"""Startup benchmark: import time and time to first interactive.
+
+Each measurement runs in a fresh interpreter, so nothing is already in
+sys.modules. Reports, per front end, the time to import it and which
+heavy modules that pulled in; the time until the Tk window has been
+drawn (skipped without a display) and until the Streamlit page first
+renders; and the first format lookup against the local fake YouTube,
+cold and after commons.prewarm().
+
+    python benchmarks/startup.py --output startup.json
+    python benchmarks/startup.py --compare startup.json --max-regression 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_youtube import FakeYouTube  # noqa: E402
+from run_benchmarks import compare, git_revision, _flatten  # noqa: E402
+
+# Front end -> module imported at its startup
+FRONT_ENDS = {'tk': 'app', 'streamlit': 'main_imports', 'api': 'api_server', 'batch': 'batch'}
+# Modules that should only load once they are needed
+HEAVY_MODULES = ('pytubefix', 'asyncio', 'ssl', 'sqlite3', 'streamlit')
+
+IMPORT_PROBE = '''
+import sys, time, json
+started = time.perf_counter()
+{statement}
+print(json.dumps({{"seconds": time.perf_counter() - started,
+                  "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+TK_PROBE = '''
+import json, time
+started = time.perf_counter()
+import tkinter as tk
+import app
+try:
+    root = tk.Tk()
+except tk.TclError as e:
+    print(json.dumps({"skipped": str(e)}))
+    raise SystemExit
+app.DownloaderApp(root)
+root.update()
+print(json.dumps({"seconds": time.perf_counter() - started}))
+root.destroy()
+'''
+
+STREAMLIT_PROBE = '''
+import json, os, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(os.path.join({root!r}, "main.py"), default_timeout=60).run()
+print(json.dumps({{"seconds": time.perf_counter() - started, "errors": [e.value for e in at.exception]}}))
+'''
+
+LOOKUP_PROBE = '''
+import json, time
+from commons import get_available_streams, prewarm
+if {warm}:
+    prewarm()
+started = time.perf_counter()
+get_available_streams({url!r})
+print(json.dumps({{"seconds": time.perf_counter() - started}}))
+'''
+
+
+def probe(code, env=None):
+    """Run code in a fresh interpreter in an empty directory; returns (its JSON line, wall seconds)"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+               **(env or {}))
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code], cwd=tempfile.mkdtemp(prefix='ytdl-startup-'),
+                         capture_output=True, text=True, env=env)
+    wall = time.perf_counter() - started
+    lines = [line for line in out.stdout.splitlines() if line.startswith('{')]
+    if not lines:
+        return {'error': out.stderr.strip().splitlines()[-1] if out.stderr.strip() else 'no output'}, wall
+    return json.loads(lines[-1]), wall
+
+
+def median(samples):
+    return round(statistics.median(samples), 4)
+
+
+def bench_interpreter(runs):
+    return {'name': 'interpreter', 'wall_seconds': median([probe('pass')[1] for _ in range(runs)])}
+
+
+def bench_import(front_end, module, runs):
+    if module == 'main_imports':
+        # main.py itself only runs under Streamlit; time what it imports
+        statement = 'import streamlit, commons, file_server, mux, retention, store'
+    else:
+        statement = f'import {module}'
+    results = [probe(IMPORT_PROBE.format(statement=statement, heavy=HEAVY_MODULES)) for _ in range(runs)]
+    errors = [r['error'] for r, _ in results if 'error' in r]
+    if errors:
+        return {'name': f'import_{front_end}', 'error': errors[0]}
+    return {'name': f'import_{front_end}',
+            'import_seconds': median([r['seconds'] for r, _ in results]),
+            'wall_seconds': median([wall for _, wall in results]),
+            'heavy_modules': results[0][0]['heavy']}
+
+
+def bench_tk(runs):
+    results = [probe(TK_PROBE) for _ in range(runs)]
+    first = results[0][0]
+    if 'seconds' not in first:
+        return {'name': 'tk_first_interactive', **first}
+    return {'name': 'tk_first_interactive',
+            'first_interactive_seconds': median([r['seconds'] for r, _ in results]),
+            'wall_seconds': median([wall for _, wall in results])}
+
+
+def bench_streamlit(runs, env):
+    results = [probe(STREAMLIT_PROBE.format(root=ROOT), env) for _ in range(runs)]
+    if 'seconds' not in results[0][0]:
+        return {'name': 'streamlit_first_render', **results[0][0]}
+    return {'name': 'streamlit_first_render',
+            'first_render_seconds': median([r['seconds'] for r, _ in results]),
+            'errors': results[0][0]['errors']}
+
+
+def bench_first_lookup(runs, backend):
+    row = {'name': 'first_lookup'}
+    env = {'YTDL_INNERTUBE_URL': backend.innertube_url}
+    for warm in (False, True):
+        samples = []
+        for i in range(runs):
+            # A new video each run so the on-disk metadata cache can't answer
+            url = backend.watch_url(f"start{int(warm)}{i:05d}")
+            result, _ = probe(LOOKUP_PROBE.format(warm=warm, url=url), env)
+            if 'error' in result:
+                return dict(row, error=result['error'])
+            samples.append(result['seconds'])
+        row['prewarmed_seconds' if warm else 'cold_seconds'] = median(samples)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per measurement')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Earlier results JSON to diff against')
+    parser.add_argument('--max-regression', type=float,
+                        help='With --compare, exit 1 if any *_seconds metric grew by more than this fraction')
+    args = parser.parse_args()
+
+    backend = FakeYouTube().start()
+    env = {'YTDL_INNERTUBE_URL': backend.innertube_url, 'YTDL_FILE_SERVER_PORT': '0'}
+    try:
+        rows = [bench_interpreter(args.runs)]
+        rows += [bench_import(front_end, module, args.runs) for front_end, module in FRONT_ENDS.items()]
+        rows += [bench_tk(args.runs), bench_streamlit(max(1, args.runs // 2), env),
+                 bench_first_lookup(args.runs, backend)]
+    finally:
+        backend.stop()
+
+    results = {'revision': git_revision(), 'python': platform.python_version(),
+               'platform': platform.platform(), 'scenarios': rows}
+    for row in rows:
+        print(json.dumps(row))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        compare(results, baseline)
+        if args.max_regression is not None and regressions(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+def regressions(current, baseline, limit):
+    """Names of *_seconds metrics that grew by more than limit (a fraction)"""
+    old = {s['name']: _flatten(s) for s in baseline['scenarios']}
+    found = []
+    for scenario in current['scenarios']:
+        before = old.get(scenario['name'], {})
+        for key, value in _flatten(scenario).items():
+            prev = before.get(key)
+            if key.endswith('_seconds') and isinstance(prev, (int, float)) and prev and value > prev * (1 + limit):
+                found.append(f"{scenario['name']}.{key}")
+    for name in found:
+        print(f"REGRESSION {name}", file=sys.stderr)
+    return found
+
+
+if __name__ == '__main__':
+    main()
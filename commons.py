@@ -1,46 +1,56 @@
-from pytubefix import YouTube
+import asyncio
 import os
+import re
 import ssl
+import time
 import uuid
+from streams import StreamCatalog, StreamInfo, reporting_progress
+from stream_cache import StreamCache
+from segmented import (
+    DOWNLOAD_CONNECTIONS,
+    SEGMENTED_MIN_SIZE,
+    DownloadCancelled,
+    RangeNotSupported,
+    SegmentScheduler,
+    StaleURL,
+    Throttled,
+    throttle_threshold,
+)
+from integrity import IntegrityError, StreamVerifier, check_container
+from partial import PARTIAL_SUFFIX, PartialDownload
+from store import get_store
+from async_engine import (
+    INNERTUBE_URL,
+    AsyncSegmentedDownloader,
+    fetch_player,
+    get_client,
+    innertube_client,
+    record_throttle,
+    run_sync,
+)
+from metrics import metrics
 
-def download_video(url):
-    # Configure SSL certificate verification
-    ssl._create_default_https_context = ssl._create_unverified_context
-    
-    try:
-        # Initialize YouTube object with proper parameters
-        yt = YouTube(url)
-        
-        # Get video information
-        title = yt.title
-
-        stream = yt.streams.filter(adaptive=True, file_extension='mp4', type='video').order_by('resolution').desc().first()
-        
-        if not stream:
-            # Second attempt: Try progressive streams (has both video and audio but lower quality)
-            stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
-            
-        if not stream:
-            # Last resort: Any video stream available
-            stream = yt.streams.filter(file_extension='mp4').order_by('resolution').desc().first()
-            
-        if not stream:
-            raise Exception("No suitable video stream found for this URL")
-        
-        # Generate a unique filename to avoid conflicts
-        unique_id = str(uuid.uuid4())[:8]
-        safe_title = "".join([c if c.isalnum() else "_" for c in title])
-        filename = f"{safe_title}_{unique_id}.mp4"
-        file_path = os.path.join(DOWNLOAD_FOLDER, filename)
-        
-        # Download the video to the specified folder
-        stream.download(output_path=DOWNLOAD_FOLDER, filename=filename)
-        
-        return file_path, filename
-    except Exception as e:
-        error_msg = f"Error downloading video: {str(e)}"
-        st.error(error_msg)
-        raise Exception(error_msg)
+# Shared metadata cache so re-submitting a URL skips the YouTube round trips
+stream_cache = StreamCache()
+
+# Resolve formats with one InnerTube request on the shared async client,
+# falling back to pytubefix when that response is unusable
+INNERTUBE_FAST_PATH = os.environ.get("YTDL_INNERTUBE_FAST_PATH", "1") == "1"
+
+# How many times a download re-resolves an expired stream URL before giving up
+URL_REFRESH_ATTEMPTS = 2
+# Fresh URLs tried for a stream whose connections all keep getting throttled
+THROTTLE_REFRESH_ATTEMPTS = 3
+
+VIDEO_ID_PATTERN = re.compile(r'(?:v=|/(?:shorts|embed|live|v)/|youtu\.be/)([0-9A-Za-z_-]{11})')
+
+def download_video(url, download_dir, rule="best progressive"):
+    """Resolve url, pick a stream with a format rule and download it"""
+    streams, title = get_available_streams(url)
+    stream = select_stream(streams, rule)
+    if not stream:
+        raise Exception(f"No stream matching '{rule}' found for this URL")
+    return download_selected_stream(stream, title, download_dir)
 
 def cleanup_video(file_path):
     """Delete the video file after download"""
@@ -49,23 +59,34 @@ def cleanup_video(file_path):
             os.remove(file_path)
             return True
     except Exception as e:
-        st.warning(f"Could not delete temporary file: {str(e)}")
+        print(f"Warning: Could not delete temporary file: {str(e)}")
         return False
     return False
 
-def get_available_streams(url):
-    """Get all available streams categorized by type"""
-    ssl._create_default_https_context = ssl._create_unverified_context
-    yt = YouTube(url)
-    
+def extract_video_id(url):
+    """Return the 11-character video ID in a YouTube URL, or None"""
+    url = url.strip()
+    if re.fullmatch(r'[0-9A-Za-z_-]{11}', url):
+        return url
+    match = VIDEO_ID_PATTERN.search(url)
+    return match.group(1) if match else None
+
+def watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def categorize_streams(stream_list):
+    """Sort StreamInfo descriptors into the categories the front ends use
+
+    Returns a StreamCatalog, with every category already ordered best first.
+    """
     streams = {
         'video': [],
         'audio': [],
         'progressive': [],
         'ae_compatible': []  # New category for After Effects compatible streams
     }
-    
-    for stream in yt.streams:
+
+    for stream in stream_list:
         if stream.type == 'video' and stream.audio_codec is None:
             streams['video'].append(stream)
             # Check for After Effects compatible video streams
@@ -78,15 +99,316 @@ def get_available_streams(url):
             streams['progressive'].append(stream)
             # Progressive streams are usually compatible with AE
             streams['ae_compatible'].append(stream)
-    
-    return streams, yt.title
 
-def download_selected_stream(stream, title, download_dir):
-    """Download the selected stream"""
+    return StreamCatalog(streams)
+
+def _streams_from_player(player, video_id):
+    """StreamInfo list and title from an InnerTube player response, or None"""
+    if player.get('playabilityStatus', {}).get('status') != 'OK':
+        return None
+    data = player.get('streamingData', {})
+    formats = data.get('formats', []) + data.get('adaptiveFormats', [])
+    # Formats without a plain URL need signature deciphering, which pytubefix does
+    if not formats or any('url' not in f for f in formats):
+        return None
+    return [StreamInfo.from_format(f, video_id) for f in formats], player['videoDetails']['title']
+
+def _streams_from_pytubefix(url, video_id):
+    from pytubefix import YouTube
+
+    # pytubefix's own requests go through urllib's process-wide default;
+    # the engine's client has a verifying context of its own
+    ssl._create_default_https_context = ssl._create_unverified_context
+    yt = YouTube(url)
+    video_id = video_id or yt.video_id
+    return [StreamInfo.from_pytubefix(s, video_id) for s in yt.streams], yt.title, video_id
+
+class _Lookup:
+    """One format lookup in flight and how many callers are waiting on it"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+# video ID -> _Lookup running on the engine loop
+_lookups = {}
+
+async def async_get_available_streams(url, refresh=False):
+    """Get all available streams categorized by type
+
+    Results are served from `stream_cache` when fresh; pass refresh=True to
+    force a new lookup through pytubefix (e.g. after a download URL has
+    gone stale). Cache misses first try a single InnerTube request on the
+    shared async client, so many lookups can be in flight without a thread
+    each. Callers asking for a video that is already being looked up (say,
+    by a prefetch) wait for that lookup instead of starting another; it is
+    cancelled only once every caller waiting on it has been.
+    """
+    video_id = extract_video_id(url)
+    if not video_id or refresh:
+        return await _resolve_streams(url, video_id, refresh)
+    lookup = _lookups.get(video_id)
+    if lookup is None or lookup.task.get_loop() is not asyncio.get_running_loop():
+        lookup = _lookups[video_id] = _Lookup(asyncio.ensure_future(_resolve_streams(url, video_id, False)))
+        lookup.task.add_done_callback(lambda task: _lookups.get(video_id) is lookup and _lookups.pop(video_id))
+    else:
+        metrics.count('resolve_joined_total')
+    lookup.waiters += 1
+    try:
+        return await asyncio.shield(lookup.task)
+    finally:
+        lookup.waiters -= 1
+        if not lookup.waiters and not lookup.task.done():
+            lookup.task.cancel()
+
+async def _resolve_streams(url, video_id, refresh):
+    with metrics.resolve(video_id) as info:
+        if video_id and not refresh:
+            entry = stream_cache.get(video_id)
+            if entry is not None:
+                info['source'] = 'cache'
+                return entry.streams, entry.title
+        if video_id and refresh:
+            stream_cache.refresh(video_id)
+
+        resolved = None
+        # Older or newer pytubefix releases may lack the client the fast path copies
+        if video_id and INNERTUBE_FAST_PATH and not refresh and innertube_client() is not None:
+            try:
+                resolved = _streams_from_player(await fetch_player(video_id), video_id)
+            except Exception:
+                resolved = None
+        if resolved is not None:
+            info['source'] = 'innertube'
+            stream_list, title = resolved
+        else:
+            info['source'] = 'pytubefix'
+            stream_list, title, video_id = await asyncio.to_thread(_streams_from_pytubefix, url, video_id)
+
+        streams = categorize_streams(stream_list)
+        if video_id:
+            stream_cache.put(video_id, streams, title)
+        return streams, title
+
+def get_available_streams(url, refresh=False):
+    """Get all available streams categorized by type (blocking wrapper)"""
+    return run_sync(async_get_available_streams(url, refresh))
+
+def prewarm():
+    """Import pytubefix and open a connection to YouTube ahead of the first lookup
+
+    Blocking; front ends run it on a background thread at startup, while
+    the user is still typing a URL. Failures (e.g. offline) are ignored,
+    the first lookup will just pay for them itself.
+    """
+    started = time.monotonic()
+    try:
+        import pytubefix  # noqa: F401  the fallback resolver
+        from pytubefix.innertube import _default_clients  # noqa: F401  used by fetch_player
+        from pytubefix.itags import get_format_profile  # noqa: F401  used by StreamInfo.from_format
+
+        async def connect():
+            await get_client().connect(INNERTUBE_URL)
+
+        run_sync(connect())
+    except Exception as e:
+        metrics.event('prewarm_failed', error=str(e))
+        return
+    metrics.event('prewarm', seconds=round(time.monotonic() - started, 3))
+
+def stream_quality(stream):
+    """Numeric sort key: resolution for video streams, bitrate for audio"""
+    return stream.quality
+
+RULE_CONSTRAINT = re.compile(r'(<=|>=|=|≤|≥)(\d+)(p|kbps)?$')
+
+def parse_format_rule(rule):
+    """Parse a rule like "best ae_compatible <=1080p" or "worst audio >=128kbps"
+
+    Returns (order, category, constraints, subtype) where constraints is a
+    list of (op, value) applied to stream_quality().
+    """
+    order, category, constraints, subtype = 'best', None, [], None
+    for token in rule.split():
+        token = token.lower()
+        match = RULE_CONSTRAINT.match(token)
+        if token in ('best', 'worst'):
+            order = token
+        elif token in ('video', 'audio', 'progressive', 'ae_compatible'):
+            category = token
+        elif token in ('mp4', 'webm'):
+            subtype = token
+        elif match:
+            op = {'≤': '<=', '≥': '>='}.get(match.group(1), match.group(1))
+            constraints.append((op, int(match.group(2))))
+        else:
+            raise ValueError(f"Unknown token '{token}' in format rule '{rule}'")
+    if category is None:
+        raise ValueError(f"Format rule '{rule}' needs a category (video, audio, progressive, ae_compatible)")
+    return order, category, constraints, subtype
+
+def select_stream(streams, rule):
+    """Pick the stream a format rule asks for, or None if nothing matches"""
+    order, category, constraints, subtype = parse_format_rule(rule)
+    candidates = []
+    for stream in streams.get(category, []):
+        quality = stream_quality(stream)
+        if subtype and stream.subtype != subtype:
+            continue
+        if all((quality <= v) if op == '<=' else (quality >= v) if op == '>=' else (quality == v)
+               for op, v in constraints):
+            candidates.append(stream)
+    if not candidates:
+        return None
+    pick = max if order == 'best' else min
+    return pick(candidates, key=lambda s: (stream_quality(s), s.filesize or 0))
+
+async def async_refresh_stream_url(stream):
+    """Re-resolve a stream's signed URL through get_available_streams"""
+    streams, _ = await async_get_available_streams(watch_url(stream.video_id), refresh=True)
+    for stream_list in streams.values():
+        for fresh in stream_list:
+            if fresh.itag == stream.itag:
+                stream.url = fresh.url
+                return stream.url
+    raise Exception(f"Stream {stream.itag} is no longer available for this video")
+
+async def async_download_selected_stream(stream, title, download_dir, connections=DOWNLOAD_CONNECTIONS, on_progress=None,
+                                         control=None):
+    """Download the selected stream
+
+    Streams with a known size are fetched by ranged requests (in parallel
+    above SEGMENTED_MIN_SIZE) on the shared async client into a `.part`
+    file whose manifest lets a retry or restart continue from the first
+    missing byte. The finished file is renamed into place atomically.
+    Streams with a video ID and size go through the download folder's
+    ContentStore, so repeats are linked from disk and concurrent requests
+    for the same stream share one transfer.
+    on_progress(stream, chunk, bytes_remaining) matches pytubefix's callback;
+    `control` (a DownloadControl) pauses or cancels the download, and a
+    cancelled download's partial file is removed unless it was cancelled
+    with keep_partial.
+    """
     unique_id = str(uuid.uuid4())[:8]
     safe_title = "".join([c if c.isalnum() else "_" for c in title])
     filename = f"{safe_title}_{unique_id}.{stream.subtype}"
     file_path = os.path.join(download_dir, filename)
-    
-    stream.download(output_path=download_dir, filename=filename)
+
+    if stream.filesize and getattr(stream, 'video_id', None):
+        # Same video/itag/size already on disk or on its way: share it
+        async def download(path, progress, shared_control):
+            return await _download_stream(stream, path, connections, progress, shared_control)
+
+        await get_store(download_dir).fetch(stream, file_path, download, on_progress, control)
+        return file_path, filename
+
+    await _download_stream(stream, file_path, connections, on_progress, control)
+    await asyncio.to_thread(lambda: get_store(download_dir).track_file(file_path))
     return file_path, filename
+
+async def _download_stream(stream, file_path, connections, on_progress, control):
+    """Fetch stream to file_path, resuming from a partial file where possible;
+    returns the file's integrity digest"""
+    with metrics.download(stream) as timer:
+        try:
+            return await _fetch_stream(stream, file_path, connections, timer.wrap(on_progress), control)
+        except IntegrityError:
+            # The bad partial file is gone; one fresh attempt before giving up
+            metrics.count('retries_total', kind='integrity')
+            return await _fetch_stream(stream, file_path, connections, timer.wrap(on_progress), control)
+
+def _verify(path, stream, verifier):
+    """Length, digest and container check of a finished download"""
+    digest = verifier.finish(path)
+    check_container(path, stream.subtype)
+    return digest
+
+async def _fetch_stream(stream, file_path, connections, on_progress, control):
+    download_dir, filename = os.path.split(file_path)
+    if stream.url and stream.filesize and getattr(stream, 'video_id', None):
+        partial = PartialDownload.for_stream(stream, download_dir)
+        if stream.filesize < SEGMENTED_MIN_SIZE:
+            connections = 1
+        progress = (lambda chunk, remaining: on_progress(stream, chunk, remaining)) if on_progress else None
+        # Hashes each block as it is written, so checking the result needs no second read
+        verifier = StreamVerifier(stream.filesize)
+        downloader = AsyncSegmentedDownloader(
+            stream.url, stream.filesize, partial.path,
+            connections=connections,
+            on_progress=progress,
+            scheduler=SegmentScheduler(stream.filesize, await asyncio.to_thread(partial.completed_ranges),
+                                       connections=connections),
+            on_checkpoint=partial.save,
+            control=control,
+            min_rate=throttle_threshold(stream),
+            info={'video_id': stream.video_id, 'itag': stream.itag},
+            on_write=verifier.update,
+        )
+        refreshes = throttle_refreshes = 0
+        while True:
+            try:
+                await downloader.run()
+                digest = await asyncio.to_thread(_verify, partial.path, stream, verifier)
+                await asyncio.to_thread(partial.promote, file_path)
+                return digest
+            except StaleURL:
+                if refreshes == URL_REFRESH_ATTEMPTS:
+                    raise
+                refreshes += 1
+                # Signed URLs expire; keep the bytes we have and ask for a new one
+                metrics.count('retries_total', kind='url_refresh')
+                downloader.url = await async_refresh_stream_url(stream)
+            except Throttled as e:
+                # New connections kept getting throttled; a freshly resolved URL
+                # usually isn't
+                if throttle_refreshes == THROTTLE_REFRESH_ATTEMPTS:
+                    raise Throttled(f"Download still throttled after {throttle_refreshes} new stream URLs") from e
+                throttle_refreshes += 1
+                try:
+                    downloader.url = await async_refresh_stream_url(stream)
+                except Exception as e:
+                    # Carry on with the URL we have rather than fail a working download
+                    record_throttle('refresh_failed', {'video_id': stream.video_id, 'itag': stream.itag},
+                                    error=str(e))
+            except RangeNotSupported:
+                metrics.count('retries_total', kind='range_fallback')
+                partial.discard()
+                break  # fall back to a single sequential download
+            except IntegrityError:
+                partial.discard()
+                raise
+            except DownloadCancelled:
+                if not (control and control.keep_partial):
+                    partial.discard()
+                raise
+
+    # Sequential download into a temporary name, renamed once it checks out
+    tmp_path = file_path + PARTIAL_SUFFIX
+    verifier = StreamVerifier(stream.filesize)
+    written = [0]
+
+    def hashing_progress(s, chunk, bytes_remaining):
+        verifier.update(written[0], chunk)
+        written[0] += len(chunk)
+        if on_progress:
+            on_progress(s, chunk, bytes_remaining)
+
+    try:
+        if isinstance(stream, StreamInfo):
+            await asyncio.to_thread(stream.download, output_path=download_dir, filename=os.path.basename(tmp_path),
+                                    on_progress=hashing_progress, control=control)
+        else:
+            with reporting_progress(stream, hashing_progress):
+                await asyncio.to_thread(stream.download, output_path=download_dir,
+                                        filename=os.path.basename(tmp_path))
+        digest = await asyncio.to_thread(_verify, tmp_path, stream, verifier)
+        await asyncio.to_thread(os.replace, tmp_path, file_path)
+        return digest
+    except BaseException:
+        cleanup_video(tmp_path)
+        raise
+
+def download_selected_stream(stream, title, download_dir, connections=DOWNLOAD_CONNECTIONS, on_progress=None,
+                             control=None):
+    """Download the selected stream (blocking wrapper)"""
+    return run_sync(async_download_selected_stream(stream, title, download_dir, connections, on_progress, control))
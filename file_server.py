@@ -0,0 +1,220 @@
+import mimetypes
+import os
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+from metrics import metrics, send_metrics
+
+# Loopback only by default: links are unauthenticated. Set 0.0.0.0 (or an
+# interface address) to let other machines download directly
+FILE_SERVER_HOST = os.environ.get("YTDL_FILE_SERVER_HOST", "127.0.0.1")
+FILE_SERVER_PORT = int(os.environ.get("YTDL_FILE_SERVER_PORT", "8502"))
+# Seconds a registered file stays downloadable after it was last requested
+FILE_TOKEN_TTL = 60 * 60
+# Upper bound on bytes handed to the socket per sendfile()/send() call
+CHUNK_SIZE = 1024 * 1024
+# Each open connection holds a thread; clients beyond this get a 503
+MAX_CONNECTIONS = int(os.environ.get("YTDL_MAX_CONNECTIONS", "256"))
+# Seconds an idle keep-alive connection may hold on to its thread
+IDLE_TIMEOUT = 30
+BUSY_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n"
+                 b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class ServedFile:
+    def __init__(self, path, file_name, mime_type):
+        self.path = path
+        self.file_name = file_name
+        self.mime_type = mime_type
+        self.last_access = time.time()
+
+
+class FileHTTPServer(ThreadingHTTPServer):
+    """Thread-per-connection server with a cap on open connections"""
+
+    daemon_threads = True
+    # The default backlog of 5 refuses bursts of clients connecting at once
+    request_queue_size = 128
+    # The FileServer whose tokens FileRequestHandler looks up
+    files = None
+
+    def __init__(self, server_address, handler_class, max_connections=MAX_CONNECTIONS):
+        super().__init__(server_address, handler_class)
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            metrics.count('http_connections_refused_total')
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+
+class FileServer:
+    """Serves prepared downloads straight from disk.
+
+    Each file is registered under an unguessable token and sent in bounded
+    chunks with sendfile(), so memory use per client does not depend on the
+    size of the video.
+    """
+
+    def __init__(self, host=FILE_SERVER_HOST, port=FILE_SERVER_PORT, token_ttl=FILE_TOKEN_TTL):
+        self.host = host
+        self.port = port
+        self.token_ttl = token_ttl
+        self._files = {}
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    def start(self):
+        """Start serving in a daemon thread. Returns self."""
+        self._httpd = FileHTTPServer((self.host, self.port), FileRequestHandler)
+        self._httpd.files = self
+        self.port = self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def register(self, path, file_name=None, mime_type=None):
+        """Make path downloadable and return its token"""
+        file_name = file_name or os.path.basename(path)
+        mime_type = mime_type or mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self._expire()
+            self._files[token] = ServedFile(os.path.abspath(path), file_name, mime_type)
+        return token
+
+    def lookup(self, token):
+        with self._lock:
+            served = self._files.get(token)
+            if served is None:
+                return None
+            served.last_access = time.time()
+            return served
+
+    def is_serving(self, path):
+        """True while path is registered under a token that has not expired"""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._expire()
+            return any(f.path == path for f in self._files.values())
+
+    def url_for(self, token, base_url=None):
+        base_url = base_url or f"http://127.0.0.1:{self.port}"
+        return f"{base_url.rstrip('/')}/files/{token}"
+
+    def _expire(self):
+        cutoff = time.time() - self.token_ttl
+        for token in [t for t, f in self._files.items() if f.last_access < cutoff]:
+            del self._files[token]
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    """GET/HEAD /files/<token> with single-range support, and GET /metrics
+
+    Tokens are looked up in the FileServer at self.server.files.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; without this small responses wait on delayed ACKs
+    disable_nagle_algorithm = True
+    timeout = IDLE_TIMEOUT
+
+    def do_HEAD(self):
+        self.handle_file(send_body=False)
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            send_metrics(self)
+            return
+        self.handle_file(send_body=True)
+
+    def handle_file(self, send_body):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        served = self.server.files.lookup(parts[1]) if len(parts) == 2 and parts[0] == 'files' else None
+        if served is None or not os.path.isfile(served.path):
+            self.send_error(404, "File not found")
+            return
+        send_file(self, served.path, served.file_name, served.mime_type, send_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def send_file(handler, path, file_name, mime_type, send_body=True):
+    """Write an (optionally ranged) response for path to a BaseHTTPRequestHandler"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start, end = 0, size - 1
+        status = 200
+
+        range_header = handler.headers.get('Range')
+        if range_header:
+            match = RANGE_PATTERN.match(range_header.strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    # Suffix range: last N bytes
+                    start = max(size - int(match.group(2)), 0)
+                if start > end or start >= size:
+                    handler.send_response(416)
+                    handler.send_header('Content-Range', f'bytes */{size}')
+                    handler.send_header('Content-Length', '0')
+                    handler.end_headers()
+                    return
+                status = 206
+
+        length = end - start + 1 if size else 0
+        handler.send_response(status)
+        handler.send_header('Content-Type', mime_type)
+        handler.send_header('Content-Length', str(length))
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(file_name)}")
+        if status == 206:
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        handler.end_headers()
+        if not send_body or not length:
+            return
+
+        handler.wfile.flush()
+        offset, remaining = start, length
+        try:
+            while remaining > 0:
+                # socket.sendfile() uses os.sendfile() where available and
+                # falls back to bounded send() calls elsewhere
+                sent = handler.connection.sendfile(f, offset, min(CHUNK_SIZE, remaining))
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-transfer
+            handler.close_connection = True
@@ -0,0 +1,187 @@
+"""Integrity checks for downloaded files.
+
+    verifier = StreamVerifier(stream.filesize)
+    verifier.update(offset, chunk)           # after every write, in any order
+    digest = verifier.finish(path)           # length check + hex digest
+    check_container(path, 'mp4')             # playable-looking MP4/WebM/WAV?
+
+The digest is SHA-256 over the SHA-256 of each BLOCK_SIZE block. Blocks
+are hashed while their bytes arrive, so parallel ranged downloads hash
+their data without reading the file again; only blocks whose bytes did
+not arrive in order within the block (a resumed partial file, say) are
+read back by finish(). SegmentScheduler cuts segments on block
+boundaries, so normally there are none.
+
+check_container() only walks headers: the MP4 box list or the WebM/EBML
+header and Segment size, enough to catch truncated and mislabelled files
+without decoding anything.
+"""
+import hashlib
+import os
+import struct
+
+from metrics import metrics
+from segmented import BLOCK_SIZE
+
+
+class IntegrityError(Exception):
+    """A downloaded file is incomplete or not the container it claims to be"""
+
+
+class StreamVerifier:
+    """Hashes a file's blocks as they are written, in any order"""
+
+    def __init__(self, total_size=None, block_size=BLOCK_SIZE):
+        self.total_size = total_size or None
+        self.block_size = block_size
+        self.blocks = {}  # block index -> digest
+        self._open = {}  # block index -> [hasher, next offset]
+        self._broken = set()  # blocks to read back in finish()
+        self.streamed = 0
+        self.rehashed = 0
+
+    def update(self, offset, data):
+        view = memoryview(data)
+        while view:
+            index = offset // self.block_size
+            block_end = (index + 1) * self.block_size
+            if self.total_size:
+                block_end = min(block_end, self.total_size)
+            n = min(len(view), block_end - offset)
+            if index not in self.blocks and index not in self._broken:
+                entry = self._open.get(index)
+                if entry is None and offset == index * self.block_size:
+                    entry = self._open[index] = [hashlib.sha256(), offset]
+                if entry is not None and entry[1] == offset:
+                    entry[0].update(view[:n])
+                    entry[1] += n
+                    self.streamed += n
+                    if entry[1] == block_end:
+                        self.blocks[index] = entry[0].digest()
+                        del self._open[index]
+                else:
+                    # Not contiguous within its block: hash it from disk at the end
+                    self._open.pop(index, None)
+                    self._broken.add(index)
+            offset += n
+            view = view[n:]
+
+    def finish(self, path):
+        """Check the file's length and return its hex digest, reading back only
+        the blocks that couldn't be hashed in flight"""
+        size = os.path.getsize(path)
+        if self.total_size and size != self.total_size:
+            metrics.count('integrity_checks_total', result='length_mismatch')
+            raise IntegrityError(f"Expected {self.total_size} bytes, {path} has {size}")
+        count = -(-size // self.block_size)
+        # The last block of a download of unknown length ends wherever the file does
+        for index, (hasher, pos) in list(self._open.items()):
+            if pos == size and index == count - 1:
+                self.blocks[index] = hasher.digest()
+        missing = [i for i in range(count) if i not in self.blocks]
+        if missing:
+            with open(path, 'rb') as f:
+                for index in missing:
+                    f.seek(index * self.block_size)
+                    data = f.read(min(self.block_size, size - index * self.block_size))
+                    self.blocks[index] = hashlib.sha256(data).digest()
+                    self.rehashed += len(data)
+            metrics.count('integrity_rehashed_bytes_total', self.rehashed)
+        return hashlib.sha256(b''.join(self.blocks[i] for i in range(count))).hexdigest()
+
+
+def file_digest(path, block_size=BLOCK_SIZE):
+    """The StreamVerifier digest of a file already on disk (reads all of it)"""
+    return StreamVerifier(os.path.getsize(path), block_size).finish(path)
+
+
+def check_container(path, kind):
+    """Raise IntegrityError unless path's headers look like a complete `kind` file
+    (mp4, m4a, mov, webm, wav); other kinds are only checked for being non-empty"""
+    size = os.path.getsize(path)
+    if not size:
+        raise IntegrityError(f"{path} is empty")
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        if head[4:8] in (b'ftyp', b'styp'):
+            _check_mp4(f, size)
+        elif head[:4] == b'\x1a\x45\xdf\xa3':
+            _check_webm(f, size)
+        elif head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            _check_wav(head, size)
+        elif kind in ('mp4', 'm4a', 'mov', 'webm', 'wav'):
+            metrics.count('integrity_checks_total', result='bad_container')
+            raise IntegrityError(f"{path} is not a {kind} file")
+    metrics.count('integrity_checks_total', result='ok')
+
+
+def _check_mp4(f, size):
+    """Top-level boxes must tile the file exactly and include moov and media data"""
+    pos = 0
+    seen = set()
+    while pos < size:
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            _bad(f"MP4 box header at {pos} is cut off")
+        box_size, box_type = struct.unpack('>I4s', header[:8])
+        if box_size == 1 and len(header) == 16:
+            box_size = struct.unpack('>Q', header[8:])[0]
+        elif box_size == 0:
+            box_size = size - pos  # runs to the end of the file
+        if box_size < 8 or pos + box_size > size:
+            _bad(f"MP4 box {box_type!r} at {pos} runs past the end of the file")
+        seen.add(box_type)
+        pos += box_size
+    if b'moov' not in seen:
+        _bad("MP4 has no moov box")
+    if b'mdat' not in seen:
+        _bad("MP4 has no mdat box")
+
+
+def _read_vint(f):
+    """An EBML variable-length integer: (value, its length, whether it is the 'unknown' marker)"""
+    first = f.read(1)
+    if not first:
+        _bad("EBML header is cut off")
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first[0] & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        _bad("Invalid EBML length")
+    rest = f.read(length - 1)
+    if len(rest) < length - 1:
+        _bad("EBML header is cut off")
+    value = first[0] & (mask - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    return value, length, value == (1 << (7 * length)) - 1
+
+
+def _check_webm(f, size):
+    """EBML header with a webm/matroska DocType, then a Segment that fits in the file"""
+    f.seek(4)
+    header_size, _, _ = _read_vint(f)
+    header = f.read(header_size)
+    if len(header) < header_size:
+        _bad("EBML header is cut off")
+    if b'\x42\x82' not in header or not (b'webm' in header or b'matroska' in header):
+        _bad("EBML header has no webm or matroska DocType")
+    if f.read(4) != b'\x18\x53\x80\x67':
+        _bad("WebM has no Segment after its EBML header")
+    segment_size, _, unknown = _read_vint(f)
+    if not unknown and f.tell() + segment_size > size:
+        _bad(f"WebM Segment needs {f.tell() + segment_size} bytes, file has {size}")
+
+
+def _check_wav(head, size):
+    riff_size = struct.unpack('<I', head[4:8])[0]
+    if 8 + riff_size > size:
+        _bad(f"WAV needs {8 + riff_size} bytes, file has {size}")
+
+
+def _bad(message):
+    metrics.count('integrity_checks_total', result='bad_container')
+    raise IntegrityError(message)
@@ -0,0 +1,450 @@
+"""Durable download jobs shared by worker processes on one machine.
+
+    queue = JobQueue("youtube_downloads")     # youtube_downloads/.store/jobs.sqlite
+    job_id = queue.submit(url, itag=137)
+    queue.get(job_id)                         # {'status': 'running', 'bytes_done': ..., ...}
+
+    python jobqueue.py worker -o youtube_downloads --jobs 2      # as many as you like
+    python jobqueue.py submit -o youtube_downloads <url> --rule "best audio"
+    python jobqueue.py status -o youtube_downloads
+
+The queue is a SQLite database inside the download folder's store, shared
+by the front ends and workers without any broker. SQLite's locking can't
+be trusted on network filesystems (NFS, SMB), which would let two workers
+claim the same job or corrupt the database, so the queue only serves
+processes on one machine: the host using it is recorded, and opening it
+from another host raises QueueHostError until the first has been quiet
+for HOST_TAKEOVER_SECONDS (the folder was moved, say). A worker claims a
+job with a lease and renews it by heartbeats that also carry the job's
+progress. When a
+worker stops heartbeating (it crashed, was killed or lost its node) the
+job is claimed again once the lease runs out and continues from the
+partial download left behind; failed jobs are retried after a backoff,
+up to max_attempts, unless retrying can't help (PermanentJobError).
+Cancelling sets a flag the worker acts on at its next heartbeat.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from bandwidth import INTERACTIVE, PRIORITIES
+from metrics import METRICS_PORT, metrics, start_metrics_server
+from store import STORE_DIRNAME
+
+QUEUE_NAME = "jobs.sqlite"
+# A job whose worker hasn't heartbeated for this long is given to another
+LEASE_SECONDS = float(os.environ.get("YTDL_JOB_LEASE", "30"))
+HEARTBEAT_SECONDS = LEASE_SECONDS / 6
+MAX_ATTEMPTS = 3
+# A failed job waits attempts * RETRY_DELAY seconds before it is tried again
+RETRY_DELAY = 10
+# How often an idle worker looks for new jobs
+POLL_SECONDS = 1.0
+WORKER_JOBS = 2
+# Finished jobs are deleted this long after they finished
+JOB_TTL = 7 * 24 * 3600
+# Another machine may take the queue over once its host has been quiet this long
+HOST_TAKEOVER_SECONDS = max(2 * LEASE_SECONDS, 60)
+FINISHED = ('done', 'failed', 'cancelled')
+
+
+class PermanentJobError(Exception):
+    """A job that would fail the same way however often it is retried (no such format, say)"""
+
+
+class QueueHostError(Exception):
+    """The queue is in use by another machine"""
+
+
+class JobQueue:
+    """Jobs in a SQLite database that the processes of one machine share"""
+
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+        self.host = socket.gethostname()
+        root = os.path.join(download_dir, STORE_DIRNAME)
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        # Autocommit; every write is an explicit BEGIN IMMEDIATE so claims can't race
+        self._db = sqlite3.connect(os.path.join(root, QUEUE_NAME), timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, url TEXT, spec TEXT, status TEXT, priority INTEGER,"
+                " attempts INTEGER DEFAULT 0, max_attempts INTEGER, worker TEXT, lease_until REAL,"
+                " not_before REAL DEFAULT 0, cancel_requested INTEGER DEFAULT 0,"
+                " title TEXT, total INTEGER DEFAULT 0, bytes_done INTEGER DEFAULT 0,"
+                " file_name TEXT, error TEXT, created REAL, updated REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, priority, created)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._check_host(db)
+
+    def _check_host(self, db):
+        """Refuse a queue another machine has used recently; record this one's use"""
+        now = time.time()
+        row = db.execute("SELECT value FROM meta WHERE key = 'host'").fetchone()
+        if row is not None:
+            host, seen = json.loads(row[0])
+            if host != self.host and now - seen < HOST_TAKEOVER_SECONDS:
+                raise QueueHostError(
+                    f"The job queue in {self.download_dir} is in use by {host}; SQLite's locking isn't reliable"
+                    f" across machines, so only processes on {host} may use it")
+            if host == self.host and now - seen < HOST_TAKEOVER_SECONDS / 4:
+                return
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('host', ?)", (json.dumps([self.host, now]),))
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def submit(self, url, itag=None, rule=None, merge=False, ae_compatible=False, audio_itag=None,
+               transcode=None, priority=INTERACTIVE, max_attempts=MAX_ATTEMPTS):
+        """Queue a download; returns its job ID.
+
+        Takes an itag or a format rule; merge=True merges the video (itag, or
+        the best) with the best audio (or audio_itag) like Best Quality, and
+        transcode names a transcode.py profile for single-stream jobs.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+        if itag is None and rule is None and not merge:
+            raise ValueError("A job needs an itag, a format rule or merge=True")
+        spec = {'itag': itag, 'rule': rule, 'merge': merge, 'ae_compatible': ae_compatible,
+                'audio_itag': audio_itag, 'transcode': transcode, 'priority': priority}
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._transaction() as db:
+            self._check_host(db)
+            db.execute("DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated < ?", (*FINISHED, now - JOB_TTL))
+            db.execute("INSERT INTO jobs (id, url, spec, status, priority, max_attempts, created, updated)"
+                       " VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                       (job_id, url, json.dumps(spec), PRIORITIES.index(priority), max_attempts, now, now))
+        metrics.count('queue_jobs_total', event='submitted')
+        return job_id
+
+    def get(self, job_id):
+        """The job as a dict, or None"""
+        with self._lock:
+            row = self._db.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _to_dict(row) if row else None
+
+    def jobs(self, limit=100):
+        """The most recent jobs, newest first"""
+        with self._lock:
+            rows = self._db.execute(f"SELECT {_COLUMNS} FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [_to_dict(row) for row in rows]
+
+    def cancel(self, job_id):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status = 'queued'",
+                       (time.time(), job_id))
+            db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+
+    # --- Worker side ---
+
+    def claim(self, worker_id, lease=LEASE_SECONDS):
+        """Lease the next runnable job to worker_id; returns its dict (with 'spec') or None"""
+        now = time.time()
+        with self._transaction() as db:
+            self._check_host(db)
+            # Jobs whose worker went quiet go back in line, or fail once out of attempts
+            for job_id, attempts, max_attempts, worker in db.execute(
+                    "SELECT id, attempts, max_attempts, worker FROM jobs WHERE status = 'running' AND lease_until < ?",
+                    (now,)).fetchall():
+                if attempts >= max_attempts:
+                    db.execute("UPDATE jobs SET status = 'failed', error = ?, worker = NULL, updated = ? WHERE id = ?",
+                               (f"Worker {worker} stopped responding", now, job_id))
+                else:
+                    db.execute("UPDATE jobs SET status = 'queued', worker = NULL, updated = ? WHERE id = ?",
+                               (now, job_id))
+                metrics.count('queue_jobs_total', event='lease_expired')
+            row = db.execute(f"SELECT {_COLUMNS} FROM jobs WHERE status = 'queued' AND not_before <= ?"
+                             " ORDER BY priority, created LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1,"
+                       " error = NULL, updated = ? WHERE id = ?", (worker_id, now + lease, now, row[0]))
+        job = _to_dict(row)
+        job.update(status='running', worker=worker_id, attempts=job['attempts'] + 1)
+        metrics.count('queue_jobs_total', event='claimed')
+        return job
+
+    def heartbeat(self, job_id, worker_id, title=None, total=0, bytes_done=0, lease=LEASE_SECONDS):
+        """Renew the lease and record progress; False once the worker should stop
+        (the job was cancelled or the lease was lost to another worker)"""
+        now = time.time()
+        with self._transaction() as db:
+            self._check_host(db)
+            updated = db.execute(
+                "UPDATE jobs SET lease_until = ?, title = ?, total = ?, bytes_done = ?, updated = ?"
+                " WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + lease, title, total, bytes_done, now, job_id, worker_id)).rowcount
+            cancelled = db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(updated) and not (cancelled and cancelled[0])
+
+    def finish(self, job_id, worker_id, status, file_name=None, error=None, retry=False,
+               title=None, total=0, bytes_done=0):
+        """Record the outcome of a claimed job and its final progress; a failure
+        with retry goes back in line while attempts remain. No-op for a worker
+        that lost its lease."""
+        now = time.time()
+        if status == 'done':
+            bytes_done = max(bytes_done, total)
+        with self._transaction() as db:
+            row = db.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? AND status = 'running'",
+                             (job_id, worker_id)).fetchone()
+            if row is None:
+                return
+            attempts, max_attempts = row
+            if status == 'failed' and retry and attempts < max_attempts:
+                db.execute("UPDATE jobs SET status = 'queued', worker = NULL, error = ?, not_before = ?,"
+                           " title = ?, total = ?, bytes_done = ?, updated = ? WHERE id = ?",
+                           (error, now + RETRY_DELAY * attempts, title, total, bytes_done, now, job_id))
+                status = 'retrying'
+            else:
+                db.execute("UPDATE jobs SET status = ?, file_name = ?, error = ?, worker = NULL,"
+                           " title = ?, total = ?, bytes_done = ?, updated = ? WHERE id = ?",
+                           (status, file_name, error, title, total, bytes_done, now, job_id))
+        metrics.count('queue_jobs_total', event=status)
+
+    def release(self, job_id, worker_id):
+        """Hand a claimed job back without counting the attempt (worker shutting down)"""
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET status = 'queued', worker = NULL, attempts = attempts - 1, updated = ?"
+                       " WHERE id = ? AND worker = ? AND status = 'running'", (time.time(), job_id, worker_id))
+
+
+_COLUMNS = ("id, url, spec, status, attempts, max_attempts, worker, title, total, bytes_done, file_name, error,"
+            " cancel_requested, created, updated")
+
+
+def _to_dict(row):
+    (job_id, url, spec, status, attempts, max_attempts, worker, title, total, bytes_done, file_name, error,
+     cancel_requested, created, updated) = row
+    return {'id': job_id, 'url': url, 'spec': json.loads(spec), 'status': status, 'attempts': attempts,
+            'max_attempts': max_attempts, 'worker': worker, 'title': title, 'total_bytes': total,
+            'bytes_done': bytes_done, 'file_name': file_name, 'error': error,
+            'cancel_requested': bool(cancel_requested), 'created': created, 'updated': updated}
+
+
+class Worker:
+    """Claims jobs from the download folder's JobQueue and runs `jobs` of them at a time"""
+
+    def __init__(self, download_dir, jobs=WORKER_JOBS, worker_id=None, log=print):
+        self.download_dir = download_dir
+        self.queue = JobQueue(download_dir)
+        self.jobs = jobs
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.log = log
+        self._stopping = threading.Event()
+        self._threads = []
+        self._controls = set()  # of the jobs running now
+
+    def run(self, until_idle=False):
+        """Work until stop() (or, with until_idle, until the queue has nothing runnable)"""
+        self._threads = [threading.Thread(target=self._loop, args=(until_idle,), daemon=True)
+                         for _ in range(self.jobs)]
+        for t in self._threads:
+            t.start()
+        self.join()
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in self._threads:
+            while t.is_alive() and (deadline is None or time.monotonic() < deadline):
+                t.join(0.5)  # wakes up for KeyboardInterrupt
+
+    def stop(self):
+        """Cancel the running downloads and hand their jobs back to the queue,
+        keeping their partial files for whichever worker claims them next"""
+        self._stopping.set()
+        for control in list(self._controls):
+            control.cancel(keep_partial=True)
+
+    def _loop(self, until_idle):
+        while not self._stopping.is_set():
+            job = self.queue.claim(self.worker_id)
+            if job is None:
+                if until_idle:
+                    return
+                self._stopping.wait(POLL_SECONDS)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        from segmented import DownloadCancelled, DownloadControl
+
+        control = DownloadControl(job['spec']['priority'])
+        progress = {'title': None, 'total': 0, 'bytes_done': 0}
+        finished = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(HEARTBEAT_SECONDS):
+                try:
+                    alive = self.queue.heartbeat(job['id'], self.worker_id, **progress)
+                except QueueHostError:
+                    alive = False  # another machine took the queue over; the lease is long gone
+                if not alive:
+                    # A lost lease leaves the partial file to the job's new worker;
+                    # a cancel the user asked for removes it
+                    current = self.queue.get(job['id'])
+                    control.cancel(keep_partial=not (current and current['cancel_requested']))
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        self._controls.add(control)
+        self.log(f"{self.worker_id}: {job['id']} {job['url']} (attempt {job['attempts']})")
+        try:
+            file_name = run_job(job, self.download_dir, control, progress)
+            self.queue.finish(job['id'], self.worker_id, 'done', file_name=file_name, **progress)
+        except DownloadCancelled:
+            if self._stopping.is_set():
+                self.queue.release(job['id'], self.worker_id)
+            else:
+                self.queue.finish(job['id'], self.worker_id, 'cancelled', **progress)
+        except Exception as e:
+            self.log(f"{self.worker_id}: {job['id']} failed: {e}")
+            self.queue.finish(job['id'], self.worker_id, 'failed', error=str(e),
+                              retry=not isinstance(e, PermanentJobError), **progress)
+        finally:
+            finished.set()
+            self._controls.discard(control)
+
+
+def run_job(job, download_dir, control, progress):
+    """Download one claimed job into download_dir; returns the file name.
+    Fills progress with the title, total and bytes done as it goes."""
+    from commons import download_selected_stream, get_available_streams, select_stream
+    from mux import download_best_quality, pick_best_pair
+    from transcode import download_and_transcode
+
+    spec = job['spec']
+    streams, progress['title'] = get_available_streams(job['url'])
+    by_itag = {s.itag: s for s in streams.all_streams()}
+
+    def on_progress(stream, chunk, bytes_remaining):
+        progress['bytes_done'] = progress['total'] - bytes_remaining
+
+    if spec.get('merge'):
+        video, audio = pick_best_pair(streams, spec.get('ae_compatible'))
+        video = by_itag.get(spec['itag'], video) if spec.get('itag') is not None else video
+        audio = by_itag.get(spec['audio_itag'], audio) if spec.get('audio_itag') is not None else audio
+        if video is None or audio is None:
+            raise PermanentJobError("No video-only and audio-only streams to merge")
+        progress['total'] = (video.filesize or 0) + (audio.filesize or 0)
+        _, file_name = download_best_quality(video, audio, progress['title'], download_dir,
+                                             ae_compatible=spec.get('ae_compatible'), on_progress=on_progress,
+                                             control=control)
+        return file_name
+
+    stream = by_itag.get(spec['itag']) if spec.get('itag') is not None else select_stream(streams, spec.get('rule'))
+    if stream is None:
+        raise PermanentJobError(f"No stream matching {spec.get('itag') or spec.get('rule')!r}")
+    progress['total'] = stream.filesize or 0
+    if spec.get('transcode'):
+        _, file_name = download_and_transcode(stream, progress['title'], download_dir, spec['transcode'],
+                                              on_progress=on_progress, control=control)
+    else:
+        _, file_name = download_selected_stream(stream, progress['title'], download_dir,
+                                                on_progress=on_progress, control=control)
+    return file_name
+
+
+def wait_for_job(queue, job_id, on_update=None, poll=0.5, should_cancel=None):
+    """Poll a job until it finishes; returns its final dict.
+
+    on_update(job) is called after every poll; should_cancel() returning
+    True cancels the job (once) and keeps waiting for the worker to stop.
+    """
+    cancel_sent = False
+    while True:
+        job = queue.get(job_id)
+        if job is None:
+            raise Exception(f"Job {job_id} disappeared from the queue")
+        if on_update:
+            on_update(job)
+        if job['status'] in FINISHED:
+            return job
+        if should_cancel and not cancel_sent and should_cancel():
+            queue.cancel(job_id)
+            cancel_sent = True
+        time.sleep(poll)
+
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-o', '--download-dir', default="youtube_downloads",
+                        help="Download folder; its queue, store and files are shared by every worker")
+    parser = argparse.ArgumentParser(description="Queue downloads and run workers for them.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    worker = commands.add_parser('worker', parents=[common], help="Claim and download jobs until interrupted")
+    worker.add_argument('-j', '--jobs', type=int, default=WORKER_JOBS, help="Jobs run at once by this worker")
+    worker.add_argument('--id', help="Worker name (default: host-pid)")
+    worker.add_argument('--until-idle', action='store_true', help="Exit once no job is runnable")
+    worker.add_argument('--metrics-port', default=METRICS_PORT, help="Serve Prometheus metrics on this port")
+
+    submit = commands.add_parser('submit', parents=[common], help="Queue a download and print its job ID")
+    submit.add_argument('url')
+    submit.add_argument('--itag', type=int)
+    submit.add_argument('--rule', default="best progressive", help='Format rule, e.g. "best audio"')
+    submit.add_argument('--merge', action='store_true', help="Merge the best video and audio (needs ffmpeg)")
+    submit.add_argument('--ae-compatible', action='store_true')
+    submit.add_argument('--transcode', help="Transcode profile: h264 or prores")
+    submit.add_argument('--priority', choices=PRIORITIES, default=INTERACTIVE)
+    submit.add_argument('--wait', action='store_true', help="Wait for the job and print its final state")
+
+    status = commands.add_parser('status', parents=[common], help="Print one job, or the most recent ones, as JSON")
+    status.add_argument('job_id', nargs='?')
+
+    cancel = commands.add_parser('cancel', parents=[common], help="Cancel a job")
+    cancel.add_argument('job_id')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        start_metrics_server(args.metrics_port)
+        runner = Worker(args.download_dir, args.jobs, args.id, log=lambda msg: print(msg, file=sys.stderr))
+        try:
+            runner.run(until_idle=args.until_idle)
+        except KeyboardInterrupt:
+            runner.stop()
+            runner.join(timeout=10)
+        return 0
+
+    queue = JobQueue(args.download_dir)
+    if args.command == 'submit':
+        job_id = queue.submit(args.url, itag=args.itag, rule=None if args.itag is not None else args.rule,
+                              merge=args.merge, ae_compatible=args.ae_compatible, transcode=args.transcode,
+                              priority=args.priority)
+        if not args.wait:
+            print(job_id)
+            return 0
+        job = wait_for_job(queue, job_id)
+        print(json.dumps(job, indent=2))
+        return 0 if job['status'] == 'done' else 1
+    if args.command == 'cancel':
+        queue.cancel(args.job_id)
+        return 0
+    print(json.dumps(queue.get(args.job_id) if args.job_id else queue.jobs(), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # transcode workers re-run a frozen executable
+    sys.exit(main())
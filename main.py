@@ -1,20 +1,131 @@
+import multiprocessing
+
+if __name__ == '__main__':
+    # Streamlit runs this script as __main__. Transcode workers are spawned
+    # processes; in a frozen (PyInstaller) build they start this executable
+    # again and must stop here, before the app starts a second time
+    multiprocessing.freeze_support()
+
 import streamlit as st
-from pytubefix import YouTube
 import os
+import threading
 from commons import (
     get_available_streams,
     download_selected_stream,
-    cleanup_video
+    prewarm,
+    watch_url,
 )
+from file_server import FILE_SERVER_PORT, FileServer
+from jobqueue import JobQueue, wait_for_job
+from mux import download_best_quality, pick_best_audio
+from prefetch import Prefetcher
+from retention import start_retention
+from store import get_store
+from transcode import download_and_transcode
 # Create a dedicated downloads folder
 DOWNLOAD_FOLDER = "youtube_downloads"
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
+# 'stream' serves prepared files from disk through the file server;
+# 'inline' hands them to st.download_button (bytes held in server memory)
+DELIVERY_MODE = os.environ.get("YTDL_DELIVERY_MODE", "stream")
+# Public base URL of the file server if it sits behind a proxy, e.g. https://host/dl
+FILE_SERVER_URL = os.environ.get("YTDL_FILE_SERVER_URL")
+# Largest file handed to st.download_button when the file server can't be
+# linked; Streamlit holds the whole file in memory while it is offered
+INLINE_MAX_BYTES = int(os.environ.get("YTDL_INLINE_MAX_MB", "200")) * 1024 * 1024
+LOOPBACK_HOSTS = ('localhost', '127.0.0.1', '[::1]', '::1')
+# 'inline' downloads in this Streamlit process; 'queue' hands jobs to
+# `jobqueue.py worker` processes (on any machine) sharing DOWNLOAD_FOLDER
+DOWNLOAD_MODE = os.environ.get("YTDL_DOWNLOAD_MODE", "inline")
+# Label shown in the UI -> transcode profile (see transcode.py)
+TRANSCODE_OPTIONS = {"Keep original format": None, "H.264/AAC (MP4)": 'h264', "ProRes/WAV (MOV)": 'prores'}
+
+
+@st.cache_resource
+def get_file_server():
+    """One file server per Streamlit process, shared by all sessions"""
+    return FileServer().start()
+
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(DOWNLOAD_FOLDER)
+
+
+def run_queued(url, **job):
+    """Submit a job to the workers and show its progress until it finishes"""
+    queue = get_job_queue()
+    job_id = queue.submit(url, **job)
+    bar = st.progress(0.0, text="Waiting for a worker...")
+
+    def show(remote):
+        if remote['status'] == 'running' and remote['total_bytes']:
+            bar.progress(min(remote['bytes_done'] / remote['total_bytes'], 1.0),
+                         text=f"Downloading on {remote['worker']}")
+
+    remote = wait_for_job(queue, job_id, on_update=show)
+    bar.empty()
+    if remote['status'] != 'done':
+        raise Exception(remote['error'] or f"Job {remote['status']}")
+    return os.path.join(DOWNLOAD_FOLDER, remote['file_name']), remote['file_name']
+
+
+def file_server_base_url(server):
+    """Base URL the browser can reach the file server on, or None if it can't"""
+    if FILE_SERVER_URL:
+        return FILE_SERVER_URL
+    headers = st.context.headers
+    if (headers.get('X-Forwarded-Proto') == 'https' or headers.get('Origin', '').startswith('https:')
+            or headers.get('X-Forwarded-Host') or headers.get('X-Forwarded-For')):
+        # Behind a proxy: a plain http://host:port link would be blocked or unreachable
+        return None
+    # Reach the file server on the same host the browser used for Streamlit
+    host = headers.get('Host', 'localhost').rsplit(':', 1)[0]
+    if server.host in LOOPBACK_HOSTS and host not in LOOPBACK_HOSTS:
+        return None  # listening on loopback only, the browser is elsewhere
+    return f"http://{host}:{server.port}"
+
+file_server = get_file_server() if DELIVERY_MODE == 'stream' else None
+
+
+@st.cache_resource
+def get_retention():
+    """Background quota/expiry cleanup of the download folder, one per Streamlit process"""
+    # Files queued by the old cleanup_list.txt scheme expire like any other
+    # delivered file. The list is left alone, so this only adds what isn't indexed yet
+    if os.path.exists('cleanup_list.txt'):
+        store = get_store(DOWNLOAD_FOLDER)
+        tracked = {path for path, _, _ in store.files()}
+        with open('cleanup_list.txt', 'r') as f:
+            for line in f:
+                path = line.strip()
+                if path and os.path.abspath(path) not in tracked and os.path.exists(path):
+                    store.track_file(path)
+    return start_retention(DOWNLOAD_FOLDER, in_use=file_server.is_serving if file_server else None)
+
+get_retention()
+
+
+@st.cache_resource
+def start_prewarm():
+    """Load pytubefix and connect to YouTube while the first visitor types a URL"""
+    thread = threading.Thread(target=prewarm, daemon=True)
+    thread.start()
+    return thread
+
+start_prewarm()
+
 
 st.title('YouTube Video Downloader')
 st.write("Version: 2.0")
 url = st.text_input('Enter YouTube URL:')
+# Look the formats up while the user reaches for the button. Each session
+# gets its own prefetcher so one visitor's typing can't cancel another's lookup
+if 'prefetcher' not in st.session_state:
+    st.session_state.prefetcher = Prefetcher()
+st.session_state.prefetcher.hint(url.strip())
 
 if 'streams' not in st.session_state:
     st.session_state.streams = None
@@ -36,53 +147,69 @@ if st.session_state.streams:
     st.subheader("Available Formats")
     
     format_type = st.radio("Select format type:", 
-                         ['Progressive (Video+Audio)', 'Video Only', 'Audio Only'],
+                         ['Progressive (Video+Audio)', 'Video Only', 'Audio Only', 'Best Quality (Video+Audio merged)'],
                          index=0)
+    ae_output = False
     
-    stream_list = []
+    category = None
     if format_type == 'Progressive (Video+Audio)':
-        stream_list = st.session_state.streams['progressive']
+        category = 'progressive'
     elif format_type == 'Video Only':
-        stream_list = st.session_state.streams['video']
+        category = 'video'
     elif format_type == 'Audio Only':
-        stream_list = st.session_state.streams['audio']
-    
-    if len(stream_list) > 0:
-        sorted_streams = sorted(stream_list, 
-                              key=lambda s: (
-                                  int(s.resolution[:-1]) 
-                                  if s.resolution and s.resolution.endswith('p') 
-                                  else int(s.abr[:-4]) if s.abr and s.abr.endswith('kbps') 
-                                  else 0
-                              ), 
-                              reverse=True)
-        
+        category = 'audio'
+    elif format_type == 'Best Quality (Video+Audio merged)':
+        # Pick the video; the best matching audio is merged in with ffmpeg
+        category = 'video'
+        ae_output = st.checkbox("After Effects compatible output (H.264/AAC)")
+    transcode = None
+    if format_type != 'Best Quality (Video+Audio merged)':
+        # Encoded while downloading, on a pool of worker processes
+        transcode = TRANSCODE_OPTIONS[st.selectbox("Transcode for After Effects:", list(TRANSCODE_OPTIONS))]
+
+    # Ordered best first when fetched; the label index is built once and reused on reruns
+    stream_options = st.session_state.streams.options(category)
+    if stream_options:
         selected = st.selectbox(
             "Select quality:",
-            options=[f"{s.resolution or s.abr} ({s.mime_type})" for s in sorted_streams],
+            options=list(stream_options),
             index=0
         )
         
-        selected_stream = sorted_streams[[f"{s.resolution or s.abr} ({s.mime_type})" for s in sorted_streams].index(selected)]
+        selected_stream = stream_options[selected]
         
         if st.button('Prepare Selected Format'):
             try:
                 with st.spinner('Preparing for download...'):
-                    file_path, file_name = download_selected_stream(selected_stream, st.session_state.video_title, DOWNLOAD_FOLDER)
+                    if format_type == 'Best Quality (Video+Audio merged)':
+                        audio_stream = pick_best_audio(st.session_state.streams, ae_output)
+                        if audio_stream is None:
+                            raise Exception("No audio stream available to merge")
+                        if DOWNLOAD_MODE == 'queue':
+                            file_path, file_name = run_queued(
+                                watch_url(selected_stream.video_id), itag=selected_stream.itag, merge=True,
+                                audio_itag=audio_stream.itag, ae_compatible=ae_output)
+                        else:
+                            file_path, file_name = download_best_quality(
+                                selected_stream, audio_stream, st.session_state.video_title, DOWNLOAD_FOLDER,
+                                ae_compatible=ae_output)
+                    elif DOWNLOAD_MODE == 'queue':
+                        file_path, file_name = run_queued(watch_url(selected_stream.video_id),
+                                                          itag=selected_stream.itag, transcode=transcode)
+                    elif transcode:
+                        file_path, file_name = download_and_transcode(
+                            selected_stream, st.session_state.video_title, DOWNLOAD_FOLDER, transcode)
+                    else:
+                        file_path, file_name = download_selected_stream(selected_stream, st.session_state.video_title, DOWNLOAD_FOLDER)
                 
                 if file_path and os.path.exists(file_path):
                     st.session_state.download_ready = True
-                    st.session_state.file_data = open(file_path, 'rb').read()
+                    # Keep only the path in the session; the bytes stay on disk
+                    st.session_state.file_path = file_path
                     st.session_state.file_name = file_name
+                    if file_server:
+                        st.session_state.download_token = file_server.register(file_path, file_name)
                     st.success('Download ready! Click the download button below.')
-                    
-                    # Schedule cleanup for next session
-                    if not os.path.exists('cleanup_list.txt'):
-                        with open('cleanup_list.txt', 'w') as f:
-                            f.write(file_path + '\n')
-                    else:
-                        with open('cleanup_list.txt', 'a') as f:
-                            f.write(file_path + '\n')
             except Exception as e:
                 st.error(f'Error: {str(e)}')
     else:
@@ -91,33 +218,24 @@ if st.session_state.streams:
 
 # Display download button if ready
 if st.session_state.get('download_ready'):
-    st.download_button(
-        label='Click to Download',
-        data=st.session_state.file_data,
-        file_name=st.session_state.file_name,
-        mime='video/mp4',
-        key='persistent_download'
-    )
-
-# Check for files that need cleanup from previous sessions
-if os.path.exists('cleanup_list.txt'):
-    try:
-        with open('cleanup_list.txt', 'r') as f:
-            files_to_cleanup = f.readlines()
-        
-        cleaned_files = []
-        for file_path in files_to_cleanup:
-            file_path = file_path.strip()
-            if file_path and os.path.exists(file_path):
-                cleanup_video(file_path)
-                cleaned_files.append(file_path)
-        
-        # Update cleanup list
-        if cleaned_files:
-            with open('cleanup_list.txt', 'w') as f:
-                for file_path in files_to_cleanup:
-                    if file_path.strip() not in cleaned_files:
-                        f.write(file_path)
-    except Exception as e:
-        st.warning(f"Could not perform cleanup: {str(e)}")
-        pass
\ No newline at end of file
+    # Keeps the file from expiring while this session still shows it
+    get_store(DOWNLOAD_FOLDER).touch(st.session_state.file_path)
+    base_url = file_server_base_url(file_server) if file_server else None
+    if base_url:
+        st.link_button('Click to Download', file_server.url_for(st.session_state.download_token, base_url))
+    elif not os.path.exists(st.session_state.file_path):
+        st.warning("The prepared file has expired. Please prepare it again.")
+    elif os.path.getsize(st.session_state.file_path) > INLINE_MAX_BYTES:
+        # Streamlit can only offer it from memory; the file server is the way for big files
+        port = file_server.port if file_server else FILE_SERVER_PORT
+        st.error(f"This file is too large to download through Streamlit. Set YTDL_FILE_SERVER_URL to the "
+                 f"public URL of the file server (port {port}) to download it from there.")
+    else:
+        with open(st.session_state.file_path, 'rb') as f:
+            st.download_button(
+                label='Click to Download',
+                data=f,
+                file_name=st.session_state.file_name,
+                mime='video/mp4',
+                key='persistent_download'
+            )
@@ -0,0 +1,400 @@
+"""Download and metadata instrumentation.
+
+    metrics.observe('resolve_seconds', 0.42, source='innertube')
+    metrics.count('retries_total', kind='url_refresh')
+    print(metrics.render())          # Prometheus text format
+
+Set YTDL_EVENT_LOG to a file path to also get one JSON line per event
+(written by a background thread; metrics.flush() waits for it), and
+YTDL_METRICS_PORT to serve /metrics from apps that have no file
+server (on loopback unless YTDL_METRICS_HOST says otherwise). Hooks such as CProfileHook can be attached to the next download
+with metrics.add_hook(hook, once=True).
+"""
+import atexit
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EVENT_LOG = os.environ.get("YTDL_EVENT_LOG")
+METRICS_PORT = os.environ.get("YTDL_METRICS_PORT")
+METRICS_HOST = os.environ.get("YTDL_METRICS_HOST", "127.0.0.1")
+METRICS_PREFIX = "ytdl_"
+PROFILE_DIR = "profiles"
+
+# Histogram bucket upper bounds per metric
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = tuple(int(mb * 1024 * 1024) for mb in (0.25, 0.5, 1, 2, 5, 10, 25, 50, 100))
+BUCKETS = {
+    'resolve_seconds': TIME_BUCKETS,
+    'ttfb_seconds': TIME_BUCKETS,
+    'download_seconds': TIME_BUCKETS + (120, 300, 600, 1800),
+    'download_bytes_per_second': THROUGHPUT_BUCKETS,
+}
+HELP = {
+    'resolve_seconds': "Time to resolve a video's formats",
+    'ttfb_seconds': "Time from starting a download to its first byte",
+    'download_seconds': "Wall time of completed downloads",
+    'download_bytes_per_second': "Average throughput of completed downloads",
+    'downloads_total': "Downloads by outcome",
+    'bytes_written_total': "Bytes written to disk by downloads",
+    'retries_total': "Retries by kind",
+    'resolve_failures_total': "Failed format lookups",
+    'resolve_joined_total': "Lookups answered by one already in flight (e.g. a prefetch)",
+    'prefetch_total': "Speculative format lookups by outcome",
+    'transcodes_total': "Transcode jobs by profile and outcome",
+    'queue_jobs_total': "Job queue events (submitted, claimed, lease_expired, done, ...)",
+    'store_requests_total': "Content store lookups by result",
+    'store_lock_waits_total': "Downloads that waited for another process fetching the same stream",
+    'integrity_checks_total': "Length and container checks on finished downloads, by result",
+    'integrity_rehashed_bytes_total': "Bytes read back from disk because they couldn't be hashed while downloading",
+    'throttle_interventions_total': "Reactions to throttled connections by action",
+    'http_connections_refused_total': "Connections turned away with a 503 because the server was at YTDL_MAX_CONNECTIONS",
+    'bandwidth_wait_seconds_total': "Time downloads spent waiting on bandwidth limits, by priority",
+}
+SIZE_CLASSES = ((10 * 1024 ** 2, 'lt10M'), (100 * 1024 ** 2, 'lt100M'), (1024 ** 3, 'lt1G'))
+
+
+def size_class(size):
+    for limit, name in SIZE_CLASSES:
+        if size < limit:
+            return name
+    return 'ge1G'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class DownloadHook:
+    """Runs around one download; override start and finish.
+
+    Both are called on the thread running the download, and finish
+    may add entries to `info`, which ends up in the download event.
+    """
+
+    def start(self, info):
+        pass
+
+    def finish(self, info):
+        pass
+
+
+class CProfileHook(DownloadHook):
+    """cProfile a download and write a .prof file per download.
+
+    Downloads run on the shared engine loop, so anything else running
+    there at the same time shows up in the profile too. Since Python 3.12
+    cProfile sees every thread, including the segment writer and
+    asyncio.to_thread workers; on 3.11 threads started during the download
+    get a profiler of their own (pool threads that already existed are
+    missed). One download is profiled at a time: a hooked download that
+    starts meanwhile runs unprofiled, with `profile_skipped` in its event.
+    """
+
+    _active = threading.Lock()  # cProfile can't profile two downloads at once
+
+    def __init__(self, out_dir=PROFILE_DIR):
+        self.out_dir = out_dir
+        self._info = None     # the download being profiled
+        self._profile = None
+        self._threads = []    # profilers of threads started meanwhile (3.11)
+
+    def start(self, info):
+        if not CProfileHook._active.acquire(blocking=False):
+            info['profile_skipped'] = "another download is being profiled"
+            return
+        self._info, self._threads = info, []
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+
+    def _profile_thread(self, frame, event, arg):
+        # First profiling event in a new thread: hand the thread to cProfile
+        profile = cProfile.Profile()
+        self._threads.append(profile)
+        profile.enable()
+
+    def finish(self, info):
+        if info is not self._info:
+            return
+        try:
+            threading.setprofile(None)
+            self._profile.disable()
+            stats = pstats.Stats(self._profile)
+            for profile in self._threads:
+                # Takes a snapshot; a thread that outlives the download stops counting here
+                stats.add(profile)
+            os.makedirs(self.out_dir, exist_ok=True)
+            path = os.path.join(self.out_dir, f"{info.get('video_id')}_{info.get('itag')}_{int(time.time())}.prof")
+            stats.dump_stats(path)
+            info['profile'] = path
+        finally:
+            self._info = self._profile = None
+            self._threads = []
+            CProfileHook._active.release()
+
+
+class TracemallocHook(DownloadHook):
+    """Record peak traced memory and the top allocation sites of a download"""
+
+    def __init__(self, top=10):
+        self.top = top
+
+    def start(self, info):
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+
+    def finish(self, info):
+        _, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:self.top]
+        tracemalloc.stop()
+        info['tracemalloc_peak_bytes'] = peak
+        info['tracemalloc_top'] = [f"{s.traceback} {s.size}B" for s in stats]
+
+
+class DownloadTimer:
+    """Progress wrapper that notes the first byte and counts bytes"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_byte = None
+        self.bytes = 0
+
+    def wrap(self, on_progress):
+        def progress(stream, chunk, bytes_remaining):
+            if self.first_byte is None:
+                self.first_byte = time.monotonic()
+            self.bytes += len(chunk)
+            if on_progress:
+                on_progress(stream, chunk, bytes_remaining)
+        return progress
+
+
+class Metrics:
+    """Thread-safe counters and histograms plus the JSON-lines event log"""
+
+    def __init__(self, event_log=EVENT_LOG):
+        self.event_log = event_log
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._hooks = []       # [hook, once]
+        self._events = None    # lines for the event log writer thread
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(BUCKETS.get(name, TIME_BUCKETS))
+            histogram.observe(value)
+
+    def event(self, name, **fields):
+        """Append one JSON line to the event log, if there is one.
+
+        Never blocks on the disk: a writer thread keeps the file open and
+        writes whatever has queued up, so slow storage can't stall the
+        engine loop.
+        """
+        if not self.event_log:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), 'event': name, **fields}, default=str)
+        self._event_queue().put(line)
+
+    def flush(self, timeout=None):
+        """Wait until the events logged so far are written; False on timeout"""
+        if self._events is None:
+            return True
+        written = threading.Event()
+        self._events.put(written)
+        return written.wait(timeout)
+
+    def _event_queue(self):
+        with self._lock:
+            if self._events is None:
+                self._events = queue.SimpleQueue()
+                threading.Thread(target=self._write_events, args=(self.event_log, self._events),
+                                 name="metrics-events", daemon=True).start()
+                atexit.register(self.flush, 5)
+            return self._events
+
+    @staticmethod
+    def _write_events(path, events):
+        try:
+            f = open(path, 'a')
+        except OSError as e:
+            print(f"Event log {path} unavailable: {e}", file=sys.stderr)
+            f = None
+        while True:
+            item = events.get()
+            marker = isinstance(item, threading.Event)
+            try:
+                if f is not None and not marker:
+                    f.write(item + '\n')
+                # One flush for everything that queued up while writing
+                if f is not None and (marker or events.empty()):
+                    f.flush()
+            except OSError:
+                pass
+            if marker:
+                item.set()
+
+    def add_hook(self, hook, once=False):
+        """Run hook around every download, or only the next one with once=True"""
+        with self._lock:
+            self._hooks.append([hook, once])
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h[0] is not hook]
+
+    def _take_hooks(self):
+        with self._lock:
+            hooks = [hook for hook, _ in self._hooks]
+            self._hooks = [h for h in self._hooks if not h[1]]
+        return hooks
+
+    @contextmanager
+    def resolve(self, video_id):
+        """Time a format lookup; set info['source'] to label it"""
+        info = {'video_id': video_id, 'source': 'unknown'}
+        started = time.monotonic()
+        try:
+            yield info
+        except Exception as e:
+            self.count('resolve_failures_total')
+            self.event('resolve_failed', error=str(e), seconds=round(time.monotonic() - started, 3), **info)
+            raise
+        seconds = time.monotonic() - started
+        self.observe('resolve_seconds', seconds, source=info['source'])
+        self.event('resolve', seconds=round(seconds, 3), **info)
+
+    @contextmanager
+    def download(self, stream):
+        """Instrument one network download; yields a DownloadTimer to wrap progress with"""
+        from segmented import DownloadCancelled
+
+        info = {'video_id': getattr(stream, 'video_id', None), 'itag': stream.itag,
+                'filesize': stream.filesize or 0}
+        labels = {'itag': str(stream.itag), 'size_class': size_class(stream.filesize or 0)}
+        hooks = self._take_hooks()
+        for hook in hooks:
+            hook.start(info)
+        timer = DownloadTimer()
+        outcome = 'failed'
+        try:
+            yield timer
+            outcome = 'ok'
+        except DownloadCancelled:
+            outcome = 'cancelled'
+            raise
+        except Exception as e:
+            info['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            for hook in hooks:
+                try:
+                    hook.finish(info)
+                except Exception as e:
+                    info.setdefault('hook_errors', []).append(str(e))
+            seconds = time.monotonic() - timer.started
+            self.count('downloads_total', outcome=outcome, **labels)
+            self.count('bytes_written_total', timer.bytes, **labels)
+            if timer.first_byte is not None:
+                info['ttfb_seconds'] = round(timer.first_byte - timer.started, 3)
+                self.observe('ttfb_seconds', timer.first_byte - timer.started, **labels)
+            if outcome == 'ok' and seconds > 0:
+                self.observe('download_seconds', seconds, **labels)
+                self.observe('download_bytes_per_second', timer.bytes / seconds, **labels)
+            self.event('download', outcome=outcome, bytes=timer.bytes, seconds=round(seconds, 3), **info)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(h.counts), h.sum, h.count, h.buckets)) for k, h in self._histograms.items())
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {METRICS_PREFIX}{name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f"{METRICS_PREFIX}{name}{_labels(labels)} {value}")
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f"{METRICS_PREFIX}{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{METRICS_PREFIX}{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{METRICS_PREFIX}{name}_count{_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+# Shared by commons, the engine and every front end in this process
+metrics = Metrics()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        send_metrics(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def send_metrics(handler):
+    body = metrics.render().encode()
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics on port from a daemon thread; does nothing if port is unset"""
+    if port is None or port == '':
+        return None
+    server = ThreadingHTTPServer((host, int(port)), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,205 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import uuid
+
+from async_engine import ordered_chunks, run_sync
+from commons import (
+    async_download_selected_stream,
+    async_refresh_stream_url,
+    cleanup_video,
+    stream_quality,
+)
+from integrity import check_container
+from metrics import metrics
+from segmented import DownloadCancelled, DownloadControl, throttle_threshold
+from store import get_store
+
+FFMPEG = os.environ.get("YTDL_FFMPEG") or shutil.which("ffmpeg")
+# Piping needs inherited file descriptors, which Windows subprocesses don't get
+CAN_PIPE = os.name == "posix"
+PIPE_CHUNK_SIZE = 4 * 1024 * 1024
+PIPE_LOOKAHEAD = 3
+
+
+def pick_best_pair(streams, ae_compatible=False):
+    """Best video-only and audio-only streams to merge, or (None, None).
+
+    For After Effects output H.264 video and AAC audio are preferred, since
+    those can be copied into the MP4 without re-encoding.
+    """
+    videos = streams.get('video', [])
+    audio = pick_best_audio(streams, ae_compatible)
+    if not videos or audio is None:
+        return None, None
+
+    def video_key(s):
+        preferred = ae_compatible and s.codec_family == 'h264'
+        return (stream_quality(s), preferred, s.filesize or 0)
+
+    return max(videos, key=video_key), audio
+
+
+def pick_best_audio(streams, ae_compatible=False):
+    """Audio-only stream to pair with a chosen video stream, or None"""
+    audios = streams.get('audio', [])
+    if not audios:
+        return None
+
+    def audio_key(s):
+        preferred = s.subtype == 'mp4'  # AAC copies into MP4 for every player and AE
+        return (preferred, stream_quality(s)) if ae_compatible else (stream_quality(s), preferred)
+
+    return max(audios, key=audio_key)
+
+
+def codec_args(video_stream, audio_stream, ae_compatible):
+    """ffmpeg codec options: copy where possible, H.264/AAC when AE needs it"""
+    if not ae_compatible:
+        return ['-c', 'copy']
+    args = []
+    if video_stream.codec_family == 'h264':
+        args += ['-c:v', 'copy']
+    else:
+        args += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-pix_fmt', 'yuv420p']
+    if audio_stream.codec_family == 'aac':
+        args += ['-c:a', 'copy']
+    else:
+        args += ['-c:a', 'aac', '-b:a', '192k']
+    return args
+
+
+async def _run_ffmpeg(inputs, video_stream, audio_stream, ae_compatible, out_path, pass_fds=()):
+    if not FFMPEG:
+        raise Exception("ffmpeg was not found. Install it or set YTDL_FFMPEG to its path.")
+    args = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-y']
+    for source in inputs:
+        args += ['-i', source]
+    args += ['-map', '0:v:0', '-map', '1:a:0', *codec_args(video_stream, audio_stream, ae_compatible),
+             '-movflags', '+faststart', '-f', 'mp4', out_path]
+    return await asyncio.create_subprocess_exec(
+        *args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, pass_fds=pass_fds)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+async def _feed(stream, fd, progress, control):
+    """Stream one input into an ffmpeg pipe, in order"""
+    try:
+        with metrics.download(stream) as timer:
+            on_chunk = timer.wrap(None)
+            async for chunk in ordered_chunks(stream, PIPE_CHUNK_SIZE, PIPE_LOOKAHEAD, on_stale=async_refresh_stream_url,
+                                              control=control, min_rate=throttle_threshold(stream)):
+                if control:
+                    # Waiting here stalls ffmpeg too, which is what pausing should do
+                    while control.paused and not control.cancelled.is_set():
+                        await asyncio.sleep(0.2)
+                    if control.cancelled.is_set():
+                        raise DownloadCancelled()
+                await asyncio.to_thread(_write_all, fd, chunk)
+                on_chunk(stream, chunk, 0)
+                progress(stream, chunk)
+    finally:
+        os.close(fd)
+
+
+async def _mux_streaming(video_stream, audio_stream, ae_compatible, out_path, progress, control):
+    video_r, video_w = os.pipe()
+    audio_r, audio_w = os.pipe()
+    try:
+        proc = await _run_ffmpeg([f'pipe:{video_r}', f'pipe:{audio_r}'], video_stream, audio_stream,
+                                 ae_compatible, out_path, pass_fds=(video_r, audio_r))
+    except BaseException:
+        for fd in (video_w, audio_w):
+            os.close(fd)
+        raise
+    finally:
+        os.close(video_r)
+        os.close(audio_r)
+
+    stderr = asyncio.ensure_future(proc.stderr.read())
+    feeds = asyncio.gather(_feed(video_stream, video_w, progress, control),
+                           _feed(audio_stream, audio_w, progress, control))
+    try:
+        await feeds
+    except BaseException as e:
+        feeds.cancel()
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        if isinstance(e, BrokenPipeError):
+            # ffmpeg quit early; its own message is more useful
+            raise Exception(f"ffmpeg failed: {(await stderr).decode(errors='replace').strip()}")
+        raise
+    if await proc.wait() != 0:
+        raise Exception(f"ffmpeg failed: {(await stderr).decode(errors='replace').strip()}")
+
+
+async def _mux_from_files(video_stream, audio_stream, ae_compatible, out_path, download_dir, progress, control):
+    def on_progress(stream, chunk, bytes_remaining):
+        progress(stream, chunk)
+
+    # Both downloads run at once, so wall time follows the slower one
+    (video_path, _), (audio_path, _) = await asyncio.gather(
+        async_download_selected_stream(video_stream, 'video', download_dir, on_progress=on_progress, control=control),
+        async_download_selected_stream(audio_stream, 'audio', download_dir, on_progress=on_progress, control=control),
+    )
+    try:
+        proc = await _run_ffmpeg([video_path, audio_path], video_stream, audio_stream, ae_compatible, out_path)
+        _, err = await proc.communicate()
+        if proc.returncode != 0:
+            raise Exception(f"ffmpeg failed: {err.decode(errors='replace').strip()}")
+    finally:
+        cleanup_video(video_path)
+        cleanup_video(audio_path)
+
+
+async def async_download_best_quality(video_stream, audio_stream, title, download_dir,
+                                      ae_compatible=False, on_progress=None, control=None):
+    """Fetch a video-only and an audio-only stream at the same time and merge them into one MP4
+
+    On POSIX both downloads are piped straight into ffmpeg, so no intermediate
+    files are written. Elsewhere they go to temporary files first. With
+    ae_compatible the output is H.264/AAC, re-encoding only what isn't already.
+    on_progress(stream, chunk, bytes_remaining) reports the combined remaining bytes.
+    """
+    # Both inputs share one control, so they count as one download for bandwidth sharing
+    control = control or DownloadControl()
+    unique_id = str(uuid.uuid4())[:8]
+    safe_title = "".join([c if c.isalnum() else "_" for c in title])
+    filename = f"{safe_title}_{unique_id}.mp4"
+    file_path = os.path.join(download_dir, filename)
+    tmp_path = file_path + '.muxing'
+
+    remaining = [(video_stream.filesize or 0) + (audio_stream.filesize or 0)]
+
+    def progress(stream, chunk):
+        remaining[0] -= len(chunk)
+        if on_progress:
+            on_progress(stream, chunk, remaining[0])
+
+    try:
+        if CAN_PIPE and video_stream.filesize and audio_stream.filesize:
+            await _mux_streaming(video_stream, audio_stream, ae_compatible, tmp_path, progress, control)
+        else:
+            await _mux_from_files(video_stream, audio_stream, ae_compatible, tmp_path, download_dir, progress, control)
+        # ffmpeg can exit 0 on a truncated input; don't hand out what it made of it
+        await asyncio.to_thread(check_container, tmp_path, 'mp4')
+        os.replace(tmp_path, file_path)
+        await asyncio.to_thread(lambda: get_store(download_dir).track_file(file_path))
+    except BaseException:
+        cleanup_video(tmp_path)
+        raise
+    return file_path, filename
+
+
+def download_best_quality(video_stream, audio_stream, title, download_dir,
+                          ae_compatible=False, on_progress=None, control=None):
+    """Merge the selected video-only and audio-only streams (blocking wrapper)"""
+    return run_sync(async_download_best_quality(video_stream, audio_stream, title, download_dir,
+                                                ae_compatible, on_progress, control))
@@ -0,0 +1,92 @@
+import json
+import os
+import time
+
+PARTIAL_SUFFIX = ".part"
+MANIFEST_SUFFIX = ".part.json"
+
+
+class PartialDownload:
+    """An in-progress download and its sidecar manifest.
+
+    The partial file is named after the video ID and itag, so a retry or an
+    app restart finds the same file. The manifest records which byte ranges
+    are already on disk:
+
+        {"video_id": ..., "itag": ..., "filesize": ..., "completed": [[0, 1048576], ...]}
+    """
+
+    def __init__(self, download_dir, video_id, itag, subtype, filesize):
+        self.video_id = video_id
+        self.itag = itag
+        self.filesize = filesize
+        base = os.path.join(download_dir, f"{video_id}_{itag}.{subtype}")
+        self.path = base + PARTIAL_SUFFIX
+        self.manifest_path = base + MANIFEST_SUFFIX
+
+    @classmethod
+    def for_stream(cls, stream, download_dir):
+        return cls(download_dir, stream.video_id, stream.itag, stream.subtype, stream.filesize)
+
+    def completed_ranges(self):
+        """Ranges recorded by a previous attempt, or [] if it can't be resumed"""
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return []
+        completed = [tuple(r) for r in manifest.get('completed', [])]
+        # Segmented downloads preallocate the file; ordered ones (transcode.py) grow it
+        size = os.path.getsize(self.path)
+        if (manifest.get('video_id') != self.video_id or manifest.get('itag') != self.itag
+                or manifest.get('filesize') != self.filesize
+                or size > self.filesize or any(end > size for _, end in completed)):
+            return []
+        return completed
+
+    def prefix(self):
+        """Bytes at the start of the file a previous attempt completed; the
+        file is cut back to them (and created if missing), so it can be
+        appended to and read while it grows"""
+        done = 0
+        for start, end in sorted(self.completed_ranges()):
+            if start > done:
+                break
+            done = max(done, end)
+        with open(self.path, 'ab') as f:
+            f.truncate(done)
+        self.save([(0, done)] if done else [])
+        return done
+
+    def save(self, completed):
+        manifest = {
+            'video_id': self.video_id,
+            'itag': self.itag,
+            'filesize': self.filesize,
+            'completed': [list(r) for r in completed],
+            'updated': time.time(),
+        }
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def promote(self, final_path):
+        """Atomically move the finished file into place and drop the manifest"""
+        os.replace(self.path, final_path)
+        self.discard_manifest()
+
+    def discard(self):
+        for path in (self.path, self.manifest_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def discard_manifest(self):
+        try:
+            os.remove(self.manifest_path)
+        except OSError:
+            pass
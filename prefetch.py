@@ -0,0 +1,76 @@
+"""Speculative format lookups, so "Show Available Formats" finds them done.
+
+    prefetcher.hint(url_entry.get())        # on every edit of the URL field
+    prefetcher.ahead(urls)                  # the next items of a queue or playlist
+
+Each URL field needs a Prefetcher of its own, since a hint cancels the
+previous one: Streamlit keeps one per session in st.session_state.
+
+Lookups run on the async engine and land in commons.stream_cache (a
+bounded LRU in memory, backed by disk). A real lookup for the same video
+joins one still in flight instead of starting over.
+"""
+import asyncio
+import threading
+
+from async_engine import engine
+from commons import async_get_available_streams, extract_video_id, watch_url
+from metrics import metrics
+
+# Wait this long after the last edit of the URL field before looking it up
+PREFETCH_DEBOUNCE_SECONDS = 0.3
+# Queue/playlist items resolved ahead of the one being worked on
+PREFETCH_AHEAD = 3
+
+
+class Prefetcher:
+    """Debounced lookups for the URL being typed, plus look-ahead for lists.
+
+    Only the latest hint matters: a new video ID cancels the lookup for
+    the previous one, whether it is still waiting out the debounce or
+    already on the network.
+    """
+
+    def __init__(self, debounce=PREFETCH_DEBOUNCE_SECONDS, ahead=PREFETCH_AHEAD):
+        self.debounce = debounce
+        self.ahead_count = ahead
+        self._lock = threading.Lock()
+        self._video_id = None
+        self._future = None
+
+    def hint(self, url):
+        """The URL field now reads `url`; safe to call on every keystroke from any thread"""
+        video_id = extract_video_id(url or '')
+        with self._lock:
+            if video_id == self._video_id:
+                return
+            if self._future is not None:
+                self._future.cancel()
+            self._video_id, self._future = video_id, None
+            if video_id is not None:
+                self._future = engine.submit(self._lookup(video_id, self.debounce))
+
+    def ahead(self, urls, count=None):
+        """Start lookups for the first `count` of urls without cancelling anything"""
+        return [engine.submit(self._lookup(extract_video_id(url), 0))
+                for url in list(urls)[:self.ahead_count if count is None else count]
+                if extract_video_id(url)]
+
+    @staticmethod
+    async def _lookup(video_id, delay):
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            await async_get_available_streams(watch_url(video_id))
+        except asyncio.CancelledError:
+            metrics.count('prefetch_total', outcome='cancelled')
+            raise
+        except Exception:
+            # Best effort: the real lookup will report the error
+            metrics.count('prefetch_total', outcome='failed')
+            return
+        metrics.count('prefetch_total', outcome='ok')
+
+
+# For front ends with a single URL field (the desktop app) and for look-ahead
+prefetcher = Prefetcher()
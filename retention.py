@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+
+from partial import MANIFEST_SUFFIX, PARTIAL_SUFFIX
+from store import get_store
+
+# Disk budget for a download folder: stored objects plus standalone files
+STORE_QUOTA_BYTES = int(float(os.environ.get("YTDL_STORE_QUOTA_GB", "10")) * 1024 ** 3)
+# Files handed to users are removed this long after their last access
+DELIVERED_TTL = int(os.environ.get("YTDL_DELIVERED_TTL", "3600"))
+# Partial downloads untouched for this long are treated as abandoned
+PARTIAL_TTL = 24 * 3600
+# Never evict anything used more recently than this, so a file isn't
+# removed between being downloaded and being handed out
+MIN_AGE = 60
+RETENTION_INTERVAL = 60
+
+
+class RetentionManager:
+    """Keeps a download folder under its disk quota from a background thread.
+
+    Each pass:
+      1. forgets catalog entries whose files were deleted by someone else,
+      2. removes delivered files not accessed for delivered_ttl (if set),
+      3. removes partial downloads abandoned for partial_ttl,
+      4. evicts least recently used objects (and, when delivered files are
+         managed, standalone files) until usage is under quota.
+
+    Pinned files, and files `in_use(path)` reports, are left alone. Work per
+    pass is proportional to what is on disk now, not to download history.
+    """
+
+    def __init__(self, download_dir, quota_bytes=STORE_QUOTA_BYTES, delivered_ttl=DELIVERED_TTL,
+                 partial_ttl=PARTIAL_TTL, interval=RETENTION_INTERVAL, in_use=None, log=print):
+        self.download_dir = download_dir
+        self.store = get_store(download_dir)
+        self.quota_bytes = quota_bytes
+        self.delivered_ttl = delivered_ttl
+        self.partial_ttl = partial_ttl
+        self.interval = interval
+        self.in_use = in_use or (lambda path: False)
+        self.log = log
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self.log(f"Warning: retention pass failed: {e}")
+            self._stop.wait(self.interval)
+
+    def run_once(self):
+        """One retention pass; returns what it removed"""
+        now = time.time()
+        removed = {'files': 0, 'objects': 0, 'partials': 0, 'bytes': 0}
+
+        for path, last_access, pinned in self.store.files():
+            if not os.path.exists(path):
+                self.store.forget_file(path)
+            elif (self.delivered_ttl is not None and not pinned and last_access < now - self.delivered_ttl
+                    and not self.in_use(path)):
+                removed['bytes'] += self.store.remove_file(path)
+                removed['files'] += 1
+
+        partial_bytes = 0
+        for directory in (self.download_dir, self.store.objects_dir):
+            for entry in os.scandir(directory):
+                if not entry.name.endswith(PARTIAL_SUFFIX):
+                    continue
+                manifest = entry.path[:-len(PARTIAL_SUFFIX)] + MANIFEST_SUFFIX
+                try:
+                    stat = entry.stat()
+                    touched = stat.st_mtime
+                    if os.path.exists(manifest):
+                        touched = max(touched, os.path.getmtime(manifest))
+                except OSError:
+                    continue
+                if touched < now - self.partial_ttl:
+                    removed['bytes'] += stat.st_size
+                    removed['partials'] += 1
+                    for path in (entry.path, manifest):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                else:
+                    partial_bytes += stat.st_size
+
+        usage = self.store.usage() + partial_bytes
+        if usage > self.quota_bytes:
+            candidates = self.store.eviction_candidates(now - MIN_AGE, include_files=self.delivered_ttl is not None)
+            for kind, name in candidates:
+                if usage <= self.quota_bytes:
+                    break
+                if kind == 'object':
+                    freed = self.store.remove_object(name)
+                    removed['objects'] += 1
+                elif self.in_use(name):
+                    continue
+                else:
+                    freed = self.store.remove_file(name)
+                    removed['files'] += 1
+                usage -= freed
+                removed['bytes'] += freed
+        return removed
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def start_retention(download_dir, **options):
+    """Start (once per folder) the background RetentionManager for download_dir"""
+    root = os.path.abspath(download_dir)
+    with _managers_lock:
+        manager = _managers.get(root)
+        if manager is None:
+            manager = _managers[root] = RetentionManager(root, **options).start()
+        return manager
@@ -0,0 +1,278 @@
+import os
+import threading
+import time
+
+from bandwidth import INTERACTIVE
+
+DOWNLOAD_CONNECTIONS = 4
+# Files smaller than this are fetched over a single connection
+SEGMENTED_MIN_SIZE = 4 * 1024 * 1024
+MIN_SEGMENT_SIZE = 1024 * 1024
+MAX_SEGMENT_SIZE = 32 * 1024 * 1024
+# Segments start and end on multiples of this (integrity.py hashes per block),
+# so each block is written by one connection, in order
+BLOCK_SIZE = 1024 * 1024
+# A worker is handed roughly this many seconds of work per segment
+TARGET_SEGMENT_SECONDS = 4.0
+READ_SIZE = 256 * 1024
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 30
+# Seconds between on_checkpoint calls while a download is running
+CHECKPOINT_INTERVAL = 2.0
+# A connection is throttled when it reads slower than THROTTLE_RATIO times
+# the stream's playback rate (or THROTTLE_MIN_RATE bytes/sec, whichever is
+# higher) over a whole THROTTLE_WINDOW; 0 turns detection off
+THROTTLE_RATIO = float(os.environ.get("YTDL_THROTTLE_RATIO", "2.0"))
+THROTTLE_MIN_RATE = 64 * 1024
+THROTTLE_WINDOW = 3.0
+# Throttled connections a download replaces before re-resolving its URL,
+# and interventions in total before it stops trying and takes what it gets
+THROTTLE_REFRESH_AFTER = 3
+MAX_THROTTLE_INTERVENTIONS = 12
+
+
+class RangeNotSupported(Exception):
+    """The server ignored the Range header"""
+
+
+class StaleURL(Exception):
+    """The signed stream URL was rejected (expired or revoked)"""
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class ConnectionThrottled(Exception):
+    """One connection read slower than the throttle threshold"""
+
+    def __init__(self, rate, threshold):
+        super().__init__(f"{rate / 1024:.0f} KiB/s is below {threshold / 1024:.0f} KiB/s")
+        self.rate = rate
+        self.threshold = threshold
+
+
+class Throttled(Exception):
+    """Replacing connections didn't help; the stream URL itself is throttled"""
+
+
+class DownloadControl:
+    """Cancel/pause switches a caller can flip from any thread.
+
+    `priority` (INTERACTIVE or BATCH) and `rate_limit` (bytes/sec, None for
+    no limit) are read by the bandwidth scheduler on every chunk, so they
+    can be changed while the download runs. A cancelled download deletes
+    its partial file unless cancelled with keep_partial, as a worker does
+    when it shuts down or loses its job to another worker that will
+    resume from that file.
+    """
+
+    def __init__(self, priority=INTERACTIVE, rate_limit=None):
+        self.priority = priority
+        self.rate_limit = rate_limit
+        self.cancelled = threading.Event()
+        self.keep_partial = False
+        self._running = threading.Event()
+        self._running.set()
+
+    def cancel(self, keep_partial=False):
+        self.keep_partial = keep_partial
+        self.cancelled.set()
+        self._running.set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def wait_while_paused(self, timeout=None):
+        """Block until resumed or cancelled; True if the download may continue"""
+        self._running.wait(timeout)
+        return not self.cancelled.is_set()
+
+
+def throttle_threshold(stream, ratio=None):
+    """Bytes/sec below which a connection for stream counts as throttled, or None"""
+    ratio = THROTTLE_RATIO if ratio is None else ratio
+    if ratio <= 0:
+        return None
+    bitrate = getattr(stream, 'bitrate', None)
+    return max(bitrate / 8 * ratio, THROTTLE_MIN_RATE) if bitrate else THROTTLE_MIN_RATE
+
+
+class ThroughputWindow:
+    """Read rate of one connection, measured over consecutive windows.
+
+    Time the caller spent waiting on purpose (bandwidth limits) is passed
+    to add() and left out, so a rate-limited connection isn't mistaken
+    for a throttled one.
+    """
+
+    def __init__(self, window=THROTTLE_WINDOW):
+        self.window = window
+        self.started = None
+        self.bytes = 0
+        self.waited = 0.0
+
+    def add(self, n, waited=0.0):
+        """Count n bytes read; returns the window's rate when one closes, else None"""
+        now = time.monotonic()
+        if self.started is None:
+            # Start at the first byte, so connection setup and TTFB don't count
+            self.started = now
+            return None
+        self.bytes += n
+        self.waited += waited
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return None
+        rate = self.bytes / max(elapsed - self.waited, 1e-6)
+        self.started, self.bytes, self.waited = now, 0, 0.0
+        return rate
+
+
+class Segment:
+    """A byte range [start, end) being fetched by one worker"""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.rate = 0.0  # bytes/sec measured by the owning worker
+
+    @property
+    def remaining(self):
+        return self.end - self.pos
+
+
+class SegmentScheduler:
+    """Hands out byte ranges of a file to download workers.
+
+    Segments are carved lazily from the unfetched gaps, sized from the
+    claiming worker's measured throughput. Once the gaps run out, idle
+    workers steal the back half of whichever active segment will take the
+    longest to finish.
+    """
+
+    def __init__(self, total_size, completed=(), min_segment=MIN_SEGMENT_SIZE,
+                 max_segment=MAX_SEGMENT_SIZE, target_seconds=TARGET_SEGMENT_SECONDS,
+                 connections=DOWNLOAD_CONNECTIONS):
+        self.total_size = total_size
+        self.min_segment = min_segment
+        self.max_segment = max_segment
+        self.target_seconds = target_seconds
+        self.initial_segment = max(min_segment, min(max_segment, total_size // (connections * 4) or 1))
+        self.lock = threading.Lock()
+        self.gaps = _invert(completed, total_size)
+        self.active = []
+        self.done = list(_merge(completed))
+
+    @property
+    def bytes_done(self):
+        with self.lock:
+            return sum(e - s for s, e in self.done) + sum(seg.pos - seg.start for seg in self.active)
+
+    def claim(self, rate=0.0):
+        """Return the next Segment for a worker, or None when nothing is left"""
+        with self.lock:
+            if self.gaps:
+                start, end = self.gaps[0]
+                size = int(rate * self.target_seconds) if rate else self.initial_segment
+                size = max(self.min_segment, min(self.max_segment, size))
+                if end - start <= size + self.min_segment:
+                    self.gaps.pop(0)
+                else:
+                    end = _align(start + size)
+                    if end <= start:
+                        end = start + size
+                    self.gaps[0] = (end, self.gaps[0][1])
+                seg = Segment(start, end)
+                self.active.append(seg)
+                return seg
+            return self._steal()
+
+    def _steal(self):
+        def eta(seg):
+            return seg.remaining / seg.rate if seg.rate else float('inf')
+
+        candidates = [s for s in self.active if s.remaining >= 2 * self.min_segment]
+        if not candidates:
+            return None
+        victim = max(candidates, key=lambda s: (eta(s), s.remaining))
+        mid = victim.pos + victim.remaining // 2
+        if _align(mid, up=True) < victim.end:
+            mid = _align(mid, up=True)
+        seg = Segment(mid, victim.end)
+        victim.end = mid
+        self.active.append(seg)
+        return seg
+
+    def writable(self, seg, n, ahead=0):
+        """How many of n bytes read at seg.pos + ahead still belong to seg;
+        fewer than n if the tail of the segment was stolen meanwhile."""
+        with self.lock:
+            return max(0, min(n, seg.end - seg.pos - ahead))
+
+    def advance(self, seg, n):
+        """Mark n bytes at seg.pos as written to disk"""
+        with self.lock:
+            seg.pos += max(0, min(n, seg.end - seg.pos))
+
+    def finish(self, seg):
+        with self.lock:
+            self.active.remove(seg)
+            if seg.pos > seg.start:
+                self.done.append((seg.start, seg.pos))
+                self.done = _merge(self.done)
+
+    def release(self, seg):
+        """Give the unfetched part of a failed segment back to the pool"""
+        with self.lock:
+            self.active.remove(seg)
+            if seg.pos > seg.start:
+                self.done.append((seg.start, seg.pos))
+                self.done = _merge(self.done)
+            if seg.pos < seg.end:
+                self.gaps.append((seg.pos, seg.end))
+                self.gaps.sort()
+
+    def completed_ranges(self):
+        """Byte ranges known to be on disk, including partial active segments"""
+        with self.lock:
+            return _merge(self.done + [(s.start, s.pos) for s in self.active if s.pos > s.start])
+
+    def is_complete(self):
+        with self.lock:
+            return not self.gaps and not self.active
+
+
+def _align(offset, up=False):
+    """offset rounded down (or up) to a BLOCK_SIZE boundary"""
+    return -(-offset // BLOCK_SIZE) * BLOCK_SIZE if up else offset // BLOCK_SIZE * BLOCK_SIZE
+
+
+def _merge(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        elif end > start:
+            merged.append((start, end))
+    return merged
+
+
+def _invert(completed, total_size):
+    gaps = []
+    pos = 0
+    for start, end in _merge(completed):
+        if start > pos:
+            gaps.append((pos, start))
+        pos = max(pos, end)
+    if pos < total_size:
+        gaps.append((pos, total_size))
+    return gaps
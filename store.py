@@ -0,0 +1,368 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from bandwidth import INTERACTIVE, PRIORITIES
+from metrics import metrics
+from segmented import DownloadCancelled, DownloadControl
+
+STORE_DIRNAME = ".store"
+INDEX_NAME = "index.sqlite3"
+LOCKS_DIRNAME = "locks"
+# How often a waiter on a shared download checks its own pause/cancel switches
+CONTROL_POLL_SECONDS = 0.2
+
+
+class _InFlight:
+    """One shared download and the callers waiting on it"""
+
+    def __init__(self):
+        self.control = DownloadControl()
+        self.waiters = []  # (control, on_progress) per caller
+        self.task = None
+
+    def progress(self, stream, chunk, bytes_remaining):
+        for _, on_progress in list(self.waiters):
+            if on_progress:
+                on_progress(stream, chunk, bytes_remaining)
+
+    def _sync_controls(self):
+        # The shared transfer only pauses when every caller has paused it,
+        # and runs at the most urgent priority and most generous limit asked for
+        controls = [control for control, _ in self.waiters]
+        if controls and all(c is not None and c.paused for c in controls):
+            self.control.pause()
+        else:
+            self.control.resume()
+        if controls:
+            self.control.priority = min((c.priority if c else INTERACTIVE for c in controls), key=PRIORITIES.index)
+            limits = [c.rate_limit if c else None for c in controls]
+            self.control.rate_limit = None if None in limits else max(limits)
+
+    async def wait(self, control, on_progress):
+        waiter = (control, on_progress)
+        self.waiters.append(waiter)
+        self._sync_controls()
+        try:
+            while True:
+                done, _ = await asyncio.wait([self.task], timeout=CONTROL_POLL_SECONDS)
+                if done:
+                    return self.task.result()
+                if control and control.cancelled.is_set():
+                    if self.waiters == [waiter]:
+                        # The last caller stops the transfer, and returns once its partial file is saved
+                        self.control.cancel(keep_partial=control.keep_partial)
+                        await asyncio.wait([self.task])
+                    raise DownloadCancelled()
+                self._sync_controls()
+        finally:
+            self.waiters.remove(waiter)
+            if not self.task.done():
+                if self.waiters:
+                    self._sync_controls()
+                else:
+                    # Nobody wants it any more; the last caller decides whether its partial file stays
+                    self.control.cancel(keep_partial=bool(control and control.keep_partial))
+
+
+class ContentStore:
+    """Downloaded streams kept once per (video ID, itag, content length).
+
+    Objects live in `<download_dir>/.store/objects/` and are recorded in a
+    SQLite index. The files handed to users are hardlinks of an object (or
+    copies where the filesystem can't link), so a stream is transferred and
+    stored once however many users ask for it, and concurrent requests for
+    the same stream share a single download. Across processes (queue
+    workers, say) a lock file per object in `.store/locks/` makes a second
+    download of the same stream wait for the first, then link it. Like the
+    job queue, the store is for processes on one machine: neither SQLite
+    nor file locks can be relied on over network filesystems.
+    """
+
+    def __init__(self, download_dir):
+        self.root = os.path.join(download_dir, STORE_DIRNAME)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.locks_dir = os.path.join(self.root, LOCKS_DIRNAME)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.root, INDEX_NAME), timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                " key TEXT PRIMARY KEY, video_id TEXT, itag INTEGER, filesize INTEGER,"
+                " path TEXT, created REAL, last_access REAL, hits INTEGER DEFAULT 0)")
+            # Files handed out from the download folder; object_key is set for links of an object
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " path TEXT PRIMARY KEY, object_key TEXT, size INTEGER,"
+                " created REAL, last_access REAL, pinned INTEGER DEFAULT 0)")
+            # Written when an object's download is verified (integrity.py); a
+            # later hit with the same size and mtime is trusted without rehashing
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(objects)")}
+            for column, kind in (('digest', 'TEXT'), ('mtime_ns', 'INTEGER')):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE objects ADD COLUMN {column} {kind}")
+            self._db.execute("CREATE INDEX IF NOT EXISTS objects_by_access ON objects (last_access)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS files_by_access ON files (last_access)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS files_by_object ON files (object_key)")
+        self._inflight = {}
+        self.stats = {'hits': 0, 'misses': 0, 'collapsed': 0}
+
+    @staticmethod
+    def key_for(stream):
+        return f"{stream.video_id}_{stream.itag}_{stream.filesize}"
+
+    def object_path(self, stream):
+        return os.path.join(self.objects_dir, f"{self.key_for(stream)}.{stream.subtype}")
+
+    def lookup(self, stream):
+        """Path of the stored object for stream, or None"""
+        key = self.key_for(stream)
+        with self._lock:
+            row = self._db.execute("SELECT path, filesize, mtime_ns FROM objects WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path, filesize, mtime_ns = row
+        try:
+            stat = os.stat(path)
+            # Unchanged since it was verified; objects stored before verification only have their size
+            intact = stat.st_size == filesize and mtime_ns in (None, stat.st_mtime_ns)
+        except OSError:
+            intact = False
+        if not intact:
+            self.forget(key)
+            return None
+        with self._lock, self._db:
+            self._db.execute("UPDATE objects SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        return path
+
+    def add(self, stream, path, digest=None):
+        """Record a downloaded object; digest is its integrity.py digest if it was verified"""
+        now = time.time()
+        mtime_ns = os.stat(path).st_mtime_ns if digest else None
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO objects"
+                " (key, video_id, itag, filesize, path, created, last_access, digest, mtime_ns)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.key_for(stream), stream.video_id, stream.itag, stream.filesize, path, now, now,
+                 digest, mtime_ns))
+
+    def forget(self, key):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM objects WHERE key = ?", (key,))
+
+    def remove_object(self, key):
+        """Delete a stored object unless a download of it is in flight"""
+        if key in self._inflight:
+            return 0
+        with self._lock:
+            row = self._db.execute("SELECT path, filesize FROM objects WHERE key = ?", (key,)).fetchone()
+        self.forget(key)
+        if row is None:
+            return 0
+        _remove(row[0])
+        return row[1] or 0
+
+    def track_file(self, path, object_key=None):
+        """Record a file handed to a user so retention can find it later"""
+        now = time.time()
+        size = 0 if object_key else os.path.getsize(path)  # links cost nothing beyond their object
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (path, object_key, size, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?)", (os.path.abspath(path), object_key, size, now, now))
+
+    def touch(self, path):
+        with self._lock, self._db:
+            self._db.execute("UPDATE files SET last_access = ? WHERE path = ?", (time.time(), os.path.abspath(path)))
+
+    def pin(self, path, pinned=True):
+        """Pinned files are never removed by retention"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE files SET pinned = ? WHERE path = ?", (int(pinned), os.path.abspath(path)))
+
+    def remove_file(self, path):
+        with self._lock, self._db:
+            row = self._db.execute("SELECT size FROM files WHERE path = ?", (path,)).fetchone()
+            self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+        _remove(path)
+        return row[0] if row else 0
+
+    def usage(self):
+        """Bytes held by stored objects plus files that aren't links of one"""
+        with self._lock:
+            objects = self._db.execute("SELECT COALESCE(SUM(filesize), 0) FROM objects").fetchone()[0]
+            files = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE object_key IS NULL").fetchone()[0]
+        return objects + files
+
+    def files(self):
+        """(path, last_access, pinned) for every tracked file"""
+        with self._lock:
+            return self._db.execute("SELECT path, last_access, pinned FROM files").fetchall()
+
+    def forget_file(self, path):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def eviction_candidates(self, before, include_files=False):
+        """Least recently used first: objects no tracked file links to, and
+        (with include_files) unpinned standalone files, last used before `before`.
+        Yields ('object', key) or ('file', path)."""
+        sql = ("SELECT 'object', key, last_access FROM objects o WHERE last_access < ?"
+               " AND NOT EXISTS (SELECT 1 FROM files f WHERE f.object_key = o.key)")
+        args = [before]
+        if include_files:
+            sql += (" UNION ALL SELECT 'file', path, last_access FROM files"
+                    " WHERE object_key IS NULL AND pinned = 0 AND last_access < ?")
+            args.append(before)
+        with self._lock:
+            rows = self._db.execute(sql + " ORDER BY last_access", args).fetchall()
+        for kind, name, _ in rows:
+            yield kind, name
+
+    @staticmethod
+    def link(object_path, file_path):
+        """Hardlink object_path to file_path, copying if that fails; True if linked"""
+        try:
+            os.link(object_path, file_path)
+            return True
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(object_path, file_path)
+            return False
+
+    async def fetch(self, stream, file_path, download, on_progress=None, control=None):
+        """Place stream's content at file_path, downloading it at most once
+
+        download(path, on_progress, control) is a coroutine function that
+        fetches the stream to path and returns its integrity digest (or
+        None). Callers asking for a stream that is already being fetched
+        wait on that download instead of starting their own; cancelling one
+        caller only stops the transfer when no other caller is still waiting.
+        """
+        key = self.key_for(stream)
+        while True:
+            # SQLite and filesystem calls run off the event loop, which lookups share
+            object_path = await asyncio.to_thread(self.lookup, stream)
+            if object_path:
+                self.stats['hits'] += 1
+                metrics.count('store_requests_total', result='hit')
+            else:
+                flight = self._inflight.get(key)
+                if flight is not None and flight.control.cancelled.is_set():
+                    # Abandoned by its callers; let it wind down and start afresh
+                    await asyncio.wait([flight.task])
+                    continue
+                if flight is None:
+                    self.stats['misses'] += 1
+                    metrics.count('store_requests_total', result='miss')
+                    flight = self._inflight[key] = _InFlight()
+                    flight.task = asyncio.ensure_future(self._download(key, stream, download, flight))
+                    # The waiters re-raise failures; this keeps asyncio from warning when none are left
+                    flight.task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                else:
+                    self.stats['collapsed'] += 1
+                    metrics.count('store_requests_total', result='collapse')
+                object_path = await flight.wait(control, on_progress)
+            try:
+                linked = await asyncio.to_thread(self.link, object_path, file_path)
+            except FileNotFoundError:
+                # Evicted between the lookup and the link
+                await asyncio.to_thread(self.forget, key)
+                continue
+            await asyncio.to_thread(self.track_file, file_path, key if linked else None)
+            return file_path
+
+    async def _download(self, key, stream, download, flight):
+        lock = ObjectLock(os.path.join(self.locks_dir, f"{key}.lock"))
+        try:
+            await self._acquire(lock, flight.control)
+            try:
+                # Another process may have stored it while this one waited
+                path = await asyncio.to_thread(self.lookup, stream)
+                if path:
+                    return path
+                path = self.object_path(stream)
+                digest = await download(path, flight.progress, flight.control)
+                await asyncio.to_thread(self.add, stream, path, digest)
+                return path
+            finally:
+                await asyncio.to_thread(lock.release)
+        finally:
+            self._inflight.pop(key, None)
+
+    @staticmethod
+    async def _acquire(lock, control):
+        if await asyncio.to_thread(lock.acquire):
+            return
+        metrics.count('store_lock_waits_total')
+        while not await asyncio.to_thread(lock.acquire):
+            if control.cancelled.is_set():
+                raise DownloadCancelled()
+            await asyncio.sleep(CONTROL_POLL_SECONDS)
+
+
+class ObjectLock:
+    """Exclusive lock on a file, held across the processes of one machine.
+    The lock file is left in place: removing it would race with the next
+    holder."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self):
+        """Take the lock without blocking; True if this caller now holds it"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            # Closing the descriptor drops a flock() lock
+            os.close(self._fd)
+            self._fd = None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(download_dir):
+    """The ContentStore for download_dir, shared by every caller in this process"""
+    root = os.path.abspath(download_dir)
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            store = _stores[root] = ContentStore(root)
+        return store
@@ -0,0 +1,249 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from streams import StreamCatalog
+
+STREAM_CACHE_DIR = ".stream_cache"
+STREAM_CACHE_TTL = 6 * 60 * 60  # seconds a metadata entry stays fresh
+STREAM_CACHE_MEMORY_ENTRIES = 128
+STREAM_CACHE_DISK_ENTRIES = 2048
+# A full disk tier is pruned this far below its limit, so the directory is
+# scanned once per this many new entries rather than on every write
+DISK_PRUNE_BATCH = 64
+# Treat signed URLs as stale this many seconds before YouTube's own expiry
+URL_EXPIRY_MARGIN = 5 * 60
+
+
+class CacheEntry:
+    """Categorized streams and title for one video ID"""
+
+    def __init__(self, video_id, streams, title, created=None):
+        self.video_id = video_id
+        self.streams = streams
+        self.title = title
+        self.created = created if created is not None else time.time()
+
+    def all_streams(self):
+        return self.streams.all_streams()
+
+    def url_expiry(self):
+        """Earliest signed-URL expiry across all streams, or None"""
+        expiries = [s.expires_at for s in self.all_streams() if s.expires_at]
+        return min(expiries) if expiries else None
+
+    def is_fresh(self, ttl, now=None):
+        now = now if now is not None else time.time()
+        if now - self.created >= ttl:
+            return False
+        expiry = self.url_expiry()
+        return expiry is None or expiry - URL_EXPIRY_MARGIN > now
+
+    def to_dict(self):
+        data = self.streams.to_dict()
+        data.update(video_id=self.video_id, title=self.title, created=self.created)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['video_id'], StreamCatalog.from_dict(data), data['title'], data['created'])
+
+
+class StreamCache:
+    """Two-tier (memory LRU + on-disk JSON) cache of stream metadata.
+
+    Entries expire after `ttl` seconds or shortly before the first signed
+    stream URL in them does, whichever comes first.
+    """
+
+    def __init__(self, cache_dir=STREAM_CACHE_DIR, ttl=STREAM_CACHE_TTL,
+                 max_memory_entries=STREAM_CACHE_MEMORY_ENTRIES,
+                 max_disk_entries=STREAM_CACHE_DISK_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_entries = None  # counted on the first write
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+            'refreshes': 0,
+        }
+
+    def _path(self, video_id):
+        return os.path.join(self.cache_dir, f"{video_id}.json")
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def get(self, video_id):
+        """Return a fresh CacheEntry for video_id, or None"""
+        with self._lock:
+            entry = self._memory.get(video_id)
+            if entry is not None:
+                if entry.is_fresh(self.ttl):
+                    self._memory.move_to_end(video_id)
+                    self.counters['memory_hits'] += 1
+                    return entry
+                del self._memory[video_id]
+                self.counters['expired'] += 1
+
+        entry = self._load(video_id)
+        if entry is not None:
+            if entry.is_fresh(self.ttl):
+                self._remember(entry)
+                self._touch(video_id)
+                self._count('disk_hits')
+                return entry
+            self._remove_file(video_id)
+            self._count('expired')
+
+        self._count('misses')
+        return None
+
+    def put(self, video_id, streams, title):
+        if not isinstance(streams, StreamCatalog):
+            streams = StreamCatalog(streams)
+        entry = CacheEntry(video_id, streams, title)
+        self._remember(entry)
+        self._store(entry)
+        return entry
+
+    def invalidate(self, video_id):
+        with self._lock:
+            self._memory.pop(video_id, None)
+        self._remove_file(video_id)
+
+    def refresh(self, video_id):
+        """Drop video_id so the next lookup goes back to YouTube"""
+        self.invalidate(video_id)
+        self._count('refreshes')
+
+    def revalidate(self, video_id, probe=True):
+        """Cheaply check whether a cached entry's URLs still work.
+
+        Checks the signed expiry locally and, if `probe` is set, sends a HEAD
+        request for one stream URL. Stale entries are dropped so the next
+        lookup refetches. Returns True if the entry is still usable.
+        """
+        entry = self.get(video_id)
+        if entry is None:
+            return False
+        if probe:
+            streams = entry.all_streams()
+            if streams and not _url_alive(streams[0].url):
+                self.refresh(video_id)
+                return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.json'):
+                    self._remove_file(name[:-5])
+
+    def _remember(self, entry):
+        with self._lock:
+            self._memory[entry.video_id] = entry
+            self._memory.move_to_end(entry.video_id)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+                self.counters['memory_evictions'] += 1
+
+    def _load(self, video_id):
+        try:
+            with open(self._path(video_id), 'r') as f:
+                return CacheEntry.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            # Corrupt or old-format entry, drop it
+            self._remove_file(video_id)
+            return None
+
+    def _store(self, entry):
+        path = self._path(entry.video_id)
+        tmp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # A name of its own, so concurrent writers of one video never share a temp file
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{entry.video_id}.", suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry.to_dict(), f)
+            with self._lock:
+                if self._disk_entries is None:
+                    self._disk_entries = sum(1 for n in os.listdir(self.cache_dir) if n.endswith('.json'))
+                if not os.path.exists(path):
+                    self._disk_entries += 1
+                full = self._disk_entries > self.max_disk_entries
+            os.replace(tmp_path, path)
+            if full:
+                self._prune_disk()
+        except OSError as e:
+            if tmp_path:
+                _remove(tmp_path)
+            print(f"Warning: could not write stream cache entry: {e}")
+
+    def _prune_disk(self):
+        files = [os.path.join(self.cache_dir, n) for n in os.listdir(self.cache_dir) if n.endswith('.json')]
+        keep = max(self.max_disk_entries - min(DISK_PRUNE_BATCH, self.max_disk_entries // 8), 0)
+        excess = len(files) - keep
+        if excess > 0:
+            files.sort(key=lambda p: os.path.getmtime(p))
+            for path in files[:excess]:
+                if _remove(path):
+                    self._count('disk_evictions')
+        with self._lock:
+            self._disk_entries = min(len(files), keep)
+
+    def _touch(self, video_id):
+        # Disk eviction is by mtime, so a hit marks the file recently used
+        try:
+            os.utime(self._path(video_id))
+        except OSError:
+            pass
+
+    def _remove_file(self, video_id):
+        if _remove(self._path(video_id)):
+            with self._lock:
+                if self._disk_entries:
+                    self._disk_entries -= 1
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+def _url_alive(url, timeout=5):
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError
+
+    try:
+        with urlopen(Request(url, method='HEAD'), timeout=timeout) as resp:
+            return resp.status < 400
+    except (URLError, OSError, ValueError):
+        return False
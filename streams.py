@@ -0,0 +1,281 @@
+import os
+import re
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+
+MIME_PATTERN = re.compile(r'(\w+/\w+);\s*codecs="([^"]*)"')
+NUMBER_PATTERN = re.compile(r'\d+')
+
+# Codec string prefix -> family shown to users and used for AE checks
+CODEC_FAMILIES = (
+    ('avc1', 'h264'), ('h264', 'h264'), ('vp09', 'vp9'), ('vp9', 'vp9'), ('vp8', 'vp8'),
+    ('av01', 'av1'), ('mp4a', 'aac'), ('opus', 'opus'), ('vorbis', 'vorbis'),
+)
+
+# Category names in the order categorize_streams builds them
+CATEGORIES = ('video', 'audio', 'progressive', 'ae_compatible')
+
+# Attributes copied from a pytubefix Stream into a StreamInfo descriptor
+STREAM_FIELDS = (
+    'itag', 'url', 'mime_type', 'type', 'subtype', 'codecs',
+    'video_codec', 'audio_codec', 'resolution', 'abr', 'fps',
+    'filesize', 'is_progressive', 'is_adaptive', 'bitrate',
+)
+
+
+class StreamInfo:
+    """Plain descriptor for one downloadable stream.
+
+    Holds the same attributes the front ends read from a pytubefix Stream,
+    but can be serialized to JSON and rebuilt without touching YouTube.
+    Resolution, bitrate and codec are also parsed once into `height`,
+    `kbps` and `codec_family`, so sorting and filtering never re-parse
+    strings.
+    """
+
+    __slots__ = STREAM_FIELDS + ('video_id', 'height', 'kbps', 'codec_family', 'label', 'detailed_label', '_source')
+
+    def __init__(self, itag, url, mime_type, codecs=(), video_codec=None,
+                 audio_codec=None, resolution=None, abr=None, fps=None,
+                 filesize=0, is_progressive=False, is_adaptive=False, bitrate=None,
+                 video_id=None, type=None, subtype=None, source=None):
+        self.itag = int(itag)
+        self.url = url
+        self.mime_type = mime_type
+        self.type, self.subtype = mime_type.split('/')
+        self.codecs = list(codecs)
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.resolution = resolution
+        self.abr = abr
+        self.fps = fps
+        self.filesize = filesize or 0
+        self.is_progressive = is_progressive
+        self.is_adaptive = is_adaptive
+        # Bits/sec, used to tell a throttled connection from a slow stream
+        self.bitrate = bitrate
+        self.video_id = video_id
+        self.height = _leading_int(resolution)
+        self.kbps = _leading_int(abr)
+        self.codec_family = codec_family(self.codecs[0]) if self.codecs else None
+        self.label = f"{resolution or abr} ({mime_type})"
+        self.detailed_label = f"{resolution or abr} ({mime_type} - {self.codecs[0] if self.codecs else '?'})"
+        # Live pytubefix Stream, only present for streams resolved in this process
+        self._source = source
+
+    @property
+    def quality(self):
+        """Numeric sort key: resolution for video streams, bitrate for audio"""
+        return self.height or self.kbps
+
+    @classmethod
+    def from_pytubefix(cls, stream, video_id=None):
+        """Build a descriptor from a pytubefix Stream"""
+        try:
+            filesize = stream.filesize
+        except Exception:
+            filesize = 0
+        return cls(
+            itag=stream.itag,
+            url=stream.url,
+            mime_type=stream.mime_type,
+            codecs=stream.codecs,
+            video_codec=stream.video_codec,
+            audio_codec=stream.audio_codec,
+            resolution=stream.resolution,
+            abr=stream.abr,
+            fps=getattr(stream, 'fps', None),
+            filesize=filesize,
+            is_progressive=stream.is_progressive,
+            is_adaptive=stream.is_adaptive,
+            bitrate=getattr(stream, 'bitrate', None),
+            video_id=video_id,
+            source=stream,
+        )
+
+    @classmethod
+    def from_format(cls, fmt, video_id=None):
+        """Build a descriptor from a player-response format dict with a plain URL"""
+        from pytubefix.itags import get_format_profile
+
+        mime_type, codecs = MIME_PATTERN.match(fmt['mimeType']).groups()
+        codecs = [c.strip() for c in codecs.split(',')]
+        is_adaptive = len(codecs) % 2 == 1
+        video_codec = audio_codec = None
+        # Same split as pytubefix's Stream.parse_codecs
+        if not is_adaptive:
+            video_codec, audio_codec = codecs
+        elif mime_type.startswith('video/'):
+            video_codec = codecs[0]
+        else:
+            audio_codec = codecs[0]
+        profile = get_format_profile(fmt['itag'])
+        return cls(
+            itag=fmt['itag'],
+            url=fmt['url'],
+            mime_type=mime_type,
+            codecs=codecs,
+            video_codec=video_codec,
+            audio_codec=audio_codec,
+            resolution=profile['resolution'],
+            abr=profile['abr'],
+            fps=fmt.get('fps'),
+            filesize=int(fmt.get('contentLength', 0)),
+            is_progressive=not is_adaptive,
+            is_adaptive=is_adaptive,
+            bitrate=fmt.get('averageBitrate') or fmt.get('bitrate'),
+            video_id=video_id,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        fields = {k: data.get(k) for k in STREAM_FIELDS if k not in ('type', 'subtype')}
+        return cls(video_id=data.get('video_id'), **fields)
+
+    def to_dict(self):
+        data = {k: getattr(self, k) for k in STREAM_FIELDS}
+        data['video_id'] = self.video_id
+        return data
+
+    def __reduce__(self):
+        # Pickles (e.g. to worker processes) without the live pytubefix Stream
+        return StreamInfo.from_dict, (self.to_dict(),)
+
+    @property
+    def expires_at(self):
+        """Unix time at which the signed URL stops working, or None"""
+        try:
+            return int(parse_qs(urlparse(self.url).query)['expire'][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    def is_expired(self, margin=60):
+        expires_at = self.expires_at
+        return expires_at is not None and expires_at - margin <= time.time()
+
+    def download(self, output_path=None, filename=None, on_progress=None, control=None):
+        """Download the stream to output_path/filename and return the path
+
+        `control` (a segmented.DownloadControl) can pause or cancel the
+        transfer between chunks.
+        """
+        from segmented import DownloadCancelled
+
+        output_path = output_path or os.getcwd()
+        file_path = os.path.join(output_path, filename or f"{self.itag}.{self.subtype}")
+
+        if self._source is not None and not self.is_expired():
+            interrupt = (lambda: not control.wait_while_paused()) if control else None
+            with reporting_progress(self._source, on_progress, self):
+                self._source.download(output_path=output_path, filename=os.path.basename(file_path),
+                                      interrupt_checker=interrupt)
+            if control and control.cancelled.is_set():
+                raise DownloadCancelled()
+            return file_path
+
+        from pytubefix import request
+
+        bytes_remaining = self.filesize
+        with open(file_path, 'wb') as fh:
+            for chunk in request.stream(self.url):
+                if control and not control.wait_while_paused():
+                    raise DownloadCancelled()
+                fh.write(chunk)
+                bytes_remaining -= len(chunk)
+                if on_progress:
+                    on_progress(self, chunk, bytes_remaining)
+        return file_path
+
+    def __repr__(self):
+        return f'<StreamInfo: itag="{self.itag}" mime_type="{self.mime_type}" res="{self.resolution or self.abr}">'
+
+
+class StreamCatalog(dict):
+    """Streams for one video, categorized and ordered once.
+
+    Maps each category in CATEGORIES to a tuple of StreamInfo ordered best
+    first, so it reads like the plain dict categorize_streams used to
+    return. options() gives the label -> stream index for a category,
+    built on first use and then reused on every redraw or rerun.
+    """
+
+    __slots__ = ('_options',)
+
+    def __init__(self, categories=()):
+        super().__init__()
+        for name, stream_list in dict(categories).items():
+            # Stable sort: equal quality keeps the order YouTube listed them in
+            self[name] = tuple(sorted(stream_list, key=lambda s: s.quality, reverse=True))
+        self._options = {}
+
+    def options(self, category, detailed=False):
+        """{label: stream} for category, best first"""
+        key = (category, detailed)
+        index = self._options.get(key)
+        if index is None:
+            index = {}
+            for s in self.get(category, ()):
+                # Same label twice (e.g. two 720p mp4s): keep the first, better one
+                index.setdefault(s.detailed_label if detailed else s.label, s)
+            self._options[key] = index
+        return index
+
+    def all_streams(self):
+        seen = {}
+        for stream_list in self.values():
+            for stream in stream_list:
+                seen.setdefault(stream.itag, stream)
+        return list(seen.values())
+
+    def to_dict(self):
+        # Streams appear in several categories, so store each once and refer by itag
+        return {
+            'streams': [s.to_dict() for s in self.all_streams()],
+            'categories': {k: [s.itag for s in v] for k, v in self.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        by_itag = {d['itag']: StreamInfo.from_dict(d) for d in data['streams']}
+        return cls({k: [by_itag[i] for i in itags] for k, itags in data['categories'].items()})
+
+    def __reduce__(self):
+        return StreamCatalog.from_dict, (self.to_dict(),)
+
+
+@contextmanager
+def reporting_progress(source, on_progress, stream=None):
+    """Have a pytubefix Stream report each chunk it writes as
+    on_progress(stream or source, chunk, bytes_remaining).
+
+    Hooks this one Stream rather than registering a callback on its
+    YouTube object, which every other stream of the video shares.
+    """
+    if on_progress is None:
+        yield
+        return
+    write = source.on_progress  # writes the chunk, then calls the YouTube object's callback
+
+    def on_chunk(chunk, file_handler, bytes_remaining):
+        write(chunk, file_handler, bytes_remaining)
+        on_progress(stream or source, chunk, bytes_remaining)
+
+    source.on_progress = on_chunk
+    try:
+        yield
+    finally:
+        del source.on_progress
+
+
+def _leading_int(text):
+    match = NUMBER_PATTERN.search(text) if text else None
+    return int(match.group()) if match else 0
+
+
+def codec_family(codec):
+    codec = codec.lower()
+    for prefix, family in CODEC_FAMILIES:
+        if codec.startswith(prefix):
+            return family
+    return codec.split('.')[0]
@@ -0,0 +1,119 @@
+"""Tests run offline against benchmarks/fake_youtube.py.
+
+One fake backend answers format lookups for the whole session, since
+commons reads YTDL_INNERTUBE_URL when it is first imported. Each test runs
+in its own temporary directory, so the metadata cache and downloads start
+empty.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from fake_youtube import FakeYouTube  # noqa: E402
+from metrics import METRICS_PREFIX, _labels, metrics  # noqa: E402
+
+VIDEO_SIZE = 32 * 1024 * 1024
+
+_backend = FakeYouTube(video_size=VIDEO_SIZE).start()
+os.environ['YTDL_INNERTUBE_URL'] = _backend.innertube_url
+
+
+@pytest.fixture
+def backend():
+    """The session's fake YouTube; knobs a test turns are put back afterwards"""
+    saved = dict(vars(_backend))
+    yield _backend
+    for name in ('latency', 'per_connection_bps', 'bandwidth', 'throttled_fraction', 'throttled_bps', 'ranges'):
+        setattr(_backend, name, saved[name])
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def get_stream(backend, video_id, itag):
+    from commons import get_available_streams
+
+    streams, title = get_available_streams(backend.watch_url(video_id))
+    return next(s for s in streams.all_streams() if s.itag == itag), title
+
+
+def download(stream, title, connections=4):
+    from commons import download_selected_stream
+
+    file_path, _ = download_selected_stream(stream, title, 'downloads', connections=connections)
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def counter(name, **labels):
+    """Current value of a metrics counter, read from the Prometheus text"""
+    prefix = f"{METRICS_PREFIX}{name}{_labels(tuple(sorted(labels.items())))} "
+    return sum(float(line[len(prefix):]) for line in metrics.render().splitlines() if line.startswith(prefix))
+
+
+FAKE_FFMPEG = '''#!{python}
+"""Stands in for ffmpeg: copies its first input to its output and logs the call"""
+import json, os, sys, threading
+
+args = sys.argv[1:]
+sources = [args[i + 1] for i, arg in enumerate(args) if arg == '-i']
+data = [b''] * len(sources)
+
+
+def read(i, source):
+    with (os.fdopen(int(source[5:]), 'rb') if source.startswith('pipe:') else open(source, 'rb')) as f:
+        data[i] = f.read()
+
+
+threads = [threading.Thread(target=read, args=item) for item in enumerate(sources)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+with open({log!r}, 'a') as f:
+    f.write(json.dumps({{'args': args, 'sizes': [len(d) for d in data]}}) + '\\n')
+if os.path.exists({fail!r}):
+    sys.exit('Invalid data found when processing input')
+with open(args[-1], 'wb') as f:
+    f.write(data[0])
+'''
+
+
+class FakeFFmpeg:
+    def __init__(self, root):
+        self.log_path = str(root / 'ffmpeg.jsonl')
+        self.fail_path = str(root / 'ffmpeg.fail')
+        self.path = str(root / 'ffmpeg')
+        with open(self.path, 'w') as f:
+            f.write(FAKE_FFMPEG.format(python=sys.executable, log=self.log_path, fail=self.fail_path))
+        os.chmod(self.path, 0o755)
+
+    def calls(self):
+        import json
+
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+    def fail(self):
+        open(self.fail_path, 'w').close()
+
+
+@pytest.fixture
+def ffmpeg(tmp_path_factory, monkeypatch):
+    """A fake ffmpeg that writes its first input out unchanged"""
+    import mux
+    import transcode
+
+    fake = FakeFFmpeg(tmp_path_factory.mktemp('ffmpeg'))
+    monkeypatch.setattr(mux, 'FFMPEG', fake.path)
+    monkeypatch.setattr(transcode, 'FFMPEG', fake.path)
+    return fake
@@ -0,0 +1,109 @@
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from api_server import make_server
+from fake_youtube import media_bytes
+
+
+@pytest.fixture
+def api(workdir):
+    server, manager = make_server(str(workdir / 'downloads'), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        conn.request(method, path, body, headers or {})
+        resp = conn.getresponse()
+        data = resp.read()
+        return resp, json.loads(data) if resp.getheader('Content-Type') == 'application/json' else data
+    finally:
+        conn.close()
+
+
+def wait_for(port, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        _, job = request(port, 'GET', f'/api/jobs/{job_id}')
+        if job['status'] in ('done', 'failed', 'cancelled'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job still {job['status']}")
+
+
+def test_submit_poll_and_fetch_a_range_of_the_file(backend, api):
+    size = backend.filesize(140)
+    resp, job = request(api, 'POST', '/api/jobs', {'url': backend.watch_url('apiaaaaaaaa'), 'itag': '140'})
+    assert resp.status == 202 and resp.getheader('Location') == f"/api/jobs/{job['id']}"
+
+    job = wait_for(api, job['id'])
+    assert job['status'] == 'done', job['error']
+    assert job['bytes_done'] == job['total_bytes'] == size
+
+    resp, data = request(api, 'GET', job['file_url'], headers={'Range': 'bytes=1000-1999'})
+    assert resp.status == 206 and resp.getheader('Content-Range') == f'bytes 1000-1999/{size}'
+    assert data == media_bytes(140, 1000, 2000, size)
+    resp, data = request(api, 'GET', job['file_url'])
+    assert resp.status == 200 and data == media_bytes(140, 0, size, size)
+
+
+@pytest.mark.parametrize('body, headers, error', [
+    (b'{"url": "x"}', {'Content-Length': 'twelve'}, "Invalid Content-Length"),
+    ({'url': 'x', 'itag': 'best'}, None, "itag must be an integer"),
+    ({'url': 'x', 'rule': 'best 3d'}, None, None),
+    (b'[1, 2]', None, "Body must be a JSON object"),
+])
+def test_bad_submissions_get_a_400(api, body, headers, error):
+    if headers:
+        # http.client won't send a bad Content-Length of its own accord
+        conn = http.client.HTTPConnection('127.0.0.1', api, timeout=30)
+        conn.putrequest('POST', '/api/jobs')
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.endheaders(body)
+        resp = conn.getresponse()
+        data = json.loads(resp.read())
+        conn.close()
+    else:
+        resp, data = request(api, 'POST', '/api/jobs', body)
+    assert resp.status == 400
+    if error:
+        assert data['error'] == error
+
+
+def test_unexpected_errors_get_a_500(api, monkeypatch):
+    monkeypatch.setattr('api_server.JobManager.jobs', lambda manager: 1 / 0)
+    resp, data = request(api, 'GET', '/api/jobs')
+    assert resp.status == 500 and data == {'error': "Internal server error"}
+    # The server is still there for the next client
+    assert request(api, 'GET', '/healthz')[0].status == 200
+
+
+def test_connections_beyond_the_cap_get_a_503(workdir):
+    server, _ = make_server(str(workdir / 'downloads'), port=0)
+    server._slots = threading.BoundedSemaphore(1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    held = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        held.request('GET', '/healthz')
+        assert held.getresponse().read() == b'{"ok": true}'  # kept alive, still holding its slot
+
+        assert request(port, 'GET', '/healthz')[0].status == 503
+        held.close()
+        time.sleep(0.2)
+        assert request(port, 'GET', '/healthz')[0].status == 200
+    finally:
+        held.close()
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,17 @@
+import ssl
+
+from async_engine import INNERTUBE_CLIENT, AsyncHTTPClient, innertube_client, media_headers
+
+
+def test_innertube_client_resolves_against_the_installed_pytubefix():
+    # Without it every lookup silently takes the slow pytubefix fallback
+    config = innertube_client()
+    assert config is not None
+    assert config['innertube_context']['context']['client']['clientName'] == INNERTUBE_CLIENT
+    assert media_headers(f'https://media.example/videoplayback?c={INNERTUBE_CLIENT}')['User-Agent']
+
+
+def test_client_verifies_certificates_whatever_the_process_default(monkeypatch):
+    monkeypatch.setattr(ssl, '_create_default_https_context', ssl._create_unverified_context)
+    context = AsyncHTTPClient()._tls_context()
+    assert context.verify_mode == ssl.CERT_REQUIRED and context.check_hostname
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import pytest
+
+from bandwidth import BATCH, BURST_SECONDS, INTERACTIVE, BandwidthScheduler, parse_rate
+from conftest import get_stream
+from segmented import DownloadControl
+
+CHUNK = 64 * 1024
+MiB = 1024 * 1024
+
+
+@pytest.mark.parametrize('value, rate', [
+    ("20M", 20 * MiB), ("500k", 500 * 1024), ("1.5MiB/s", int(1.5 * MiB)), ("1048576", MiB),
+    ("", None), ("0", None), (None, None), (0, None), (2048, 2048),
+])
+def test_parse_rate(value, rate):
+    assert parse_rate(value) == rate
+
+
+def test_parse_rate_rejects_nonsense():
+    with pytest.raises(ValueError, match="use e.g. 500k"):
+        parse_rate("fast")
+
+
+async def consume(scheduler, control, total, connections=1):
+    async def connection():
+        for _ in range(total // CHUNK // connections):
+            await scheduler.consume(control, CHUNK)
+
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return time.monotonic()
+
+
+async def drained(rate):
+    """A scheduler with the global cap's initial burst used up"""
+    scheduler = BandwidthScheduler(rate)
+    await scheduler.consume(None, int(rate * BURST_SECONDS))
+    return scheduler
+
+
+def test_rate_limit_caps_one_download():
+    async def main():
+        scheduler = BandwidthScheduler()
+        start = time.monotonic()
+        # A quarter of a second's burst, then 1 MiB at 4 MiB/s
+        end = await consume(scheduler, DownloadControl(rate_limit=4 * MiB), 2 * MiB, connections=4)
+        return end - start
+
+    assert 0.2 <= asyncio.run(main()) < 1.0
+
+
+def test_interactive_downloads_go_before_batch_under_the_global_cap():
+    async def main():
+        scheduler = await drained(8 * MiB)
+        batch = asyncio.ensure_future(consume(scheduler, DownloadControl(priority=BATCH), 2 * MiB))
+        await asyncio.sleep(0.05)
+        interactive = await consume(scheduler, DownloadControl(priority=INTERACTIVE), 2 * MiB)
+        return interactive, await batch
+
+    interactive, batch = asyncio.run(main())
+    # The batch job only gets the link once the interactive one is done
+    assert batch - interactive >= 0.15
+
+
+def test_downloads_share_the_cap_whatever_their_connection_count():
+    async def main():
+        scheduler = await drained(8 * MiB)
+        start = time.monotonic()
+        wide = asyncio.ensure_future(consume(scheduler, DownloadControl(), 2 * MiB, connections=8))
+        narrow = await consume(scheduler, DownloadControl(), 2 * MiB, connections=1)
+        return (await wide) - start, narrow - start
+
+    wide, narrow = asyncio.run(main())
+    assert 0.4 < narrow < 0.7 and abs(wide - narrow) < 0.05
+
+
+def test_download_with_a_rate_limit(backend):
+    from commons import download_selected_stream
+
+    stream, title = get_stream(backend, 'bandwidthaa', 140)
+    control = DownloadControl(rate_limit=MiB)
+    start = time.monotonic()
+    download_selected_stream(stream, title, 'downloads', control=control)
+    # A quarter-second burst, then the rest at 1 MiB/s
+    assert time.monotonic() - start >= (stream.filesize - MiB / 4) / MiB * 0.9
@@ -0,0 +1,55 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from batch import BatchRunner, BatchJob, HostQueue, read_jobs
+
+
+def test_read_jobs_applies_the_default_rule_and_rejects_typos():
+    lines = ["# comment", "", "https://youtu.be/aaaaaaaaaaa  best audio", "https://youtu.be/bbbbbbbbbbb"]
+    assert read_jobs(lines, "best progressive") == [
+        ("https://youtu.be/aaaaaaaaaaa", "best audio"),
+        ("https://youtu.be/bbbbbbbbbbb", "best progressive"),
+    ]
+    with pytest.raises(ValueError, match="Unknown token '1080'"):
+        read_jobs(["https://youtu.be/aaaaaaaaaaa best video 1080"])
+
+
+def job(host):
+    return SimpleNamespace(stream=SimpleNamespace(url=f"https://{host}/videoplayback"))
+
+
+def test_host_queue_skips_hosts_at_their_limit():
+    queue = HostQueue(per_host=1)
+    first, second, other = job('a.example'), job('a.example'), job('b.example')
+    for j in (first, second, other):
+        queue.put(j)
+    queue.close()
+
+    assert queue.get() is first
+    assert queue.get() is other  # a.example is busy
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(queue.get()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()  # waits for a.example's slot
+    queue.done(first)
+    waiter.join(5)
+    assert got == [second]
+    queue.done(other)
+    queue.done(second)
+    assert queue.get() is None
+
+
+def test_runner_downloads_what_each_rule_picks(backend, workdir):
+    jobs = [BatchJob(backend.watch_url('batchaaaaaa'), "best audio"),
+            BatchJob(backend.watch_url('batchbbbbbb'), "best video mp4 <=720p"),
+            BatchJob(backend.watch_url('batchcccccc'), "best video <=144p")]
+
+    summary = BatchRunner(str(workdir / 'downloads'), workers=2, log=lambda message: None).run(jobs)
+
+    assert (summary['succeeded'], summary['failed']) == (2, 1)
+    assert [r['itag'] for r in summary['results']] == [251, 136, None]
+    assert summary['bytes'] == backend.filesize(251) + backend.filesize(136)
+    assert summary['failures'] == [{'url': jobs[2].url, 'error': "resolve: No stream matching 'best video <=144p'"}]
@@ -0,0 +1,69 @@
+import struct
+
+import pytest
+
+import fake_youtube
+from conftest import counter, download, get_stream
+from fake_youtube import _header, media_bytes
+from integrity import IntegrityError, StreamVerifier, check_container, file_digest
+
+BLOCK = 64 * 1024
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_digest_does_not_depend_on_write_order(workdir):
+    data = media_bytes(140, 0, 5 * BLOCK + 123, 5 * BLOCK + 123)
+    path = write(workdir / 'file', data)
+
+    verifier = StreamVerifier(len(data), block_size=BLOCK)
+    for start in reversed(range(0, len(data), BLOCK)):
+        verifier.update(start, data[start:start + BLOCK])
+    assert verifier.finish(path) == file_digest(path, block_size=BLOCK)
+    assert verifier.rehashed == 0
+
+    # Out of order within a block: read back from disk, same digest
+    verifier = StreamVerifier(len(data), block_size=BLOCK)
+    verifier.update(100, data[100:BLOCK])
+    verifier.update(0, data[:100])
+    verifier.update(BLOCK, data[BLOCK:])
+    assert verifier.finish(path) == file_digest(path, block_size=BLOCK)
+    assert verifier.rehashed == BLOCK
+
+
+def test_short_file_fails_the_length_check(workdir):
+    path = write(workdir / 'file', b'x' * 100)
+    with pytest.raises(IntegrityError, match="Expected 200 bytes"):
+        StreamVerifier(200).finish(path)
+
+
+@pytest.mark.parametrize('itag, kind', [(137, 'mp4'), (140, 'm4a'), (248, 'webm')])
+def test_container_check_accepts_complete_files(workdir, itag, kind):
+    check_container(write(workdir / 'file', media_bytes(itag, 0, 4096, 4096)), kind)
+
+
+@pytest.mark.parametrize('data, kind, error', [
+    (media_bytes(137, 0, 4096, 8192), 'mp4', "runs past the end"),
+    (media_bytes(248, 0, 4096, 8192), 'webm', "file has 4096"),
+    (struct.pack('>I4s4s', 16, b'ftyp', b'isom') + b'\0' * 4 + struct.pack('>I4s', 8, b'mdat'), 'mp4', "no moov"),
+    (b'<html>Sign in to confirm you are not a bot</html>', 'mp4', "is not a mp4 file"),
+    (b'', 'webm', "is empty"),
+], ids=['truncated-mp4', 'truncated-webm', 'no-moov', 'html', 'empty'])
+def test_container_check_rejects_truncated_and_mislabelled_files(workdir, data, kind, error):
+    with pytest.raises(IntegrityError, match=error):
+        check_container(write(workdir / 'file', data), kind)
+
+
+def test_download_that_fails_verification_is_retried_then_removed(backend, workdir, monkeypatch):
+    stream, title = get_stream(backend, 'integrityaa', 140)
+    # Served without its moov box, as if the upload were cut short
+    monkeypatch.setattr(fake_youtube, '_header', lambda itag, size: _header(itag, size)[:24] + b'\0' * 8)
+    retries = counter('retries_total', kind='integrity')
+
+    with pytest.raises(IntegrityError, match="no moov"):
+        download(stream, title)
+    assert counter('retries_total', kind='integrity') == retries + 1
+    assert [p.name for p in (workdir / 'downloads').iterdir() if p.is_file()] == []
@@ -0,0 +1,154 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+import jobqueue
+from conftest import ROOT
+from fake_youtube import media_bytes
+from jobqueue import JobQueue, Worker
+from partial import PartialDownload
+
+VIDEO_ID = 'aaaaaaaaaaa'
+
+
+@pytest.fixture
+def queue(workdir):
+    return JobQueue(str(workdir / 'downloads'))
+
+
+def test_claim_heartbeat_and_lease_expiry(queue):
+    job_id = queue.submit('https://youtu.be/' + VIDEO_ID, itag=137)
+    job = queue.claim('w1', lease=0.3)
+    assert job['id'] == job_id and job['attempts'] == 1
+    assert queue.claim('w2') is None
+
+    assert queue.heartbeat(job_id, 'w1', title='t', total=100, bytes_done=40, lease=0.3)
+    assert queue.get(job_id)['bytes_done'] == 40
+
+    time.sleep(0.4)
+    job = queue.claim('w2')
+    assert job['id'] == job_id and job['worker'] == 'w2' and job['attempts'] == 2
+    # The old worker finds out at its next heartbeat, and can't finish the job any more
+    assert not queue.heartbeat(job_id, 'w1')
+    queue.finish(job_id, 'w1', 'done', file_name='stale.mp4')
+    assert queue.get(job_id)['status'] == 'running'
+
+
+def test_cancel_stops_the_worker_at_its_next_heartbeat(queue):
+    job_id = queue.submit('https://youtu.be/' + VIDEO_ID, itag=137)
+    queue.claim('w1')
+    queue.cancel(job_id)
+    assert not queue.heartbeat(job_id, 'w1')
+    assert queue.get(job_id)['cancel_requested']
+
+
+def test_release_does_not_count_the_attempt(queue):
+    job_id = queue.submit('https://youtu.be/' + VIDEO_ID, itag=137)
+    queue.claim('w1')
+    queue.release(job_id, 'w1')
+    job = queue.get(job_id)
+    assert job['status'] == 'queued' and job['attempts'] == 0 and job['worker'] is None
+    assert queue.claim('w2')['attempts'] == 1
+
+
+def test_failed_job_is_retried_after_a_backoff(queue, monkeypatch):
+    monkeypatch.setattr(jobqueue, 'RETRY_DELAY', 0.3)
+    job_id = queue.submit('https://youtu.be/' + VIDEO_ID, itag=137, max_attempts=2)
+    queue.claim('w1')
+    queue.finish(job_id, 'w1', 'failed', error='boom', retry=True, title='t', total=10, bytes_done=4)
+    job = queue.get(job_id)
+    assert job['status'] == 'queued' and job['error'] == 'boom' and job['bytes_done'] == 4
+    assert queue.claim('w1') is None  # still backing off
+
+    time.sleep(0.35)
+    assert queue.claim('w1')['attempts'] == 2
+    queue.finish(job_id, 'w1', 'failed', error='boom again', retry=True)
+    assert queue.get(job_id)['status'] == 'failed'  # out of attempts
+
+
+def test_finish_records_final_progress(queue):
+    job_id = queue.submit('https://youtu.be/' + VIDEO_ID, itag=137)
+    queue.claim('w1')
+    queue.finish(job_id, 'w1', 'done', file_name='a.mp4', title='A video', total=1000, bytes_done=1000)
+    job = queue.get(job_id)
+    assert (job['status'], job['title'], job['total_bytes'], job['bytes_done']) == ('done', 'A video', 1000, 1000)
+
+
+def test_worker_runs_jobs_and_does_not_retry_permanent_failures(backend, queue):
+    ok = queue.submit(backend.watch_url(VIDEO_ID), itag=140)
+    missing = queue.submit(backend.watch_url(VIDEO_ID), itag=999)
+    Worker(queue.download_dir, jobs=1, log=lambda message: None).run(until_idle=True)
+
+    job = queue.get(ok)
+    assert job['status'] == 'done' and job['bytes_done'] == job['total_bytes'] == backend.filesize(140)
+    with open(os.path.join(queue.download_dir, job['file_name']), 'rb') as f:
+        assert f.read() == media_bytes(140, 0, backend.filesize(140), backend.filesize(140))
+
+    job = queue.get(missing)
+    assert job['status'] == 'failed' and job['attempts'] == 1 and '999' in job['error']
+
+
+def test_killed_workers_job_resumes_elsewhere_from_its_partial_file(backend, queue, monkeypatch):
+    backend.per_connection_bps = 1024 * 1024  # slow enough to kill it halfway
+    size = backend.filesize(137)
+    job_id = queue.submit(backend.watch_url('killedworkr'), itag=137)
+    env = dict(os.environ, YTDL_JOB_LEASE='1',
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'jobqueue.py'), 'worker', '-o', queue.download_dir,
+                             '--jobs', '1', '--id', 'doomed'], env=env, stderr=subprocess.DEVNULL)
+    manifest = os.path.join(queue.download_dir, '.store', 'objects', 'killedworkr_137.mp4.part.json')
+    try:
+        completed = 0
+        deadline = time.monotonic() + 30
+        while not completed and time.monotonic() < deadline:
+            time.sleep(0.1)
+            try:
+                with open(manifest) as f:
+                    completed = sum(end - start for start, end in json.load(f)['completed'])
+            except (OSError, ValueError):
+                pass
+    finally:
+        proc.send_signal(signal.SIGKILL)
+        proc.wait()
+    assert 0 < completed < size
+
+    backend.per_connection_bps = None
+    resumed = []
+    completed_ranges = PartialDownload.completed_ranges
+
+    def spy(partial):
+        ranges = completed_ranges(partial)
+        resumed.append(sum(end - start for start, end in ranges))
+        return ranges
+
+    monkeypatch.setattr(PartialDownload, 'completed_ranges', spy)
+    time.sleep(2)  # let the dead worker's lease run out
+    Worker(queue.download_dir, jobs=1, worker_id='survivor', log=lambda message: None).run(until_idle=True)
+
+    job = queue.get(job_id)
+    assert job['status'] == 'done' and job['worker'] is None and job['attempts'] == 2
+    assert resumed and resumed[0] >= completed
+    with open(os.path.join(queue.download_dir, job['file_name']), 'rb') as f:
+        assert f.read() == media_bytes(137, 0, size, size)
+
+
+def test_queue_is_refused_to_a_second_machine_while_the_first_uses_it(queue, monkeypatch):
+    job_id = queue.submit('https://youtu.be/' + VIDEO_ID, itag=137)
+    monkeypatch.setattr(jobqueue.socket, 'gethostname', lambda: 'elsewhere')
+    with pytest.raises(jobqueue.QueueHostError, match=queue.host):
+        JobQueue(queue.download_dir)
+
+    # Once the first machine has been quiet long enough, the queue can move
+    monkeypatch.setattr(jobqueue, 'HOST_TAKEOVER_SECONDS', 0.2)
+    time.sleep(0.3)
+    moved = JobQueue(queue.download_dir)
+    assert moved.claim('w1')['id'] == job_id
+    monkeypatch.undo()
+    monkeypatch.setattr(jobqueue, 'HOST_TAKEOVER_SECONDS', 60)
+    with pytest.raises(jobqueue.QueueHostError, match='elsewhere'):
+        queue.heartbeat(job_id, 'w1')
@@ -0,0 +1,43 @@
+import json
+import pstats
+
+from conftest import download, get_stream
+from metrics import CProfileHook, Metrics, metrics
+
+
+def test_events_are_written_by_a_background_thread(workdir):
+    log = workdir / 'events.jsonl'
+    recorder = Metrics(event_log=str(log))
+    for i in range(100):
+        recorder.event('tick', n=i)
+    assert recorder.flush(timeout=5)
+    events = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [e['n'] for e in events] == list(range(100)) and events[0]['event'] == 'tick'
+
+
+def test_profile_covers_the_writer_thread(backend, workdir):
+    stream, title = get_stream(backend, 'profiledaaa', 137)
+    metrics.add_hook(CProfileHook(str(workdir / 'profiles')), once=True)
+    download(stream, title)
+
+    (path,) = (workdir / 'profiles').iterdir()
+    functions = {name for _, _, name in pstats.Stats(str(path)).stats}
+    assert '_worker' in functions  # connections, on the engine thread
+    assert '_write' in functions  # block writes, on the segment writer thread
+
+
+def test_overlapping_downloads_are_not_profiled_twice(workdir):
+    first, second = {}, {}
+    hook = CProfileHook(str(workdir / 'profiles'))
+    hook.start(first)
+    CProfileHook(str(workdir / 'profiles')).start(second)
+    assert second['profile_skipped']
+    hook.finish(second)  # not the one it profiles
+    assert 'profile' not in second
+    hook.finish(first)
+    assert first['profile'].endswith('.prof')
+    # Free again once the first is done
+    third = {}
+    hook.start(third)
+    hook.finish(third)
+    assert 'profile' in third
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import mux
+from conftest import get_stream
+from fake_youtube import media_bytes
+
+
+def best_pair(backend, video_id, ae_compatible=False):
+    from commons import get_available_streams
+
+    streams, title = get_available_streams(backend.watch_url(video_id))
+    os.makedirs('downloads', exist_ok=True)  # as the front ends do
+    return (*mux.pick_best_pair(streams, ae_compatible), title)
+
+
+def test_picks_the_best_video_and_audio(backend):
+    video, audio, _ = best_pair(backend, 'pairaaaaaaa')
+    assert (video.itag, audio.itag) == (137, 251)
+    # AAC copies into the MP4 After Effects gets
+    video, audio, _ = best_pair(backend, 'pairaaaaaaa', ae_compatible=True)
+    assert (video.itag, audio.itag) == (137, 140)
+    assert mux.codec_args(video, audio, True) == ['-c:v', 'copy', '-c:a', 'copy']
+
+
+def test_codec_args_reencode_only_what_after_effects_cannot_take(backend):
+    vp9, _ = get_stream(backend, 'pairaaaaaaa', 248)
+    opus, _ = get_stream(backend, 'pairaaaaaaa', 251)
+    args = mux.codec_args(vp9, opus, ae_compatible=True)
+    assert args[args.index('-c:v') + 1] == 'libx264' and args[args.index('-c:a') + 1] == 'aac'
+    assert mux.codec_args(vp9, opus, ae_compatible=False) == ['-c', 'copy']
+
+
+@pytest.mark.parametrize('can_pipe', [True, False], ids=['piped', 'from-files'])
+def test_both_streams_reach_ffmpeg_in_full(backend, ffmpeg, monkeypatch, can_pipe):
+    monkeypatch.setattr(mux, 'CAN_PIPE', can_pipe)
+    video, audio, title = best_pair(backend, 'muxaaaaaaaa')
+    reported = []
+
+    path, filename = mux.download_best_quality(video, audio, title, 'downloads',
+                                               on_progress=lambda s, chunk, remaining: reported.append(remaining))
+
+    (call,) = ffmpeg.calls()
+    assert call['sizes'] == [video.filesize, audio.filesize]
+    assert call['args'][call['args'].index('-c') + 1] == 'copy'
+    with open(path, 'rb') as f:
+        assert f.read() == media_bytes(137, 0, video.filesize, video.filesize)
+    assert reported[-1] == 0
+    # Only the merged file is left in the download folder
+    assert [n for n in os.listdir('downloads') if not n.startswith('.')] == [filename]
+
+
+def test_ffmpeg_failure_leaves_no_output(backend, ffmpeg):
+    video, audio, title = best_pair(backend, 'muxbbbbbbbb')
+    ffmpeg.fail()
+
+    with pytest.raises(Exception, match="ffmpeg failed: Invalid data"):
+        mux.download_best_quality(video, audio, title, 'downloads')
+    assert [n for n in os.listdir('downloads') if not n.startswith('.')] == []
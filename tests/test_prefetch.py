@@ -0,0 +1,37 @@
+import time
+
+from commons import stream_cache
+from prefetch import Prefetcher
+
+
+def test_only_the_last_hint_is_looked_up(backend):
+    prefetcher = Prefetcher(debounce=0.2)
+    players = backend.requests['player']
+    for url in ('https://youtu.be/prefetchaaa', 'https://youtu.be/prefetchbbb', 'not a url',
+                'https://youtu.be/prefetchccc'):
+        prefetcher.hint(url)
+    prefetcher._future.result(timeout=10)
+
+    assert backend.requests['player'] - players == 1
+    assert stream_cache.get('prefetchccc') is not None
+    assert stream_cache.get('prefetchaaa') is None and stream_cache.get('prefetchbbb') is None
+
+
+def test_repeated_hint_keeps_the_pending_lookup(backend):
+    prefetcher = Prefetcher(debounce=0.2)
+    prefetcher.hint('https://youtu.be/prefetchddd')
+    future = prefetcher._future
+    time.sleep(0.1)
+    prefetcher.hint('https://www.youtube.com/watch?v=prefetchddd')
+    assert prefetcher._future is future
+    future.result(timeout=10)
+    assert stream_cache.get('prefetchddd') is not None
+
+
+def test_ahead_resolves_the_next_items(backend):
+    players = backend.requests['player']
+    urls = [backend.watch_url(f'prefetchah{i}') for i in range(5)]
+    for future in Prefetcher(ahead=3).ahead(urls):
+        future.result(timeout=10)
+    assert backend.requests['player'] - players == 3
+    assert [stream_cache.get(f'prefetchah{i}') is not None for i in range(5)] == [True] * 3 + [False] * 2
@@ -0,0 +1,88 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from retention import MIN_AGE, RetentionManager
+from store import get_store
+
+
+@pytest.fixture
+def store(workdir):
+    os.makedirs('downloads')
+    return get_store('downloads')
+
+
+def age(store, table, column, name, seconds):
+    with store._db:
+        store._db.execute(f"UPDATE {table} SET last_access = ? WHERE {column} = ?", (time.time() - seconds, name))
+
+
+def add_file(store, name, size=1000, seconds=0):
+    path = os.path.abspath(os.path.join('downloads', name))
+    with open(path, 'wb') as f:
+        f.write(bytes(size))
+    store.track_file(path)
+    age(store, 'files', 'path', path, seconds)
+    return path
+
+
+def add_object(store, video_id, size=1000, seconds=0):
+    stream = SimpleNamespace(video_id=video_id, itag=140, filesize=size, subtype='mp4')
+    path = store.object_path(stream)
+    with open(path, 'wb') as f:
+        f.write(bytes(size))
+    store.add(stream, path)
+    key = store.key_for(stream)
+    age(store, 'objects', 'key', key, seconds)
+    return key, path
+
+
+def test_delivered_files_expire_unless_pinned_or_in_use(store):
+    old = add_file(store, 'old.mp4', seconds=7200)
+    pinned = add_file(store, 'pinned.mp4', seconds=7200)
+    busy = add_file(store, 'busy.mp4', seconds=7200)
+    fresh = add_file(store, 'fresh.mp4', seconds=60)
+    gone = add_file(store, 'gone.mp4')
+    store.pin(pinned)
+    os.remove(gone)
+
+    removed = RetentionManager('downloads', delivered_ttl=3600, in_use=lambda path: path == busy).run_once()
+
+    assert removed['files'] == 1 and removed['bytes'] == 1000
+    assert not os.path.exists(old)
+    assert all(os.path.exists(p) for p in (pinned, busy, fresh))
+    assert sorted(path for path, _, _ in store.files()) == sorted([pinned, busy, fresh])
+
+
+def test_abandoned_partial_downloads_are_removed(store):
+    for name, seconds in (('old', 2 * 86400), ('recent', 60)):
+        part = os.path.join(store.objects_dir, f'{name}.mp4.part')
+        with open(part, 'wb') as f:
+            f.write(bytes(500))
+        os.utime(part, (time.time() - seconds,) * 2)
+
+    removed = RetentionManager('downloads', delivered_ttl=None, partial_ttl=86400).run_once()
+
+    assert removed['partials'] == 1 and removed['bytes'] == 500
+    assert os.listdir(store.objects_dir) == ['recent.mp4.part']
+
+
+def test_quota_evicts_least_recently_used_objects(store):
+    oldest, oldest_path = add_object(store, 'aaaaaaaaaaa', seconds=3000)
+    linked, linked_path = add_object(store, 'bbbbbbbbbbb', seconds=4000)
+    older, _ = add_object(store, 'ccccccccccc', seconds=2000)
+    recent, _ = add_object(store, 'ddddddddddd', seconds=MIN_AGE // 2)
+    user_copy = os.path.join('downloads', 'linked.mp4')
+    os.link(linked_path, user_copy)
+    store.track_file(user_copy, linked)
+
+    # 4000 bytes stored, room for 2500; links to an object cost nothing extra
+    removed = RetentionManager('downloads', quota_bytes=2500, delivered_ttl=None).run_once()
+
+    assert removed['objects'] == 2 and removed['bytes'] == 2000
+    assert not os.path.exists(oldest_path)
+    remaining = {row[0] for row in store._db.execute("SELECT key FROM objects")}
+    assert remaining == {linked, recent}
+    assert store.usage() == 2000
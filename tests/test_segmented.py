@@ -0,0 +1,131 @@
+import os
+import time
+
+import pytest
+
+from conftest import VIDEO_SIZE, counter, download, get_stream
+from fake_youtube import media_bytes
+from partial import PartialDownload
+from segmented import BLOCK_SIZE, Throttled
+from store import get_store
+
+
+def leftovers():
+    objects = os.path.join('downloads', '.store', 'objects')
+    return [name for name in os.listdir(objects) if name.endswith(('.part', '.json'))]
+
+
+@pytest.mark.parametrize('connections', [1, 4, 8])
+def test_segmented_download_is_byte_identical(backend, connections):
+    stream, title = get_stream(backend, f'segments{connections:03d}', 137)
+    media_before = backend.requests['media']
+
+    data = download(stream, title, connections)
+
+    assert data == media_bytes(137, 0, VIDEO_SIZE, VIDEO_SIZE)
+    assert backend.requests['media'] - media_before >= connections
+    assert leftovers() == []
+
+
+def test_falls_back_to_one_request_when_ranges_are_ignored(backend):
+    stream, title = get_stream(backend, 'norangesaaa', 136)
+    backend.ranges = False
+    fallbacks = counter('retries_total', kind='range_fallback')
+
+    data = download(stream, title)
+
+    assert data == media_bytes(136, 0, stream.filesize, stream.filesize)
+    assert counter('retries_total', kind='range_fallback') == fallbacks + 1
+    assert leftovers() == []
+
+
+def test_resumes_from_partial_file_and_manifest(backend):
+    stream, title = get_stream(backend, 'resumeaaaaa', 137)
+    size = stream.filesize
+    partial = PartialDownload.for_stream(stream, get_store('downloads').objects_dir)
+    done = 4 * BLOCK_SIZE
+    # A previous attempt finished the first 4 MiB. All but the first block is
+    # zeroed, so anything fetched again would show up in the result.
+    with open(partial.path, 'wb') as f:
+        f.write(media_bytes(137, 0, BLOCK_SIZE, size))
+        f.truncate(size)
+    partial.save([(0, done)])
+
+    data = download(stream, title)
+
+    assert data[:BLOCK_SIZE] == media_bytes(137, 0, BLOCK_SIZE, size)
+    assert data[BLOCK_SIZE:done] == bytes(done - BLOCK_SIZE)
+    assert data[done:] == media_bytes(137, done, size, size)
+    assert not os.path.exists(partial.path) and not os.path.exists(partial.manifest_path)
+
+
+def test_cancelled_download_kept_for_later_resumes_where_it_stopped(backend):
+    from commons import download_selected_stream
+    from segmented import DownloadCancelled, DownloadControl
+
+    backend.per_connection_bps = 16 * 1024 * 1024
+    stream, title = get_stream(backend, 'keptpartial', 137)
+    partial = PartialDownload.for_stream(stream, get_store('downloads').objects_dir)
+    control = DownloadControl()
+    received = [0]
+
+    def cancel_halfway(s, chunk, remaining):
+        received[0] += len(chunk)
+        if received[0] >= stream.filesize // 2:
+            control.cancel(keep_partial=True)
+
+    with pytest.raises(DownloadCancelled):
+        download_selected_stream(stream, title, 'downloads', on_progress=cancel_halfway, control=control)
+    assert os.path.exists(partial.path) and os.path.exists(partial.manifest_path)
+    kept = sum(end - start for start, end in partial.completed_ranges())
+    assert kept >= stream.filesize // 4
+
+    fetched = [0]
+    file_path, _ = download_selected_stream(stream, title, 'downloads',
+                                            on_progress=lambda s, chunk, remaining: fetched.__setitem__(
+                                                0, fetched[0] + len(chunk)))
+    with open(file_path, 'rb') as f:
+        assert f.read() == media_bytes(137, 0, stream.filesize, stream.filesize)
+    assert fetched[0] <= stream.filesize - kept
+    assert leftovers() == []
+
+
+def test_throttled_connection_hands_its_range_to_a_new_one(backend):
+    stream, title = get_stream(backend, 'throttledaa', 136)
+    # Served at 48 KiB/s, below the detection threshold. With this seed one
+    # of the first four requests is throttled and the next several are not.
+    backend.throttled_fraction = 0.3
+    backend._random.seed(0)
+    throttled = backend.requests['throttled']
+    reconnects = counter('throttle_interventions_total', action='reconnect')
+    started = time.monotonic()
+
+    data = download(stream, title)
+
+    assert data == media_bytes(136, 0, stream.filesize, stream.filesize)
+    assert backend.requests['throttled'] > throttled
+    assert counter('throttle_interventions_total', action='reconnect') > reconnects
+    # A throttled connection alone would need minutes for its range
+    assert time.monotonic() - started < 30
+
+
+def test_gives_up_when_every_new_url_is_throttled_too(backend, monkeypatch):
+    import async_engine
+    import fake_youtube
+    from commons import THROTTLE_REFRESH_ATTEMPTS
+    from segmented import ThroughputWindow
+
+    # Shorter windows and smaller sends, so each round of detection takes well under a second
+    monkeypatch.setattr(async_engine, 'ThroughputWindow', lambda: ThroughputWindow(window=0.5))
+    monkeypatch.setattr(fake_youtube, 'SEND_SIZE', 8 * 1024)
+    stream, title = get_stream(backend, 'alwaysslowa', 136)
+    backend.throttled_fraction = 1.0
+    refreshes = counter('throttle_interventions_total', action='refresh')
+    partial = PartialDownload.for_stream(stream, get_store('downloads').objects_dir)
+
+    with pytest.raises(Throttled, match=f"after {THROTTLE_REFRESH_ATTEMPTS} new stream URLs"):
+        download(stream, title)
+
+    assert counter('throttle_interventions_total', action='refresh') == refreshes + THROTTLE_REFRESH_ATTEMPTS + 1
+    # What did arrive is kept for the next attempt
+    assert os.path.exists(partial.manifest_path)
@@ -0,0 +1,45 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import download, get_stream
+from fake_youtube import media_bytes
+from store import get_store
+
+
+def test_second_download_is_linked_from_the_store(backend, workdir):
+    stream, title = get_stream(backend, 'storeaaaaaa', 140)
+    first = download(stream, title)
+    media = backend.requests['media']
+
+    assert download(stream, title) == first == media_bytes(140, 0, stream.filesize, stream.filesize)
+    assert backend.requests['media'] == media
+    store = get_store('downloads')
+    assert (store.stats['misses'], store.stats['hits']) == (1, 1)
+    # Two user files, one object on disk
+    files = [os.path.join('downloads', n) for n in os.listdir('downloads') if n.endswith('.mp4')]
+    assert len(files) == 2 and os.path.samefile(*files)
+
+
+def test_concurrent_requests_share_one_transfer(backend, workdir):
+    backend.per_connection_bps = 4 * 1024 * 1024
+    stream, title = get_stream(backend, 'storebbbbbb', 140)
+    media = backend.requests['media']
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: download(stream, title, connections=1), range(4)))
+
+    assert all(r == media_bytes(140, 0, stream.filesize, stream.filesize) for r in results)
+    assert backend.requests['media'] - media == 1
+    store = get_store('downloads')
+    assert store.stats['misses'] == 1 and store.stats['collapsed'] + store.stats['hits'] == 3
+
+
+def test_a_changed_object_is_downloaded_again(backend, workdir):
+    stream, title = get_stream(backend, 'storecccccc', 140)
+    download(stream, title)
+    store = get_store('downloads')
+    with open(store.object_path(stream), 'r+b') as f:
+        f.truncate(1000)
+
+    assert download(stream, title) == media_bytes(140, 0, stream.filesize, stream.filesize)
+    assert store.stats['misses'] == 2
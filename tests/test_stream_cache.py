@@ -0,0 +1,81 @@
+import os
+import time
+
+from stream_cache import URL_EXPIRY_MARGIN, StreamCache
+from streams import StreamInfo
+
+
+def streams(expire=None):
+    url = 'https://example.invalid/videoplayback?itag=140'
+    if expire is not None:
+        url += f'&expire={int(expire)}'
+    audio = StreamInfo(140, url, 'audio/mp4', codecs=['mp4a.40.2'], audio_codec='mp4a.40.2', abr='128kbps')
+    return {'audio': [audio]}
+
+
+def test_memory_hit_disk_hit_and_miss(workdir):
+    cache = StreamCache(str(workdir / 'cache'))
+    assert cache.get('aaaaaaaaaaa') is None
+    cache.put('aaaaaaaaaaa', streams(), 'Title')
+
+    entry = cache.get('aaaaaaaaaaa')
+    assert entry.title == 'Title' and entry.streams['audio'][0].itag == 140
+
+    # A new process only has the disk tier
+    entry = StreamCache(str(workdir / 'cache')).get('aaaaaaaaaaa')
+    assert entry.title == 'Title' and entry.streams['audio'][0].abr == '128kbps'
+
+    stats = cache.stats()
+    assert (stats['memory_hits'], stats['disk_hits'], stats['misses']) == (1, 0, 1)
+
+
+def test_entries_expire_after_the_ttl(workdir):
+    cache = StreamCache(str(workdir / 'cache'), ttl=60)
+    entry = cache.put('aaaaaaaaaaa', streams(), 'Title')
+    entry.created -= 61
+    cache._store(entry)
+    assert cache.get('aaaaaaaaaaa') is None
+    assert cache.counters['expired'] == 2  # in memory, then on disk
+    assert not os.path.exists(cache._path('aaaaaaaaaaa'))
+
+
+def test_entries_expire_before_their_signed_urls(workdir):
+    cache = StreamCache(str(workdir / 'cache'))
+    cache.put('aaaaaaaaaaa', streams(expire=time.time() + URL_EXPIRY_MARGIN - 10), 'Title')
+    cache.put('bbbbbbbbbbb', streams(expire=time.time() + URL_EXPIRY_MARGIN + 60), 'Title')
+    assert cache.get('aaaaaaaaaaa') is None
+    assert cache.get('bbbbbbbbbbb') is not None
+
+
+def test_memory_tier_evicts_least_recently_used(workdir):
+    cache = StreamCache(str(workdir / 'cache'), max_memory_entries=2)
+    for video_id in ('aaaaaaaaaaa', 'bbbbbbbbbbb'):
+        cache.put(video_id, streams(), video_id)
+    cache.get('aaaaaaaaaaa')
+    cache.put('ccccccccccc', streams(), 'ccccccccccc')
+
+    assert cache.counters['memory_evictions'] == 1
+    assert cache.get('aaaaaaaaaaa') is not None and cache.get('ccccccccccc') is not None
+    assert cache.counters['disk_hits'] == 0
+    # bbbbbbbbbbb left memory but is still on disk
+    assert cache.get('bbbbbbbbbbb') is not None and cache.counters['disk_hits'] == 1
+
+
+def test_disk_tier_prunes_oldest_entries_in_a_batch(workdir):
+    cache = StreamCache(str(workdir / 'cache'), max_disk_entries=16)
+    for i in range(17):
+        cache.put(f'video{i:06d}', streams(), str(i))
+        os.utime(cache._path(f'video{i:06d}'), (1000 + i, 1000 + i))
+
+    # 16 // 8 = 2 below the limit, oldest first
+    names = sorted(os.listdir(workdir / 'cache'))
+    assert len(names) == 14 and names[0] == 'video000003.json'
+    assert cache.counters['disk_evictions'] == 3
+
+
+def test_refresh_drops_both_tiers(workdir):
+    cache = StreamCache(str(workdir / 'cache'))
+    cache.put('aaaaaaaaaaa', streams(), 'Title')
+    cache.refresh('aaaaaaaaaaa')
+    assert cache.get('aaaaaaaaaaa') is None
+    assert cache.counters['refreshes'] == 1
@@ -0,0 +1,50 @@
+import pickle
+
+from conftest import get_stream
+from streams import StreamCatalog, StreamInfo
+
+
+def stream(itag, resolution=None, abr=None, mime_type='video/mp4', codec='avc1.640028'):
+    return StreamInfo(itag, f'https://example.invalid/{itag}?expire=2000000000', mime_type, codecs=[codec],
+                      video_codec=codec if resolution else None, audio_codec=None if resolution else codec,
+                      resolution=resolution, abr=abr)
+
+
+def test_categories_are_ordered_best_first_once():
+    catalog = StreamCatalog({
+        'video': [stream(136, '720p'), stream(137, '1080p'), stream(298, '720p'), stream(160, '144p')],
+        'audio': [stream(139, abr='48kbps', mime_type='audio/mp4', codec='mp4a.40.5'),
+                  stream(140, abr='128kbps', mime_type='audio/mp4', codec='mp4a.40.2')],
+    })
+    # Equal quality keeps the order YouTube listed them in
+    assert [s.itag for s in catalog['video']] == [137, 136, 298, 160]
+    assert [s.itag for s in catalog['audio']] == [140, 139]
+    assert catalog['video'][0].height == 1080 and catalog['audio'][0].kbps == 128
+
+
+def test_options_keep_the_first_of_equal_labels_and_are_reused():
+    catalog = StreamCatalog({'video': [stream(136, '720p'), stream(298, '720p'), stream(137, '1080p')]})
+    options = catalog.options('video')
+    assert [s.itag for s in options.values()] == [137, 136]
+    assert catalog.options('video') is options
+    assert len(catalog.options('video', detailed=True)) == 2
+    assert catalog.options('progressive') == {}
+
+
+def test_catalog_round_trips_through_json_and_pickle(backend):
+    from commons import get_available_streams
+
+    catalog, _ = get_available_streams(backend.watch_url('catalogaaaa'))
+    for copy in (StreamCatalog.from_dict(catalog.to_dict()), pickle.loads(pickle.dumps(catalog))):
+        assert {k: [s.itag for s in v] for k, v in copy.items()} == {k: [s.itag for s in v] for k, v in catalog.items()}
+        # Shared streams stay shared
+        assert copy['video'][0] is next(s for s in copy['ae_compatible'] if s.itag == copy['video'][0].itag)
+        assert copy['video'][0].url == catalog['video'][0].url
+
+
+def test_expiry_comes_from_the_signed_url(backend):
+    s, _ = get_stream(backend, 'catalogaaaa', 140)
+    assert s.expires_at > 0 and not s.is_expired()
+    stale = StreamInfo.from_dict(dict(s.to_dict(), url=s.url.replace(f'expire={s.expires_at}', 'expire=1000000000')))
+    assert stale.is_expired()
+    assert StreamInfo(140, 'https://example.invalid/140', 'audio/mp4').expires_at is None
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+import pytest
+
+import transcode
+from conftest import get_stream
+from fake_youtube import media_bytes
+from store import get_store
+from transcode import COMPLETE_SUFFIX, download_and_transcode, transcode_args, transcoder
+
+
+def test_transcode_args_copy_what_is_already_in_the_target_codec(backend):
+    h264, _ = get_stream(backend, 'argsaaaaaaa', 137)
+    opus, _ = get_stream(backend, 'argsaaaaaaa', 251)
+    args, extension = transcode_args('h264', h264)
+    assert extension == '.mp4' and args[args.index('-c:v') + 1] == 'copy'
+    args, extension = transcode_args('h264', opus)
+    assert extension == '.m4a' and args[args.index('-c:a') + 1] == 'aac'
+    assert transcode_args('prores', opus)[1] == '.wav'
+    with pytest.raises(ValueError, match="Unknown transcode profile"):
+        transcode_args('hevc')
+
+
+def test_encode_follows_a_growing_file_until_it_is_complete(ffmpeg, workdir):
+    data = media_bytes(137, 0, 6 * 1024 * 1024, 6 * 1024 * 1024)
+    source = str(workdir / 'source.mp4.part')
+    open(source, 'wb').close()
+
+    def write():
+        with open(source, 'ab', buffering=0) as f:
+            for start in range(0, len(data), 1024 * 1024):
+                f.write(data[start:start + 1024 * 1024])
+                time.sleep(0.1)
+        open(source + COMPLETE_SUFFIX, 'w').close()
+
+    writer = threading.Thread(target=write)
+    job = transcoder.submit(source, 'h264', out_path=str(workdir / 'out.mp4'), total=len(data), follow=True)
+    writer.start()
+    path = job.result(timeout=60)
+    writer.join()
+
+    (call,) = ffmpeg.calls()
+    assert call['sizes'] == [len(data)] and job.progress == 1.0
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(path + transcode.ENCODING_SUFFIX)
+
+
+def test_failed_encode_reports_ffmpegs_message(ffmpeg, workdir):
+    source = workdir / 'source.mp4'
+    source.write_bytes(media_bytes(137, 0, 4096, 4096))
+    ffmpeg.fail()
+
+    job = transcoder.submit(str(source), 'h264')
+    with pytest.raises(Exception, match="ffmpeg failed: Invalid data"):
+        job.result(timeout=60)
+    assert job.status == 'failed' and not os.path.exists(job.out_path)
+
+
+def test_download_and_transcode_encode_while_fetching(backend, ffmpeg):
+    stream, title = get_stream(backend, 'transcodeaa', 140)
+    encodes = []
+
+    path, filename = download_and_transcode(stream, title, 'downloads', 'h264', on_encode=encodes.append)
+
+    assert filename.endswith('.m4a') and encodes[-1].status == 'done'
+    (call,) = ffmpeg.calls()
+    assert call['args'][call['args'].index('-c:a') + 1] == 'copy'
+    with open(path, 'rb') as f:
+        assert f.read() == media_bytes(140, 0, stream.filesize, stream.filesize)
+    # The source is kept in the store, not next to the encoded file
+    assert get_store('downloads').lookup(stream)
+    assert [n for n in os.listdir('downloads') if not n.startswith('.')] == [filename]
@@ -0,0 +1,430 @@
+"""Transcoding downloads into formats After Effects imports directly.
+
+    job = transcoder.submit(path, 'h264', stream)    # a file already on disk
+    out_path = job.result()                          # blocks; raises if ffmpeg failed
+    file_path, filename = download_and_transcode(stream, title, download_dir, 'prores')
+
+Profiles: 'h264' (H.264/AAC in MP4, or M4A for audio-only sources) and
+'prores' (ProRes 422 HQ with PCM audio in MOV, or WAV for audio-only
+sources). Whatever is already in the target codec is copied, not
+re-encoded.
+
+Encodes run on a pool of worker processes (YTDL_TRANSCODE_WORKERS, by
+default half the cores), each driving one ffmpeg, and wait in the pool's
+queue beyond that. A worker pipes its source into ffmpeg and can follow a
+file that is still being written, until `<source>.complete` appears;
+download_and_transcode uses that to encode a download's `.part` file
+while it is being fetched.
+"""
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from integrity import IntegrityError, check_container
+from metrics import metrics
+from segmented import DownloadCancelled, DownloadControl
+from streams import codec_family
+
+FFMPEG = os.environ.get("YTDL_FFMPEG") or shutil.which("ffmpeg")
+CPU_COUNT = os.cpu_count() or 1
+TRANSCODE_WORKERS = int(os.environ.get("YTDL_TRANSCODE_WORKERS", 0)) or max(1, CPU_COUNT // 2)
+# ffmpeg threads per encode, so a full pool keeps every core busy once
+ENCODE_THREADS = max(1, CPU_COUNT // TRANSCODE_WORKERS)
+# Written next to a growing source once its last byte is on disk
+COMPLETE_SUFFIX = ".complete"
+ENCODING_SUFFIX = ".encoding"
+FEED_CHUNK_SIZE = 1024 * 1024
+# How often a worker looks for more bytes of a growing source
+FOLLOW_INTERVAL = 0.1
+# Progress is reported to the parent after every this many bytes fed
+PROGRESS_BYTES = 4 * 1024 * 1024
+
+H264_VIDEO = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-pix_fmt', 'yuv420p']
+AAC_AUDIO = ['-c:a', 'aac', '-b:a', '192k']
+PRORES_VIDEO = ['-c:v', 'prores_ks', '-profile:v', '3', '-pix_fmt', 'yuv422p10le']
+PCM_AUDIO = ['-c:a', 'pcm_s16le']
+PROFILES = ('h264', 'prores')
+
+
+def transcode_args(profile, stream=None):
+    """ffmpeg output options and file extension for encoding stream to profile"""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown transcode profile '{profile}' (use {' or '.join(PROFILES)})")
+    audio_only = stream is not None and stream.type == 'audio'
+    video_family = codec_family(stream.video_codec) if stream is not None and stream.video_codec else None
+    audio_family = codec_family(stream.audio_codec) if stream is not None and stream.audio_codec else None
+
+    if profile == 'h264':
+        audio = ['-c:a', 'copy'] if audio_family == 'aac' else AAC_AUDIO
+        if audio_only:
+            return ['-map', '0:a:0', '-vn', *audio, '-f', 'mp4'], '.m4a'
+        video = ['-c:v', 'copy'] if video_family == 'h264' else H264_VIDEO
+        return (['-map', '0:v:0', '-map', '0:a:0?', *video, *audio, '-movflags', '+faststart', '-f', 'mp4'],
+                '.mp4')
+    if audio_only:
+        return ['-map', '0:a:0', '-vn', *PCM_AUDIO, '-f', 'wav'], '.wav'
+    return ['-map', '0:v:0', '-map', '0:a:0?', *PRORES_VIDEO, *PCM_AUDIO, '-f', 'mov'], '.mov'
+
+
+# --- Worker process side ---
+_events = None
+
+
+def _init_worker(events):
+    global _events
+    _events = events
+
+
+def _encode(job_id, ffmpeg, source, out_path, args, follow):
+    """Pipe source through ffmpeg, following it while it grows; returns (exit code, bytes fed, stderr)"""
+    with tempfile.TemporaryFile() as stderr:
+        f = open(source, 'rb')
+        proc = subprocess.Popen([ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', 'pipe:0',
+                                 '-threads', str(ENCODE_THREADS), *args, out_path],
+                                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        _events.put((job_id, 'started', proc.pid))
+        fed = reported = 0
+        try:
+            while True:
+                chunk = f.read(FEED_CHUNK_SIZE)
+                if chunk:
+                    proc.stdin.write(chunk)
+                    fed += len(chunk)
+                    if fed - reported >= PROGRESS_BYTES:
+                        _events.put((job_id, 'progress', fed))
+                        reported = fed
+                elif not follow:
+                    break
+                elif os.path.exists(source + COMPLETE_SUFFIX):
+                    follow = False  # one more pass picks up the last bytes
+                elif proc.poll() is not None:
+                    break
+                else:
+                    time.sleep(FOLLOW_INTERVAL)
+        except BrokenPipeError:
+            pass  # ffmpeg quit early; its exit code and message say why
+        finally:
+            f.close()
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        # The source is closed, so the parent may move it while ffmpeg finishes
+        _events.put((job_id, 'fed', fed))
+        code = proc.wait()
+        stderr.seek(0)
+        return code, fed, stderr.read().decode(errors='replace').strip()
+
+
+# --- Parent side ---
+class TranscodeJob:
+    """One queued or running encode and its progress"""
+
+    def __init__(self, source, out_path, profile, total, on_progress=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.source = source
+        self.out_path = out_path
+        self.profile = profile
+        self.total = total  # source bytes, if known
+        self.on_progress = on_progress  # on_progress(job), from the transcoder's event thread
+        self.status = 'queued'  # queued, encoding, done, failed, cancelled
+        self.bytes_done = 0
+        self.error = None
+        self.pid = None
+        self.cancelled = False
+        self.future = None
+        self.fed = threading.Event()  # the worker has read all it will of the source
+        self.done = threading.Event()
+
+    @property
+    def progress(self):
+        """Fraction of the source encoded so far, or None if its size is unknown"""
+        if self.status == 'done':
+            return 1.0
+        return min(self.bytes_done / self.total, 1.0) if self.total else None
+
+    def result(self, timeout=None):
+        """Path of the encoded file once done; raises DownloadCancelled or the ffmpeg error"""
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Transcode {self.id} still running")
+        if self.status == 'cancelled':
+            raise DownloadCancelled()
+        if self.status == 'failed':
+            raise Exception(self.error)
+        return self.out_path
+
+
+class Transcoder:
+    """Queues TranscodeJobs onto a process pool and tracks their progress.
+
+    The pool and its event thread start with the first job.
+    """
+
+    def __init__(self, workers=TRANSCODE_WORKERS):
+        self.workers = workers
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._events = None
+
+    def _start(self):
+        with self._lock:
+            if self._pool is None:
+                # Fresh interpreters: forking a process full of threads isn't safe
+                context = multiprocessing.get_context('spawn')
+                self._events = context.Queue()
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=context,
+                                                 initializer=_init_worker, initargs=(self._events,))
+                threading.Thread(target=self._listen, daemon=True, name='transcode-events').start()
+
+    def submit(self, source, profile, stream=None, out_path=None, total=None, follow=False, on_progress=None):
+        """Queue an encode of source; with follow, source may still be growing until
+        `source + COMPLETE_SUFFIX` exists"""
+        if not FFMPEG:
+            raise Exception("ffmpeg was not found. Install it or set YTDL_FFMPEG to its path.")
+        args, extension = transcode_args(profile, stream)
+        if out_path is None:
+            out_path = f"{os.path.splitext(source)[0]}_{profile}{extension}"
+        if total is None and not follow:
+            total = os.path.getsize(source)
+        self._start()
+        job = TranscodeJob(source, out_path, profile, total, on_progress)
+        with self._lock:
+            self._jobs[job.id] = job
+        # Workers keep the working directory they were started in
+        job.future = self._pool.submit(_encode, job.id, FFMPEG, os.path.abspath(source),
+                                       os.path.abspath(out_path + ENCODING_SUFFIX), args, follow)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def cancel(self, job):
+        job.cancelled = True
+        if job.future is not None and job.future.cancel():
+            return
+        if job.pid is not None and not job.done.is_set():
+            _kill(job.pid)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _listen(self):
+        while True:
+            job_id, kind, value = self._events.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            if kind == 'started':
+                job.pid, job.status = value, 'encoding'
+                if job.cancelled:
+                    _kill(value)
+            elif kind == 'progress':
+                job.bytes_done = value
+            elif kind == 'fed':
+                job.bytes_done = value
+                job.fed.set()
+            if job.on_progress:
+                job.on_progress(job)
+
+    def _finish(self, job, future):
+        tmp_path = job.out_path + ENCODING_SUFFIX
+        if job.cancelled or future.cancelled():
+            job.status = 'cancelled'
+        elif future.exception() is not None:
+            job.status, job.error = 'failed', f"Transcode worker failed: {future.exception()}"
+        else:
+            code, job.bytes_done, err = future.result()
+            if code == 0:
+                try:
+                    check_container(tmp_path, os.path.splitext(job.out_path)[1][1:])
+                    os.replace(tmp_path, job.out_path)
+                    job.status = 'done'
+                except IntegrityError as e:
+                    job.status, job.error = 'failed', f"ffmpeg output is damaged: {e}"
+            else:
+                job.status, job.error = 'failed', f"ffmpeg failed: {err}"
+        if job.status != 'done':
+            _remove(tmp_path)
+        metrics.count('transcodes_total', profile=job.profile, outcome=job.status)
+        with self._lock:
+            self._jobs.pop(job.id, None)
+        job.fed.set()
+        job.done.set()
+        if job.on_progress:
+            job.on_progress(job)
+
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass  # already gone
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+async def async_download_and_transcode(stream, title, download_dir, profile, on_progress=None, on_encode=None,
+                                       control=None):
+    """Download stream and encode it to profile at the same time; returns (file_path, filename)
+
+    The download goes through the download folder's store like any other,
+    except that its `.part` file is written in order, so the encode can
+    follow it and finishes shortly after the last byte arrives. It resumes
+    from the bytes a previous attempt left, is hashed as it arrives and is
+    only stored once verified. A stream already stored, or being fetched
+    for another caller, is encoded from the finished file.
+    on_progress(stream, chunk, bytes_remaining) reports the download and
+    on_encode(job) the TranscodeJob; `control` pauses the download or
+    cancels both.
+    """
+    from commons import async_download_selected_stream, cleanup_video
+    from store import get_store
+
+    control = control or DownloadControl()
+    _, extension = transcode_args(profile, stream)
+    unique_id = str(uuid.uuid4())[:8]
+    safe_title = "".join([c if c.isalnum() else "_" for c in title])
+    filename = f"{safe_title}_{unique_id}{extension}"
+    file_path = os.path.join(download_dir, filename)
+    store = await asyncio.to_thread(get_store, download_dir)
+
+    following = []  # the encode that follows this caller's download, if it runs one
+    source = None
+    job = None
+    try:
+        if stream.filesize and getattr(stream, 'video_id', None):
+            async def download(path, progress, shared_control):
+                return await _download_followed(stream, path, profile, file_path, on_encode, progress,
+                                                shared_control, following)
+
+            source = file_path + '.source'
+            await store.fetch(stream, source, download, on_progress, control)
+        else:
+            # No size to follow a download by: encode the finished file
+            source, _ = await async_download_selected_stream(stream, title, download_dir,
+                                                             on_progress=on_progress, control=control)
+        job = following[0] if following else transcoder.submit(source, profile, stream, out_path=file_path,
+                                                               on_progress=on_encode)
+        await _wait(job, control)
+    except BaseException:
+        job = job or (following[0] if following else None)
+        if job is not None and not job.done.is_set():
+            transcoder.cancel(job)
+            await asyncio.to_thread(job.done.wait, 5)
+        raise
+    finally:
+        if source:
+            cleanup_video(source)
+    await asyncio.to_thread(store.track_file, file_path)
+    return file_path, filename
+
+
+async def _download_followed(stream, path, profile, out_path, on_encode, on_progress, control, following):
+    """Fetch stream in order into its `.part` file while an encode to out_path
+    follows it, then verify and move it to path; returns its integrity digest.
+    The encode is appended to `following` unless it never got to start."""
+    from async_engine import ordered_chunks
+    from commons import async_refresh_stream_url
+    from integrity import StreamVerifier
+    from mux import PIPE_CHUNK_SIZE, PIPE_LOOKAHEAD
+    from partial import PartialDownload
+    from segmented import CHECKPOINT_INTERVAL, throttle_threshold
+
+    partial = PartialDownload.for_stream(stream, os.path.dirname(path))
+    pos = await asyncio.to_thread(partial.prefix)
+    verifier = StreamVerifier(stream.filesize)
+    job = transcoder.submit(partial.path, profile, stream, out_path=out_path, total=stream.filesize, follow=True,
+                            on_progress=on_encode)
+    following.append(job)
+    complete = partial.path + COMPLETE_SUFFIX
+    try:
+        with metrics.download(stream) as timer:
+            on_chunk = timer.wrap(on_progress)
+            f = await asyncio.to_thread(open, partial.path, 'ab', buffering=0)
+            saved = time.monotonic()
+            try:
+                async for chunk in ordered_chunks(stream, PIPE_CHUNK_SIZE, PIPE_LOOKAHEAD,
+                                                  on_stale=async_refresh_stream_url, control=control,
+                                                  min_rate=throttle_threshold(stream), start=pos):
+                    while control.paused and not control.cancelled.is_set():
+                        await asyncio.sleep(0.2)
+                    if control.cancelled.is_set():
+                        raise DownloadCancelled()
+                    await asyncio.to_thread(_append, f, verifier, pos, chunk)
+                    pos += len(chunk)
+                    if time.monotonic() - saved >= CHECKPOINT_INTERVAL:
+                        await asyncio.to_thread(partial.save, [(0, pos)])
+                        saved = time.monotonic()
+                    on_chunk(stream, chunk, stream.filesize - pos)
+            finally:
+                # Whatever is on disk is kept for the next attempt
+                await asyncio.to_thread(f.close)
+                await asyncio.to_thread(partial.save, [(0, pos)])
+        await asyncio.to_thread(_touch, complete)
+        digest = await asyncio.to_thread(_verify, partial.path, stream, verifier)
+        if job.future.cancel():
+            # No worker picked the encode up in time; it runs from the stored file instead
+            following.remove(job)
+        else:
+            # Windows can't move a file that is still open
+            while not job.fed.is_set():
+                await asyncio.sleep(FOLLOW_INTERVAL)
+        await asyncio.to_thread(partial.promote, path)
+        return digest
+    except BaseException as e:
+        if not job.done.is_set():
+            transcoder.cancel(job)
+            await asyncio.to_thread(job.done.wait, 5)
+        if isinstance(e, IntegrityError) or isinstance(e, DownloadCancelled) and not control.keep_partial:
+            await asyncio.to_thread(partial.discard)
+        raise
+    finally:
+        _remove(complete)
+
+
+def _append(f, verifier, offset, data):
+    f.write(data)
+    verifier.update(offset, data)
+
+
+def _touch(path):
+    open(path, 'w').close()
+
+
+def _verify(path, stream, verifier):
+    digest = verifier.finish(path)
+    check_container(path, stream.subtype)
+    return digest
+
+
+async def _wait(job, control):
+    while not job.done.is_set():
+        if control.cancelled.is_set():
+            raise DownloadCancelled()
+        await asyncio.sleep(0.2)
+    return job.result()
+
+
+def download_and_transcode(stream, title, download_dir, profile, on_progress=None, on_encode=None, control=None):
+    """Download and transcode the selected stream (blocking wrapper)"""
+    from async_engine import run_sync
+    return run_sync(async_download_and_transcode(stream, title, download_dir, profile, on_progress, on_encode,
+                                                 control))
+
+
+# Shared by every front end in this process
+transcoder = Transcoder()